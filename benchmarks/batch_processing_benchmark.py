@@ -0,0 +1,160 @@
+"""
+Benchmark of batched data processing (easy_run_batch) as the number of participants per task varies.
+
+Most participants have a few small files to process every cycle, so their processing time is mostly
+the fixed cost of a run.  This benchmark creates a study of such participants in a test database
+(created and destroyed like the test runner does, your database is not touched) with their uploads
+in an in-memory stand-in for S3, and processes all of them in tasks of each batch size.  Each batch
+size starts from the same uploads.
+
+Every Celery task also sleeps for AbstractQueueWrapper.SLEEP_TIME seconds after it finishes, that
+time is not slept here, it is added to the "with task sleep" column.
+    python -m benchmarks.batch_processing_benchmark [participants] [files_per_participant]
+"""
+
+import random
+import sys
+from io import BytesIO
+from time import perf_counter
+from unittest.mock import MagicMock, patch
+
+import database  # sets up django  # noqa: F401
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from constants.user_constants import ANDROID_API
+from database.models import ChunkRegistry, FileToProcess, Participant, S3File, Study
+from libs.celery_control import AbstractQueueWrapper
+from libs.file_processing.file_processing_core import easy_run_batch, RUN_FINISHED
+from libs.s3 import s3_upload
+
+
+BATCH_SIZES = (1, 5, 25)
+ENCRYPTION_KEY = "benchmarkbenchmarkbenchmarkbench"
+START_MS = 1770357600000  # 2026-02-06T06:00:00 UTC
+PASSWORD = "sha1$1000$zsk387ts02hDMRAALwL2SL3nVHFgMs84UcZRYIQWYNQ=$hllJauvRYDJMQpXQKzTdwQ=="
+
+
+def power_state_file(rng: random.Random, start_ms: int) -> bytes:
+    """ A few minutes of screen on/off events. """
+    rows = [b"timestamp,event,level"]
+    t = start_ms
+    for _ in range(rng.randint(5, 40)):
+        t += rng.randint(1_000, 20_000)
+        rows.append(b"%d,%s,%.2f" % (t, rng.choice([b"Locked", b"Unlocked"]), rng.random()))
+    return b"\n".join(rows)
+
+
+def fake_s3_conn(fake_s3: dict[str, bytes]) -> MagicMock:
+    conn = MagicMock()
+    
+    def put_object(Body: bytes, Bucket: str, Key: str):
+        fake_s3[Key] = Body
+    
+    def get_object(Bucket: str, Key: str, **kwargs):
+        return {"Body": BytesIO(fake_s3[Key])}
+    
+    def delete_object(Bucket: str, Key: str):
+        fake_s3.pop(Key)
+        return {}
+    
+    conn.put_object.side_effect = put_object
+    conn.get_object.side_effect = get_object
+    conn.delete_object.side_effect = delete_object
+    return conn
+
+
+def create_uploads(
+    participant_count: int, files_per_participant: int
+) -> tuple[list[int], list[FileToProcess]]:
+    """ Creates the participants and uploads their files, returns participant ids and the files to
+    process, which are deleted by processing. """
+    rng = random.Random(participant_count)
+    study = Study.create_with_object_id(
+        name="batch processing benchmark", encryption_key=ENCRYPTION_KEY, timezone_name="UTC"
+    )
+    participants = Participant.objects.bulk_create(
+        Participant(
+            patient_id=f"bench{i:03}", study=study, os_type=ANDROID_API, device_id="benchmark",
+            password=PASSWORD,
+        )
+        for i in range(participant_count)
+    )
+    
+    ftps = []
+    for participant in participants:
+        for i in range(files_per_participant):
+            start_ms = START_MS + i * 600_000
+            path = f"{study.object_id}/{participant.patient_id}/powerState/{start_ms}.csv"
+            s3_upload(path, power_state_file(rng, start_ms), study, raw_path=True)
+            ftps.append(FileToProcess(
+                s3_file_path=path, study=study, participant=participant, os_type=ANDROID_API
+            ))
+    return [participant.pk for participant in participants], ftps
+
+
+def reset(uploads: dict[str, bytes], fake_s3: dict[str, bytes], ftps: list[FileToProcess]):
+    ChunkRegistry.objects.all().delete()
+    S3File.objects.filter(path__startswith="CHUNKED_DATA/").delete()
+    FileToProcess.objects.all().delete()
+    FileToProcess.objects.bulk_create(
+        FileToProcess(
+            s3_file_path=ftp.s3_file_path, study=ftp.study, participant=ftp.participant,
+            os_type=ftp.os_type,
+        )
+        for ftp in ftps
+    )
+    fake_s3.clear()
+    fake_s3.update(uploads)
+
+
+def run(participant_ids: list[int], batch_size: int) -> tuple[float, int, int]:
+    """ Processes every participant in tasks of batch_size participants, returns the seconds taken,
+    the number of tasks, and the number of database queries. """
+    failures = 0
+    task_count = 0
+    with CaptureQueriesContext(connection) as queries:
+        t_start = perf_counter()
+        for i in range(0, len(participant_ids), batch_size):
+            runs = easy_run_batch(participant_ids[i:i + batch_size])
+            failures += sum(outcome != RUN_FINISHED for _, _, outcome in runs)
+            task_count += 1
+        elapsed = perf_counter() - t_start
+    assert failures == 0, f"{failures} participants failed to process"
+    assert not FileToProcess.objects.exists()
+    return elapsed, task_count, len(queries)
+
+
+def main():
+    participant_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    files_per_participant = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    
+    old_database_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    fake_s3: dict[str, bytes] = {}
+    try:
+        with patch("libs.s3.conn", fake_s3_conn(fake_s3)), \
+                patch("libs.file_processing.file_processing_core.log"), \
+                patch("libs.file_processing.file_processing_core.logd"):
+            participant_ids, ftps = create_uploads(participant_count, files_per_participant)
+            uploads = dict(fake_s3)
+            
+            print(f"{participant_count} participants, {files_per_participant} files each")
+            print(
+                f"{'batch size':>10} {'tasks':>6} {'seconds':>8} {'participants/s':>15} "
+                f"{'files/s':>8} {'queries':>8} {'with task sleep, participants/s':>32}"
+            )
+            for batch_size in BATCH_SIZES:
+                reset(uploads, fake_s3, ftps)
+                elapsed, task_count, query_count = run(participant_ids, batch_size)
+                with_sleep = elapsed + task_count * AbstractQueueWrapper.SLEEP_TIME
+                print(
+                    f"{batch_size:>10} {task_count:>6} {elapsed:>8.2f} "
+                    f"{participant_count / elapsed:>15.1f} {len(ftps) / elapsed:>8.1f} "
+                    f"{query_count:>8} {participant_count / with_sleep:>32.2f}"
+                )
+    finally:
+        connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Benchmark of binning a page of uploaded files in worker processes (FILE_PROCESS_BINNING_WORKERS).
+
+A page of synthetic raw uploads, several files of each of several data streams, is split, fixed
+and sorted into hourly bins in this process (what FileProcessingTracker does with the setting at 0),
+and then in a pool of each number of worker processes, one task per data stream, including
+unpacking the results in this process.  The pool's processes are started before timing, like the
+long lived pool of a data processing task.  The speedup is bounded by the number of cpu cores and
+by the number of data streams in the page.
+    python -m benchmarks.binning_pool_benchmark [files_per_stream] [minutes_per_file]
+"""
+
+import hashlib
+import os
+import random
+import sys
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import get_context
+from time import perf_counter
+
+import database  # sets up django  # noqa: F401
+
+from constants.data_stream_constants import ACCELEROMETER, GPS, GYRO, MAGNETOMETER, POWER_STATE
+from constants.user_constants import ANDROID_API
+from libs.file_processing.binning_pool import (bin_file_contents, bin_stream_files, BinnedFile,
+    StreamFile, unpack_rows)
+
+
+WORKER_COUNTS = (1, 2, 4, 8)
+START_MS = 1770357600000  # 2026-02-06T06:00:00 UTC
+
+# s3 folder name, header, milliseconds between rows, a row
+STREAMS = {
+    ACCELEROMETER: ("accel", b"timestamp,accuracy,x,y,z", 10, lambda rng: b"unknown,%.16f,%.16f,%.16f" % (
+        rng.uniform(-1, 1), rng.uniform(-1, 1), rng.uniform(9, 10))),
+    GYRO: ("gyro", b"timestamp,accuracy,x,y,z", 10, lambda rng: b"unknown,%.16f,%.16f,%.16f" % (
+        rng.uniform(-1, 1), rng.uniform(-1, 1), rng.uniform(-1, 1))),
+    MAGNETOMETER: ("magnetometer", b"timestamp,x,y,z", 10, lambda rng: b"%.16f,%.16f,%.16f" % (
+        rng.uniform(-50, 50), rng.uniform(-50, 50), rng.uniform(-50, 50))),
+    GPS: ("gps", b"timestamp,latitude,longitude,altitude,accuracy", 1000, lambda rng: b"%.8f,%.8f,%.2f,%.1f" % (
+        rng.uniform(42, 43), rng.uniform(-72, -71), rng.uniform(0, 100), rng.uniform(1, 50))),
+    POWER_STATE: ("powerState", b"timestamp,event,level", 5000, lambda rng: b"%s,%.2f" % (
+        rng.choice([b"Locked", b"Unlocked"]), rng.random())),
+}
+
+
+def synthetic_page(files_per_stream: int, minutes_per_file: int) -> dict[str, list[StreamFile]]:
+    rng = random.Random(files_per_stream)
+    page: dict[str, list[StreamFile]] = {}
+    pk = 0
+    for data_type, (folder, header, step_ms, make_row) in STREAMS.items():
+        page[data_type] = []
+        for i in range(files_per_stream):
+            start_ms = START_MS + i * minutes_per_file * 60_000
+            lines = [header]
+            for t in range(start_ms, start_ms + minutes_per_file * 60_000, step_ms):
+                lines.append(b"%d," % t + make_row(rng))
+            pk += 1
+            page[data_type].append(
+                (pk, f"study/patient/{folder}/{start_ms}.csv", ANDROID_API, b"\n".join(lines))
+            )
+    return page
+
+
+def output_hash(binned_files: dict[int, BinnedFile | Exception]) -> str:
+    sha1 = hashlib.sha1()
+    for pk in sorted(binned_files):
+        binned_file = binned_files[pk]
+        assert binned_file is not None and not isinstance(binned_file, Exception), binned_file
+        header, packed_bins = binned_file
+        sha1.update(header)
+        for time_bin in sorted(packed_bins):
+            sha1.update(b"%d\n" % time_bin)
+            for row in unpack_rows(packed_bins[time_bin]):
+                sha1.update(b",".join(row) + b"\n")
+    return sha1.hexdigest()
+
+
+def run_in_process(page: dict[str, list[StreamFile]]) -> tuple[float, str]:
+    t_start = perf_counter()
+    binned_files = {}
+    for stream_files in page.values():
+        for pk, s3_file_path, os_type, file_contents in stream_files:
+            binned_file = bin_file_contents(s3_file_path, os_type, file_contents)
+            binned_files[pk] = binned_file
+            for packed_rows in binned_file[1].values():
+                unpack_rows(packed_rows)
+    return perf_counter() - t_start, output_hash(binned_files)
+
+
+def run_in_pool(page: dict[str, list[StreamFile]], workers: int) -> tuple[float, str]:
+    with ProcessPoolExecutor(workers, mp_context=get_context("spawn")) as pool:
+        wait([pool.submit(sum, []) for _ in range(workers)])  # start the processes
+        t_start = perf_counter()
+        binned_files = {}
+        futures = [pool.submit(bin_stream_files, list(stream_files)) for stream_files in page.values()]
+        for future in futures:
+            for pk, binned_file in future.result():
+                binned_files[pk] = binned_file
+                for packed_rows in binned_file[1].values():
+                    unpack_rows(packed_rows)
+        elapsed = perf_counter() - t_start
+    return elapsed, output_hash(binned_files)
+
+
+def main(files_per_stream: int = 4, minutes_per_file: int = 10):
+    page = synthetic_page(files_per_stream, minutes_per_file)
+    size = sum(len(f[3]) for stream_files in page.values() for f in stream_files)
+    print(
+        f"{len(page)} data streams, {files_per_stream} files each, {size / 1024 ** 2:.1f} MB, "
+        f"{os.cpu_count()} cpu cores"
+    )
+    
+    elapsed, expected_hash = run_in_process(page)
+    print(f"{'in process':>12}: {elapsed:.3f}s, {size / 1024 ** 2 / elapsed:.1f} MB/s")
+    for workers in WORKER_COUNTS:
+        elapsed, pool_hash = run_in_pool(page, workers)
+        if pool_hash != expected_hash:
+            raise Exception(f"output of {workers} workers differs from in process")
+        print(f"{workers:>4} workers: {elapsed:.3f}s, {size / 1024 ** 2 / elapsed:.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,82 @@
+"""
+Benchmark of the new-chunk step of data processing (CsvMerger.chunk_not_exists_case), which builds
+a csv out of sorted rows and drops duplicate rows.
+
+Compares construct_csv_as_bytes_with_set (deduplicate through a set of every row of the chunk) with
+construct_csv_as_bytes (deduplicate only among rows that share a timestamp).  Data is a synthetic
+accelerometer hour at the given sample rate with a fraction of rows duplicated, like overlapping
+uploads; 100 Hz is ~37 MB of csv, 1000 Hz (the most the synthetic data supports) is ~370 MB.
+
+Each measurement runs in a fresh process so that peak RSS values are not polluted by prior runs.
+    python -m benchmarks.construct_csv_benchmark [hertz]
+"""
+
+import hashlib
+import resource
+import sys
+import tracemalloc
+from multiprocessing import get_context
+from time import perf_counter
+
+from benchmarks.csv_merge_benchmark import HEADER, HOUR_START_MS, synthetic_rows
+from libs.file_processing.utility_functions_csvs import (construct_csv_as_bytes,
+    construct_csv_as_bytes_with_set)
+
+
+DUPLICATE_EVERY = 20  # one row in 20 appears twice
+
+FUNCTIONS = {"set": construct_csv_as_bytes_with_set, "grouped": construct_csv_as_bytes}
+
+
+def generate_rows(hertz: int) -> list[list[bytes]]:
+    rows = []
+    for i, row in enumerate(synthetic_rows(hertz, HOUR_START_MS, HOUR_START_MS + 3_600_000)):
+        rows.append(row)
+        if i % DUPLICATE_EVERY == 0:
+            rows.append(list(row))
+    return rows
+
+
+def measure(function_name: str, hertz: int, use_tracemalloc: bool, queue):
+    rows = generate_rows(hertz)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if use_tracemalloc:
+        tracemalloc.start()
+    t_start = perf_counter()
+    output = FUNCTIONS[function_name](HEADER, rows)
+    elapsed = perf_counter() - t_start
+    traced_peak = tracemalloc.get_traced_memory()[1] if use_tracemalloc else None
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((elapsed, traced_peak, rss_before, rss_after, len(output), hashlib.sha1(output).hexdigest()))
+
+
+def run_in_child(function_name: str, hertz: int, use_tracemalloc: bool) -> tuple:
+    ctx = get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=measure, args=(function_name, hertz, use_tracemalloc, queue))
+    process.start()
+    ret = queue.get()
+    process.join()
+    return ret
+
+
+def main(hertz: int = 100):
+    if not 0 < hertz <= 1000:
+        raise ValueError("hertz must be between 1 and 1000")
+    print(f"{hertz} Hz for one hour, one row in {DUPLICATE_EVERY} duplicated")
+    results = {}
+    for function_name in FUNCTIONS:
+        elapsed, _, rss_before, rss_after, size, output_hash = run_in_child(function_name, hertz, False)
+        _, traced_peak, *_ = run_in_child(function_name, hertz, True)
+        results[function_name] = output_hash
+        # ru_maxrss is in kilobytes on linux
+        print(
+            f"{function_name:>8}: {elapsed:.3f}s, peak traced allocations {traced_peak / 1024 ** 2:.1f} MB, "
+            f"peak RSS {rss_before / 1024:.1f} MB -> {rss_after / 1024:.1f} MB, output {size} bytes"
+        )
+    if len(set(results.values())) != 1:
+        raise Exception("outputs differ between functions")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
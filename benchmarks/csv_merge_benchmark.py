@@ -0,0 +1,111 @@
+"""
+Benchmark of the existing-chunk update step of data processing (CsvMerger.chunk_exists_case).
+
+Compares the original path (concatenate, full sort, deduplicate through a set of every row) with
+merge_sorted_rows_as_csv_bytes (linear merge of already-sorted rows, per-timestamp deduplication).
+Data is a synthetic 100 Hz accelerometer hour, the existing chunk covers most of the hour and the
+new data covers the remainder plus an overlap of duplicate rows.
+
+Each measurement runs in a fresh process so that peak RSS values are not polluted by prior runs.
+    python -m benchmarks.csv_merge_benchmark [hertz] [minutes_new]
+"""
+
+import hashlib
+import random
+import resource
+import sys
+import tracemalloc
+from multiprocessing import get_context
+from time import perf_counter
+
+from libs.file_processing.utility_functions_csvs import (construct_csv_as_bytes,
+    construct_csv_as_bytes_with_set, existing_data_csv_splitter, unix_time_to_string)
+from libs.file_processing.utility_functions_simple import (ensure_sorted_by_timestamp,
+    merge_sorted_rows_as_csv_bytes)
+
+
+HEADER = b"timestamp,UTC time,accuracy,x,y,z"
+HOUR_START_MS = 1770357600000  # 2026-02-06T06:00:00 UTC
+OVERLAP_MINUTES = 2
+
+
+def synthetic_rows(hertz: int, start_ms: int, end_ms: int) -> list[list[bytes]]:
+    rng = random.Random(start_ms)
+    step = 1000 // hertz
+    rows = []
+    for t in range(start_ms, end_ms, step):
+        rows.append([
+            b"%d" % t,
+            unix_time_to_string(t // 1000) + b".%03d" % (t % 1000),
+            b"unknown",
+            b"%.16f" % rng.uniform(-1, 1),
+            b"%.16f" % rng.uniform(-1, 1),
+            b"%.16f" % rng.uniform(9, 10),
+        ])
+    return rows
+
+
+def generate_inputs(hertz: int, minutes_new: int) -> tuple[bytes, list[list[bytes]]]:
+    split_ms = HOUR_START_MS + (60 - minutes_new) * 60_000
+    existing = construct_csv_as_bytes(HEADER, synthetic_rows(hertz, HOUR_START_MS, split_ms))
+    new_rows = synthetic_rows(hertz, split_ms - OVERLAP_MINUTES * 60_000, HOUR_START_MS + 3_600_000)
+    return existing, new_rows
+
+
+def original_path(existing_file: bytes, new_rows: list[list[bytes]]) -> bytes:
+    header, output_rows = existing_data_csv_splitter(existing_file)
+    output_rows.extend(new_rows)
+    new_rows.clear()
+    ensure_sorted_by_timestamp(output_rows)
+    return construct_csv_as_bytes_with_set(header, output_rows)
+
+
+def merge_path(existing_file: bytes, new_rows: list[list[bytes]]) -> bytes:
+    header, output_rows = existing_data_csv_splitter(existing_file)
+    return merge_sorted_rows_as_csv_bytes(header, output_rows, new_rows)
+
+
+PATHS = {"original": original_path, "merge": merge_path}
+
+
+def measure(path_name: str, hertz: int, minutes_new: int, use_tracemalloc: bool, queue):
+    existing_file, new_rows = generate_inputs(hertz, minutes_new)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if use_tracemalloc:
+        tracemalloc.start()
+    t_start = perf_counter()
+    output = PATHS[path_name](existing_file, new_rows)
+    elapsed = perf_counter() - t_start
+    traced_peak = tracemalloc.get_traced_memory()[1] if use_tracemalloc else None
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((elapsed, traced_peak, rss_before, rss_after, len(output), hashlib.sha1(output).hexdigest()))
+
+
+def run_in_child(path_name: str, hertz: int, minutes_new: int, use_tracemalloc: bool) -> tuple:
+    ctx = get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=measure, args=(path_name, hertz, minutes_new, use_tracemalloc, queue))
+    process.start()
+    ret = queue.get()
+    process.join()
+    return ret
+
+
+def main(hertz: int = 100, minutes_new: int = 10):
+    print(f"{hertz} Hz, existing chunk of {60 - minutes_new} minutes, {minutes_new + OVERLAP_MINUTES} minutes of new data")
+    results = {}
+    for path_name in PATHS:
+        elapsed, _, rss_before, rss_after, size, output_hash = run_in_child(path_name, hertz, minutes_new, False)
+        _, traced_peak, *_ = run_in_child(path_name, hertz, minutes_new, True)
+        results[path_name] = output_hash
+        # ru_maxrss is in kilobytes on linux
+        print(
+            f"{path_name:>9}: {elapsed:.3f}s, peak traced allocations {traced_peak / 1024 ** 2:.1f} MB, "
+            f"peak RSS {rss_before / 1024:.1f} MB -> {rss_after / 1024:.1f} MB, output {size} bytes"
+        )
+    if len(set(results.values())) != 1:
+        raise Exception("outputs differ between paths")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
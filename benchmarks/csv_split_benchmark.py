@@ -0,0 +1,96 @@
+"""
+Benchmark of the first step of processing an uploaded file (FileForProcessing.raw_csv_to_line_list),
+which splits the raw csv into a header and rows.
+
+Compares the original splitlines-then-split (a list of every line and the rows exist at the same
+time) with split_csv_rows, splitting every column and splitting only the timestamp column (which is
+what binning needs).  Data is a synthetic raw accelerometer upload at 100 Hz of the given length;
+60 minutes is ~29 MB, the largest uploads are a few hundred MB.
+
+Each measurement runs in a fresh process so that peak RSS values are not polluted by prior runs.
+    python -m benchmarks.csv_split_benchmark [minutes]
+"""
+
+import hashlib
+import random
+import resource
+import sys
+import tracemalloc
+from multiprocessing import get_context
+from time import perf_counter
+
+from libs.file_processing.utility_functions_csvs import split_csv_rows
+
+
+HEADER = b"timestamp,accuracy,x,y,z"
+START_MS = 1770357600000  # 2026-02-06T06:00:00 UTC
+
+
+def original_split(file_contents: bytes) -> tuple[bytes, list[list[bytes]]]:
+    lines = file_contents.splitlines()
+    return lines.pop(0), [line.split(b",") for line in lines]
+
+
+FUNCTIONS = {
+    "splitlines": original_split,
+    "split_csv_rows": split_csv_rows,
+    "split_csv_rows, timestamp only": lambda file_contents: split_csv_rows(file_contents, 1),
+}
+
+
+def synthetic_upload(minutes: int) -> bytes:
+    rng = random.Random(minutes)
+    lines = [HEADER]
+    for t in range(START_MS, START_MS + minutes * 60_000, 10):
+        lines.append(b"%d,unknown,%.16f,%.16f,%.16f" % (
+            t, rng.uniform(-1, 1), rng.uniform(-1, 1), rng.uniform(9, 10)
+        ))
+    return b"\n".join(lines)
+
+
+def measure(function_name: str, minutes: int, use_tracemalloc: bool, queue):
+    file_contents = synthetic_upload(minutes)
+    size = len(file_contents)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if use_tracemalloc:
+        tracemalloc.start()
+    t_start = perf_counter()
+    header, rows = FUNCTIONS[function_name](file_contents)
+    elapsed = perf_counter() - t_start
+    del file_contents  # like FileForProcessing.clear_file_content
+    traced_current, traced_peak = tracemalloc.get_traced_memory() if use_tracemalloc else (None, None)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    
+    # rows split on fewer commas join back into the same lines
+    output_hash = hashlib.sha1(b"\n".join([header] + [b",".join(row) for row in rows])).hexdigest()
+    queue.put((elapsed, traced_current, traced_peak, rss_before, rss_after, size, output_hash))
+
+
+def run_in_child(function_name: str, minutes: int, use_tracemalloc: bool) -> tuple:
+    ctx = get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=measure, args=(function_name, minutes, use_tracemalloc, queue))
+    process.start()
+    ret = queue.get()
+    process.join()
+    return ret
+
+
+def main(minutes: int = 60):
+    results = {}
+    for function_name in FUNCTIONS:
+        elapsed, _, _, rss_before, rss_after, size, output_hash = run_in_child(function_name, minutes, False)
+        _, traced_current, traced_peak, *_ = run_in_child(function_name, minutes, True)
+        results[function_name] = output_hash
+        # ru_maxrss is in kilobytes on linux
+        print(
+            f"{function_name:>30}: {elapsed:.3f}s, peak traced allocations {traced_peak / 1024 ** 2:.1f} MB, "
+            f"rows {traced_current / 1024 ** 2:.1f} MB, peak RSS {rss_before / 1024:.1f} MB -> "
+            f"{rss_after / 1024:.1f} MB, input {size} bytes"
+        )
+    if len(set(results.values())) != 1:
+        raise Exception("outputs differ between functions")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,4 @@
+"""
+End to end benchmark of data processing, see run.py.
+    python -m benchmarks.file_processing.run [minutes] [rate] [output_file]
+"""
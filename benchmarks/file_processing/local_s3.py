@@ -0,0 +1,96 @@
+import os
+from io import BytesIO
+
+from botocore.exceptions import ClientError as Boto3ClientError
+
+
+class LocalS3:
+    """ Stands in for the boto3 S3 client (libs.s3.conn) with a folder on local disk, one file per
+    key.  Only implements the calls that data processing and the upload endpoint make.  Objects hold
+    exactly what would be in S3, compressed and encrypted, so downloads pay the same decryption and
+    decompression cost. """
+    
+    def __init__(self, root: str):
+        self.root = root
+        # counters, the bytes that would have gone over the network
+        self.get_count = 0
+        self.put_count = 0
+        self.delete_count = 0
+        self.list_count = 0
+        self.bytes_downloaded = 0
+        self.bytes_uploaded = 0
+    
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+    
+    def put_object(self, Body: bytes, Bucket: str, Key: str, **kwargs):
+        path = self.path(Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(Body)
+        self.put_count += 1
+        self.bytes_uploaded += len(Body)
+        return {}
+    
+    def get_object(self, Bucket: str, Key: str, **kwargs):
+        try:
+            with open(self.path(Key), "rb") as f:
+                body = f.read()
+        except FileNotFoundError:
+            raise Boto3ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject") from None
+        self.get_count += 1
+        self.bytes_downloaded += len(body)
+        return {"Body": BytesIO(body)}
+    
+    def head_object(self, Bucket: str, Key: str, **kwargs):
+        try:
+            return {"ContentLength": os.path.getsize(self.path(Key))}
+        except FileNotFoundError:
+            raise Boto3ClientError({"Error": {"Code": "404"}}, "HeadObject") from None
+    
+    def delete_object(self, Bucket: str, Key: str, **kwargs):
+        try:
+            os.remove(self.path(Key))
+        except FileNotFoundError:
+            pass  # like S3
+        self.delete_count += 1
+        return {}
+    
+    def delete_objects(self, Bucket: str, Delete: dict, **kwargs):
+        for obj in Delete["Objects"]:
+            self.delete_object(Bucket, obj["Key"])
+        return {"Deleted": Delete["Objects"]}
+    
+    def get_paginator(self, operation_name: str):
+        if operation_name != "list_objects_v2":
+            raise NotImplementedError(f"LocalS3 does not implement {operation_name}")
+        return self
+    
+    def paginate(self, Bucket: str, Prefix: str, StartAfter: str = "", **kwargs):
+        """ The list_objects_v2 paginator, every matching key in one page. """
+        self.list_count += 1
+        contents = []
+        for folder, _, file_names in os.walk(self.root):
+            for file_name in file_names:
+                path = os.path.join(folder, file_name)
+                key = os.path.relpath(path, self.root).replace(os.sep, "/")
+                if key.startswith(Prefix) and key > StartAfter:
+                    contents.append({"Key": key, "Size": os.path.getsize(path)})
+        if contents:  # like S3, there is no Contents when nothing matches
+            yield {"Contents": sorted(contents, key=lambda item: item["Key"])}
+        else:
+            yield {}
+    
+    def reset_counters(self):
+        self.get_count = self.put_count = self.delete_count = self.list_count = 0
+        self.bytes_downloaded = self.bytes_uploaded = 0
+    
+    def counters(self) -> dict[str, int]:
+        return {
+            "s3_gets": self.get_count,
+            "s3_puts": self.put_count,
+            "s3_deletes": self.delete_count,
+            "s3_lists": self.list_count,
+            "s3_bytes_downloaded": self.bytes_downloaded,
+            "s3_bytes_uploaded": self.bytes_uploaded,
+        }
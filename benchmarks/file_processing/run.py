@@ -0,0 +1,211 @@
+"""
+End to end benchmark of data processing, FileProcessingTracker.process_user_file_chunks, for an
+Android and an iOS participant with synthetic uploads of every chunkable data stream (see
+synthetic_participant.py).  Uploads are compressed and encrypted like real uploads and stored in a
+folder on local disk that stands in for S3 (see local_s3.py).  The database is a test database
+(created and destroyed like the test runner does, your database is not touched).
+
+There are two phases, like a participant's first processing run and the ones after it:
+    initial: all of the uploads, every chunk is new.
+    incremental: one more round of uploads that overlaps the last uploads, merged into existing chunks.
+
+Prints a JSON report, and writes it to output_file if given, so that runs can be compared across
+commits: rows/s, bytes/s (uncompressed upload bytes), database queries, S3 operations, and the time
+spent in each stage (FileProcessingTracker methods, cumulative) for each phase, and the peak RSS of
+the whole run.  Processing settings (FILE_PROCESS_*) apply as usual.
+    python -m benchmarks.file_processing.run [minutes] [rate] [output_file]
+"""
+
+import json
+import platform
+import resource
+import subprocess
+import sys
+from collections import defaultdict
+from contextlib import ExitStack
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from unittest.mock import patch
+
+import database  # sets up django  # noqa: F401
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from benchmarks.file_processing.local_s3 import LocalS3
+from benchmarks.file_processing.synthetic_participant import SyntheticUpload, synthetic_uploads
+from constants.user_constants import ANDROID_API, IOS_API
+from database.models import ChunkRegistry, FileToProcess, Participant, Study, Survey
+from libs.file_processing.file_processing_core import FileProcessingTracker
+from libs.s3 import s3_upload
+
+
+ENCRYPTION_KEY = "benchmarkbenchmarkbenchmarkbench"
+START_MS = 1770357600000  # 2026-02-06T06:00:00 UTC
+FILE_MINUTES = 10
+PASSWORD = "sha1$1000$zsk387ts02hDMRAALwL2SL3nVHFgMs84UcZRYIQWYNQ=$hllJauvRYDJMQpXQKzTdwQ=="
+
+# FileProcessingTracker methods that are timed, the pipelined ones run on background threads.
+STAGES = (
+    "get_paginated_files_to_process",
+    "download_files",
+    "binify_files",
+    "merge_binified_data",
+    "do_uploads",
+    "do_pipelined_uploads",
+    "finish_pipelined_upload",
+    "retire_files",
+    "compact_chunk_segments",
+)
+
+
+def timed_stages(stage_seconds: defaultdict[str, float]) -> ExitStack:
+    """ Patches the STAGES methods of FileProcessingTracker to add up their run time. """
+    stack = ExitStack()
+    for method_name in STAGES:
+        original = getattr(FileProcessingTracker, method_name)
+        
+        if method_name == "get_paginated_files_to_process":
+            def wrapper(self, *args, _original=original, _name=method_name, **kwargs):
+                pages = _original(self, *args, **kwargs)
+                while True:  # time each page's query, not the work done between pages
+                    t_start = perf_counter()
+                    page = next(pages, None)
+                    stage_seconds[_name] += perf_counter() - t_start
+                    if page is None:
+                        return
+                    yield page
+        else:
+            def wrapper(self, *args, _original=original, _name=method_name, **kwargs):
+                t_start = perf_counter()
+                try:
+                    return _original(self, *args, **kwargs)
+                finally:
+                    stage_seconds[_name] += perf_counter() - t_start
+        
+        stack.enter_context(patch.object(FileProcessingTracker, method_name, wrapper))
+    return stack
+
+
+def create_participants() -> tuple[Study, Survey, list[Participant]]:
+    study = Study.create_with_object_id(
+        name="file processing benchmark", encryption_key=ENCRYPTION_KEY, timezone_name="UTC"
+    )
+    survey = Survey.create_with_object_id(study=study, survey_type=Survey.TRACKING_SURVEY)
+    participants = [
+        Participant.objects.create(
+            patient_id=patient_id, study=study, os_type=os_type, device_id="benchmark", password=PASSWORD
+        )
+        for patient_id, os_type in (("benchand", ANDROID_API), ("benchios", IOS_API))
+    ]
+    return study, survey, participants
+
+
+def upload(study: Study, participant: Participant, uploads: list[SyntheticUpload]) -> tuple[int, int, int]:
+    """ Uploads the files and creates their FileToProcess objects, returns the number of files, rows
+    and (uncompressed) bytes. """
+    ftps = []
+    row_count = byte_count = 0
+    for relative_path, contents, rows in uploads:
+        path = f"{study.object_id}/{participant.patient_id}/{relative_path}"
+        s3_upload(path, contents, study, raw_path=True)
+        ftps.append(FileToProcess(
+            s3_file_path=path, study=study, participant=participant, os_type=participant.os_type
+        ))
+        row_count += rows
+        byte_count += len(contents)
+    FileToProcess.objects.bulk_create(ftps)
+    return len(ftps), row_count, byte_count
+
+
+def run_phase(
+    study: Study, participants: list[Participant], uploads: dict[int, list[SyntheticUpload]], local_s3: LocalS3
+) -> dict:
+    file_count = row_count = byte_count = 0
+    for participant in participants:
+        files, rows, size = upload(study, participant, uploads[participant.pk])
+        file_count, row_count, byte_count = file_count + files, row_count + rows, byte_count + size
+    
+    local_s3.reset_counters()
+    stage_seconds: defaultdict[str, float] = defaultdict(float)
+    with timed_stages(stage_seconds), CaptureQueriesContext(connection) as queries:
+        t_start = perf_counter()
+        for participant in participants:
+            FileProcessingTracker(participant).process_user_file_chunks()
+        elapsed = perf_counter() - t_start
+    
+    if FileToProcess.objects.exists():
+        raise Exception("some files failed to process")
+    
+    return {
+        "seconds": round(elapsed, 3),
+        "files": file_count,
+        "rows": row_count,
+        "bytes": byte_count,
+        "rows_per_second": round(row_count / elapsed),
+        "bytes_per_second": round(byte_count / elapsed),
+        "queries": len(queries),
+        "chunks": ChunkRegistry.objects.count(),
+        **local_s3.counters(),
+        "stages": {name: round(seconds, 3) for name, seconds in stage_seconds.items()},
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(minutes: int = 120, rate: float = 1.0, output_file: str | None = None):
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "minutes": minutes,
+        "rate": rate,
+        "file_minutes": FILE_MINUTES,
+    }
+    
+    old_database_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        with TemporaryDirectory() as s3_folder, \
+                patch("libs.s3.conn", LocalS3(s3_folder)) as local_s3, \
+                patch("libs.file_processing.file_processing_core.log"), \
+                patch("libs.file_processing.file_processing_core.logd"):
+            study, survey, participants = create_participants()
+            
+            def uploads(start_ms: int, minutes: int, seed: int) -> dict[int, list[SyntheticUpload]]:
+                return {
+                    participant.pk: synthetic_uploads(
+                        participant.os_type, start_ms, minutes, rate, FILE_MINUTES, survey.object_id, seed
+                    )
+                    for participant in participants
+                }
+            
+            report["initial"] = run_phase(study, participants, uploads(START_MS, minutes, 0), local_s3)
+            # the same time range as the last files of the initial phase, so they merge into chunks
+            last_files_ms = START_MS + (minutes - FILE_MINUTES) * 60_000
+            report["incremental"] = run_phase(
+                study, participants, uploads(last_files_ms, FILE_MINUTES, 1), local_s3
+            )
+    finally:
+        connection.creation.destroy_test_db(old_database_name, verbosity=0)
+    
+    # ru_maxrss is in kilobytes on linux
+    report["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    
+    output = json.dumps(report, indent=2)
+    print(output)
+    if output_file:
+        with open(output_file, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 120,
+        float(sys.argv[2]) if len(sys.argv) > 2 else 1.0,
+        sys.argv[3] if len(sys.argv) > 3 else None,
+    )
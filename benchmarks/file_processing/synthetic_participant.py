@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import random
+from collections.abc import Callable
+
+from constants.data_processing_constants import REFERENCE_UPLOAD_HEADERS
+from constants.data_stream_constants import (ACCELEROMETER, ANDROID_LOG_FILE, BLUETOOTH, CALL_LOG,
+    DATA_STREAM_TO_S3_FILE_NAME_STRING, DEVICEMOTION, GPS, GYRO, IDENTIFIERS, IOS_LOG_FILE,
+    MAGNETOMETER, POWER_STATE, PROXIMITY, REACHABILITY, SURVEY_TIMINGS, TEXTS_LOG, WIFI)
+from constants.user_constants import ANDROID_API, IOS_API
+
+
+"""
+Synthetic uploads of a participant's phone, for every data stream in CHUNKABLE_FILES that the
+participant's os records, in the formats the apps upload (see REFERENCE_UPLOAD_HEADERS).  Each data
+stream has a default rate in rows per minute, roughly what the apps record with common study
+settings, which the caller can scale.  Uploads are split into files of a fixed number of minutes,
+like the apps rotate their files.  Everything is seeded, the same arguments produce the same files.
+"""
+
+# an upload: s3 file path (without the study and patient folders), file contents, number of rows
+SyntheticUpload = tuple[str, bytes, int]
+RowMaker = Callable[[random.Random, int], bytes]
+
+HASHES = [b"%043dA=" % i for i in range(50)]  # stands in for hashed MACs and phone numbers
+
+# rows per minute at a rate multiplier of 1
+ANDROID_RATES = {
+    ACCELEROMETER: 600.0,  # 10 Hz
+    ANDROID_LOG_FILE: 2.0,
+    BLUETOOTH: 5.0,
+    CALL_LOG: 0.05,
+    GPS: 60.0,
+    GYRO: 600.0,
+    POWER_STATE: 1.0,
+    SURVEY_TIMINGS: 0.5,
+    TEXTS_LOG: 0.1,
+    WIFI: 4.0,  # a scan of 20 networks every 5 minutes
+}
+IOS_RATES = {
+    ACCELEROMETER: 600.0,
+    DEVICEMOTION: 600.0,
+    GPS: 60.0,
+    GYRO: 600.0,
+    IOS_LOG_FILE: 2.0,
+    MAGNETOMETER: 600.0,
+    POWER_STATE: 1.0,
+    PROXIMITY: 0.5,
+    REACHABILITY: 0.2,
+    SURVEY_TIMINGS: 0.5,
+}
+WIFI_SCAN_SIZE = 20
+
+
+def floats(rng: random.Random, count: int, low: float, high: float) -> bytes:
+    return b",".join(b"%.16f" % rng.uniform(low, high) for _ in range(count))
+
+
+def gps_row(rng: random.Random, t: int) -> bytes:
+    return b"%d,%.8f,%.8f,%.2f,%.1f" % (
+        t, rng.uniform(42.3, 42.4), rng.uniform(-71.2, -71.1), rng.uniform(0, 50), rng.uniform(3, 30)
+    )
+
+
+# makes a row from a timestamp, for each data stream and os.  (The call log's timestamp is its
+# third column, the android log file is space separated.)
+ROW_MAKERS: dict[tuple[str, str], RowMaker] = {
+    (ACCELEROMETER, ANDROID_API): lambda rng, t: b"%d,unknown,%s" % (t, floats(rng, 3, -10, 10)),
+    (ACCELEROMETER, IOS_API): lambda rng, t: b"%d,unknown,%s" % (t, floats(rng, 3, -1, 1)),
+    (BLUETOOTH, ANDROID_API): lambda rng, t: b"%d,%s,%d" % (t, rng.choice(HASHES), rng.randint(-100, -30)),
+    (CALL_LOG, ANDROID_API): lambda rng, t: b"%s,%s,%d,%d" % (
+        rng.choice(HASHES), rng.choice([b"Missed Call", b"Incoming Call", b"Outgoing Call"]), t,
+        rng.randint(0, 600),
+    ),
+    (DEVICEMOTION, IOS_API): lambda rng, t: b"%d,%s,%d,%s" % (
+        t, floats(rng, 12, -1, 1), rng.randint(-1, 2), floats(rng, 3, -50, 50)
+    ),
+    (GPS, ANDROID_API): lambda rng, t: gps_row(rng, t),
+    (GPS, IOS_API): lambda rng, t: gps_row(rng, t),
+    (GYRO, ANDROID_API): lambda rng, t: b"%d,unknown,%s" % (t, floats(rng, 3, -1, 1)),
+    (GYRO, IOS_API): lambda rng, t: b"%d,%s" % (t, floats(rng, 3, -1, 1)),
+    (IOS_LOG_FILE, IOS_API): lambda rng, t: b"%d,%d,%d,%.2f,%s,%s,,,," % (
+        t, rng.randint(1, 20), rng.randint(10_000_000, 90_000_000), rng.random(),
+        rng.choice([b"foreground", b"background", b"upload"]), b"some log message",
+    ),
+    (MAGNETOMETER, IOS_API): lambda rng, t: b"%d,%s" % (t, floats(rng, 3, -50, 50)),
+    (POWER_STATE, ANDROID_API): lambda rng, t: b"%d,%s" % (
+        t, rng.choice([b"Screen turned on", b"Screen turned off"])
+    ),
+    (POWER_STATE, IOS_API): lambda rng, t: b"%d,%s,%.2f" % (t, rng.choice([b"Locked", b"Unlocked"]), rng.random()),
+    (PROXIMITY, IOS_API): lambda rng, t: b"%d,%s" % (t, rng.choice([b"NearUser", b"NotNearUser"])),
+    (REACHABILITY, IOS_API): lambda rng, t: b"%d,%s" % (t, rng.choice([b"wifi", b"cellular", b"unreachable"])),
+    (SURVEY_TIMINGS, ANDROID_API): lambda rng, t: b"%d,%s,radio_button,How are you?,good;bad,good" % (
+        t, rng.choice([b"q1", b"q2", b"q3"])
+    ),
+    (SURVEY_TIMINGS, IOS_API): lambda rng, t: b"%d,%s,radio_button,How are you?,good;bad,good,answered" % (
+        t, rng.choice([b"q1", b"q2", b"q3"])
+    ),
+    (TEXTS_LOG, ANDROID_API): lambda rng, t: b"%d,%s,%s,%d,%d" % (
+        t, rng.choice(HASHES), rng.choice([b"sent SMS", b"received SMS"]), rng.randint(1, 200), t - 1000
+    ),
+    (ANDROID_LOG_FILE, ANDROID_API): lambda rng, t: b"%d %s" % (
+        t, rng.choice([b"Screen turned on", b"Bluetooth turned off", b"GPS on"])
+    ),
+}
+
+
+def stream_timestamps(rng: random.Random, start_ms: int, end_ms: int, rows_per_minute: float) -> list[int]:
+    """ Evenly spaced, with a little jitter, in order. """
+    expected_count = rows_per_minute * (end_ms - start_ms) / 60_000
+    count = int(expected_count) + (rng.random() < expected_count % 1)  # and maybe the fractional row
+    step = (end_ms - start_ms) / max(count, 1)
+    return [int(start_ms + i * step + rng.uniform(0, step / 4)) for i in range(count)]
+
+
+def synthetic_uploads(
+    os_type: str,
+    start_ms: int,
+    minutes: int,
+    rate: float = 1.0,
+    file_minutes: int = 10,
+    survey_object_id: str = "",
+    seed: int = 0,
+) -> list[SyntheticUpload]:
+    """ All of a participant's uploads for this many minutes of recording.  Survey timings need the
+    object id of a survey. """
+    rng = random.Random(seed)
+    rates = ANDROID_RATES if os_type == ANDROID_API else IOS_RATES
+    uploads: list[SyntheticUpload] = [identifiers_upload(os_type, start_ms)]
+    for file_start_ms in range(start_ms, start_ms + minutes * 60_000, file_minutes * 60_000):
+        file_end_ms = file_start_ms + file_minutes * 60_000
+        for data_stream, rows_per_minute in rates.items():
+            if data_stream == WIFI:
+                uploads.extend(wifi_uploads(rng, file_start_ms, file_end_ms, rate * rows_per_minute))
+                continue
+            timestamps = stream_timestamps(rng, file_start_ms, file_end_ms, rate * rows_per_minute)
+            make_row = ROW_MAKERS[(data_stream, os_type)]
+            rows = [make_row(rng, t) for t in timestamps]
+            header = REFERENCE_UPLOAD_HEADERS[data_stream][os_type]
+            uploads.append((
+                upload_path(data_stream, file_start_ms, survey_object_id),
+                b"\n".join([header] + rows),
+                len(rows),
+            ))
+    return uploads
+
+
+def upload_path(data_stream: str, timestamp_ms: int, survey_object_id: str = "") -> str:
+    folder = DATA_STREAM_TO_S3_FILE_NAME_STRING[data_stream]
+    if data_stream == SURVEY_TIMINGS:
+        return f"{folder}/{survey_object_id}/{timestamp_ms}.csv"
+    return f"{folder}/{timestamp_ms}.csv"
+
+
+def identifiers_upload(os_type: str, timestamp_ms: int) -> SyntheticUpload:
+    # identifiers files have the timestamp (in seconds) in the file name, after an underscore.
+    header = REFERENCE_UPLOAD_HEADERS[IDENTIFIERS][os_type].strip().encode()
+    row = b"patient1,%s,%s,device1,%s,16.1,product,brand,hardware1,manufacturer,model,3.4.0" % (
+        HASHES[0], HASHES[1], b"Android" if os_type == ANDROID_API else b"iOS"
+    )
+    return f"identifiers_{timestamp_ms // 1000}.csv", header + b"\n" + row, 1
+
+
+def wifi_uploads(rng: random.Random, start_ms: int, end_ms: int, rows_per_minute: float) -> list[SyntheticUpload]:
+    """ Wifi files are one scan each, with the time of the scan in the file name, not the rows. """
+    uploads = []
+    header = REFERENCE_UPLOAD_HEADERS[WIFI][ANDROID_API]
+    for t in stream_timestamps(rng, start_ms, end_ms, rows_per_minute / WIFI_SCAN_SIZE):
+        rows = [
+            b"%s,%d,%d" % (rng.choice(HASHES), rng.choice([2412, 2437, 5180]), rng.randint(-90, -30))
+            for _ in range(WIFI_SCAN_SIZE)
+        ]
+        uploads.append((upload_path(WIFI, t), b"\n".join([header] + rows), len(rows)))
+    return uploads
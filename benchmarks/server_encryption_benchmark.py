@@ -0,0 +1,63 @@
+"""
+Benchmark of the server-side encryption of files on S3 (libs/aes.py), the legacy AES-CFB-8 format
+against the current format, across file sizes.  Files on S3 are zstd compressed before encryption,
+so the data is random bytes, which is what compressed data looks like to a cipher.  Prints the
+throughput of encryption and decryption (MB/s of plaintext, the best of several repetitions) of
+each format and size, and checks that decrypt_server reads both formats.
+    python -m benchmarks.server_encryption_benchmark [repetitions]
+"""
+
+import sys
+from os import urandom
+from time import perf_counter
+
+from libs.aes import decrypt_server, encrypt_for_server, legacy_encrypt_for_server
+
+
+KEY = b"benchmarkbenchmarkbenchmarkbench"
+SIZES = (1024, 64 * 1024, 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2)
+FORMATS = {
+    "legacy cfb-8": legacy_encrypt_for_server,
+    "current": encrypt_for_server,
+}
+
+
+def best_seconds(function, repetitions: int) -> float:
+    best = float("inf")
+    for _ in range(repetitions):
+        t_start = perf_counter()
+        function()
+        best = min(best, perf_counter() - t_start)
+    return best
+
+
+def format_size(size: int) -> str:
+    if size >= 1024 ** 2:
+        return f"{size // 1024 ** 2}MB"
+    return f"{size // 1024}KB"
+
+
+def main(repetitions: int = 5):
+    print(f"{'size':>6}  {'format':>12}  {'encrypt MB/s':>12}  {'decrypt MB/s':>12}")
+    for size in SIZES:
+        data = urandom(size)
+        # smaller files are repeated so that each timing is long enough to measure
+        loops = max(1, 16 * 1024 ** 2 // size)
+        for name, encrypt in FORMATS.items():
+            encrypted = encrypt(data, KEY)
+            if decrypt_server(encrypted, KEY) != data:
+                raise Exception(f"{name} did not decrypt to the original data")
+            
+            encrypt_seconds = best_seconds(lambda: [encrypt(data, KEY) for _ in range(loops)], repetitions)
+            decrypt_seconds = best_seconds(
+                lambda: [decrypt_server(encrypted, KEY) for _ in range(loops)], repetitions
+            )
+            megabytes = size * loops / 1024 ** 2
+            print(
+                f"{format_size(size):>6}  {name:>12}  {megabytes / encrypt_seconds:>12.1f}  "
+                f"{megabytes / decrypt_seconds:>12.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,74 @@
+"""
+Benchmark of ensure_sorted_by_timestamp against the sort it replaced (a full sort that parses the
+timestamp inside the key function), over synthetic 100 Hz accelerometer rows that are:
+    sorted - in order, the normal case for a file from a device
+    nearly - in order except for a few swapped neighbors
+    runs   - a few sorted runs concatenated out of order, like several files binned together
+    random - shuffled, the worst case
+
+Reports the best of several repetitions for each.
+    python -m benchmarks.sort_benchmark [row_count] [repetitions]
+"""
+
+import random
+import sys
+from time import perf_counter
+
+from libs.file_processing.utility_functions_simple import (ensure_sorted_by_timestamp,
+    raise_sort_error)
+
+
+START_MS = 1770357600000  # 2026-02-06T06:00:00 UTC
+RUN_COUNT = 4
+SWAP_COUNT = 50
+
+
+def original_sort(rows: list[list[bytes]]):
+    try:
+        rows.sort(key=lambda row: int(bytes_item) if (bytes_item := row[0]).isdigit() else None)  # type: ignore
+    except (AttributeError, TypeError) as e:
+        raise_sort_error(rows, e)
+
+
+def synthetic_timestamps(kind: str, row_count: int) -> list[int]:
+    rng = random.Random(row_count)
+    timestamps = list(range(START_MS, START_MS + row_count * 10, 10))
+    if kind == "nearly":
+        for _ in range(SWAP_COUNT):
+            i = rng.randrange(row_count - 1)
+            timestamps[i], timestamps[i + 1] = timestamps[i + 1], timestamps[i]
+    elif kind == "runs":
+        size = row_count // RUN_COUNT
+        runs = [timestamps[i:i + size] for i in range(0, row_count, size)]
+        rng.shuffle(runs)
+        timestamps = [timestamp for run in runs for timestamp in run]
+    elif kind == "random":
+        rng.shuffle(timestamps)
+    return timestamps
+
+
+def best_time(sort_function, rows: list[list[bytes]], repetitions: int) -> tuple[float, list[list[bytes]]]:
+    best = float("inf")
+    for _ in range(repetitions):
+        rows_copy = list(rows)
+        t_start = perf_counter()
+        sort_function(rows_copy)
+        best = min(best, perf_counter() - t_start)
+    return best, rows_copy  # type: ignore - it will be bound
+
+
+def main(row_count: int, repetitions: int):
+    print(f"{row_count} rows, best of {repetitions}")
+    for kind in ("sorted", "nearly", "runs", "random"):
+        rows = [[b"%d" % t, b"unknown", b"0.1", b"0.2", b"9.8"] for t in synthetic_timestamps(kind, row_count)]
+        t_original, output_original = best_time(original_sort, rows, repetitions)
+        t_adaptive, output_adaptive = best_time(ensure_sorted_by_timestamp, rows, repetitions)
+        assert output_original == output_adaptive, "outputs differ"
+        print(f"{kind:>8}: original {t_original:.4f}s, adaptive {t_adaptive:.4f}s ({t_original / t_adaptive:.2f}x)")
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 360_000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 5,
+    )
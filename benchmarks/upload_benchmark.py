@@ -0,0 +1,136 @@
+"""
+Benchmark of the participant upload endpoint (mobile_endpoints.upload), for a burst of uploads from
+one participant's phone like the apps send after being offline: the synthetic files of an Android
+participant (see file_processing/synthetic_participant.py), encrypted the way the apps encrypt them,
+posted through Django's test client.  S3 is a folder on local disk (see file_processing/local_s3.py)
+and the database is a test database, created and destroyed like the test runner does.
+
+The burst is uploaded with the cache of participant private keys (PARTICIPANT_KEY_CACHE_SECONDS)
+disabled and then enabled, and the uploads per second and S3 operations per upload of each are
+printed.  Without the cache every upload downloads the participant's private key.
+    python -m benchmarks.upload_benchmark [minutes]
+"""
+
+import sys
+from os import urandom
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from unittest.mock import patch
+
+import database  # sets up django  # noqa: F401
+from Cryptodome.Cipher import AES
+from Cryptodome.PublicKey import RSA
+from django.db import connection
+from django.test import Client
+from django.test.utils import setup_test_environment
+
+from benchmarks.file_processing.local_s3 import LocalS3
+from benchmarks.file_processing.synthetic_participant import SyntheticUpload, synthetic_uploads
+from constants.user_constants import ANDROID_API
+from database.models import Participant, Study, Survey
+from libs.rsa import create_participant_key_pair, get_participant_public_key, ParticipantKeyCache
+from libs.utils.base64_utils import encode_base64
+from libs.utils.security_utils import device_hash
+
+
+ENCRYPTION_KEY = "benchmarkbenchmarkbenchmarkbench"
+START_MS = 1770357600000  # 2026-02-06T06:00:00 UTC
+FILE_MINUTES = 10
+PATIENT_ID = "benchupl"
+DEVICE_ID = "benchmark"
+PASSWORD = "benchmark"
+
+
+def encrypt_like_the_apps(data: bytes, public_key: RSA.RsaKey) -> bytes:
+    """ The first line is a random AES key, base64 encoded and then encrypted with the participant's
+    public key (textbook RSA), the other lines are the lines of the file, each encrypted with that
+    key with AES-CBC and its own iv.  See DeviceDataDecryptor. """
+    aes_key = urandom(16)
+    key_int = int.from_bytes(encode_base64(aes_key), "big")
+    encrypted_key = pow(key_int, public_key.e, public_key.n).to_bytes(public_key.size_in_bytes(), "big")
+    lines = [encode_base64(encrypted_key)]
+    for line in data.split(b"\n"):
+        iv = urandom(16)
+        padding = 16 - len(line) % 16  # PKCS5
+        ciphertext = AES.new(aes_key, AES.MODE_CBC, IV=iv).encrypt(line + bytes([padding]) * padding)
+        lines.append(encode_base64(iv) + b":" + encode_base64(ciphertext))
+    return b"\n".join(lines)
+
+
+def create_participant() -> tuple[Participant, Survey]:
+    study = Study.create_with_object_id(
+        name="upload benchmark", encryption_key=ENCRYPTION_KEY, timezone_name="UTC"
+    )
+    survey = Survey.create_with_object_id(study=study, survey_type=Survey.TRACKING_SURVEY)
+    participant = Participant(patient_id=PATIENT_ID, study=study, os_type=ANDROID_API, device_id=DEVICE_ID)
+    participant.set_password(PASSWORD)  # saves
+    create_participant_key_pair(PATIENT_ID, study.object_id)
+    return participant, survey
+
+
+def run_burst(
+    participant: Participant, uploads: list[SyntheticUpload], local_s3: LocalS3, cache_seconds: int
+) -> dict:
+    public_key = get_participant_public_key(PATIENT_ID, participant.study.object_id)
+    posts = [
+        {
+            "patient_id": PATIENT_ID,
+            "device_id": DEVICE_ID,
+            "password": device_hash(PASSWORD.encode()).decode(),
+            "file_name": f"{PATIENT_ID}_{relative_path.replace('/', '_')}",
+            "file": encrypt_like_the_apps(contents, public_key).decode(),
+        }
+        for relative_path, contents, _ in uploads
+    ]
+    
+    client = Client()
+    ParticipantKeyCache.clear()
+    local_s3.reset_counters()
+    with patch("libs.rsa.PARTICIPANT_KEY_CACHE_SECONDS", cache_seconds):
+        t_start = perf_counter()
+        for post in posts:
+            response = client.post("/upload", data=post)
+            if response.status_code != 200 or response.content != b"upload successful.":
+                raise Exception(
+                    f"upload of {post['file_name']} failed: {response.status_code} {response.content}"
+                )
+        elapsed = perf_counter() - t_start
+    
+    counters = local_s3.counters()
+    return {
+        "uploads": len(posts),
+        "uploads_per_second": round(len(posts) / elapsed, 1),
+        "gets_per_upload": round(counters["s3_gets"] / len(posts), 3),
+        "puts_per_upload": round(counters["s3_puts"] / len(posts), 3),
+        "lists_per_upload": round(counters["s3_lists"] / len(posts), 3),
+    }
+
+
+def main(minutes: int = 60):
+    setup_test_environment()  # allows the test client's host name
+    old_database_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        with TemporaryDirectory() as s3_folder, patch("libs.s3.conn", LocalS3(s3_folder)) as local_s3:
+            participant, survey = create_participant()
+            results = {}
+            # each burst uploads different files, the endpoint rejects files it already has
+            for burst, (name, cache_seconds) in enumerate((("no cache", 0), ("cache", 900))):
+                uploads = synthetic_uploads(
+                    ANDROID_API, START_MS + burst * minutes * 60_000, minutes, 1.0, FILE_MINUTES,
+                    survey.object_id, burst,
+                )
+                results[name] = run_burst(participant, uploads, local_s3, cache_seconds)
+    finally:
+        connection.creation.destroy_test_db(old_database_name, verbosity=0)
+    
+    print(f"{'':>8}  {'uploads':>7}  {'uploads/s':>9}  {'gets/upload':>11}  {'puts/upload':>11}  {'lists/upload':>12}")
+    for name, result in results.items():
+        print(
+            f"{name:>8}  {result['uploads']:>7}  {result['uploads_per_second']:>9.1f}  "
+            f"{result['gets_per_upload']:>11.3f}  {result['puts_per_upload']:>11.3f}  "
+            f"{result['lists_per_upload']:>12.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -81,6 +81,27 @@ DEVELOPER_TIMEZONE: str = getenv("DEVELOPER_TIMEZONE", "America/New_York")
 # Much of the work on compression benchmarking can be found in the compression_tests folder.
 DATA_COMPRESSION_LEVEL: int = int(getenv("DATA_COMPRESSION_LEVEL", "2"))
 
+# Every read and write of a file on S3 needs the encryption key (and folder) of the file's study.
+# Each server process caches these, so that a study's key is looked up in the database once, and
+# not once per file.  This is the number of seconds a cached key is used before it is looked up
+# again.  A process drops its cached values for a study when it saves that study, other processes
+# see the change when their cached values expire.  0 disables the cache.
+#   Expects an integer number.
+STUDY_KEY_CACHE_SECONDS: int = int(getenv("STUDY_KEY_CACHE_SECONDS", "3600"))
+
+# Every file a participant's device uploads is decrypted with the participant's private key, which
+# is stored (encrypted) on S3.  Each server process caches the private keys of participants that
+# upload, so that a burst of uploads downloads the key once.  This is the number of seconds a cached
+# key is used before it is downloaded again, 0 disables the cache.  A process drops a participant's
+# cached key when it creates a new key pair for the participant or deletes the participant's data.
+#   Expects an integer number.
+PARTICIPANT_KEY_CACHE_SECONDS: int = int(getenv("PARTICIPANT_KEY_CACHE_SECONDS", "900"))
+
+# The most private keys each server process caches (see PARTICIPANT_KEY_CACHE_SECONDS), the least
+# recently used keys are dropped when it is full.  A cached key uses a few kilobytes of memory.
+#   Expects an integer number.
+PARTICIPANT_KEY_CACHE_SIZE: int = int(getenv("PARTICIPANT_KEY_CACHE_SIZE", "2000"))
+
 
 #
 # File processing and Data Access API options
@@ -92,7 +113,85 @@ DATA_COMPRESSION_LEVEL: int = int(getenv("DATA_COMPRESSION_LEVEL", "2"))
 # therefore S3 costs), but will use more memory. Individual file sizes ranges from bytes to tens of
 # megabytes, so memory usage can be spikey and difficult to predict.
 #   Expects an integer number.
-FILE_PROCESS_PAGE_SIZE: int = getenv("FILE_PROCESS_PAGE_SIZE", 100)
+FILE_PROCESS_PAGE_SIZE: int = int(getenv("FILE_PROCESS_PAGE_SIZE", "100"))
+
+# This is the target size, in megabytes, of a page of files (see FILE_PROCESS_PAGE_SIZE), using the
+# (uncompressed) file sizes recorded when files are uploaded.  Pages are filled with files until the
+# next file would go over this size or the page has FILE_PROCESS_PAGE_SIZE files, so a page is
+# either many small files or a few large ones, and memory usage is much more consistent.  (A single
+# file larger than this is processed as a page of one file.)  Set to 0 to page by file count only.
+#   Expects an integer number.
+FILE_PROCESS_PAGE_MB: int = int(getenv("FILE_PROCESS_PAGE_MB", "256"))
+
+# This is a soft cap, in megabytes, on the memory used by data that has been read from a page of
+# uploaded files and sorted into hourly bins, but not yet merged and uploaded.  When the (estimated)
+# size goes over this value the largest bins are moved out to temporary files on local disk and
+# read back when they are merged.  This prevents participants with very large backlogs of data
+# from running a data processing server out of memory.  Set to 0 to disable.
+#   Expects an integer number.
+FILE_PROCESS_MEMORY_BUDGET_MB: int = int(getenv("FILE_PROCESS_MEMORY_BUDGET_MB", "1024"))
+
+# Setting this to a positive number turns on pipelined file processing on this data processing
+# server: pages of files are downloaded in the background while the current page is processed, and
+# merged chunks are uploaded in the background while the next page is processed.  The value is the
+# number of pages that may be downloaded ahead of processing, each page of files held in memory
+# costs roughly as much as a page of files being processed, so keep this small.  0 (the default)
+# processes each page serially, download then process then upload.
+#   Expects an integer number.
+FILE_PROCESS_PIPELINE_DEPTH: int = int(getenv("FILE_PROCESS_PIPELINE_DEPTH", "0"))
+
+# The number of threads used to checksum and compress merged chunks of data during file processing.
+# Checksumming and compression run outside of Python's global interpreter lock, so these threads let
+# a single data processing task use more than one cpu core.  0 (the default) does this work on the
+# main thread, one chunk at a time.
+#   Expects an integer number.
+FILE_PROCESS_COMPRESSION_WORKERS: int = int(getenv("FILE_PROCESS_COMPRESSION_WORKERS", "0"))
+
+# When FILE_PROCESS_COMPRESSION_WORKERS is in use, this is a cap, in megabytes, on the uncompressed
+# chunk data waiting to be checksummed and compressed.  Merging of further chunks pauses until the
+# waiting data is below this value.  (A single chunk larger than this value is still processed.)
+#   Expects an integer number.
+FILE_PROCESS_COMPRESSION_BUFFER_MB: int = int(getenv("FILE_PROCESS_COMPRESSION_BUFFER_MB", "256"))
+
+# Setting this to a positive number moves the splitting, fixing, and sorting into hourly bins of
+# uploaded files into a pool of this many worker processes, one data stream of a page of files per
+# worker at a time, so that a single data processing task can use more than one cpu core for this
+# work.  The number of processes is capped at the number of cpu cores.  Each data processing task
+# has its own pool, and every worker process holds the files it is working on in memory, so keep
+# (number of tasks per server) x (this value) near the number of cpu cores.  0 (the default) does
+# this work in the data processing task's own process.
+#   Expects an integer number.
+FILE_PROCESS_BINNING_WORKERS: int = int(getenv("FILE_PROCESS_BINNING_WORKERS", "0"))
+
+# Setting this to a positive number turns on a cache, on local disk, of recently written chunks of
+# processed data on this data processing server.  Participants upload data continuously, so the chunk
+# for the current hour is usually downloaded from S3 again by the next processing run; a cache hit
+# skips that download.  The value is the size of the cache in megabytes, the least recently used
+# chunks are removed when it is full.  The cache is checked against the database so it never returns
+# out-of-date data.  Note that cached data is compressed but NOT encrypted.  0 (the default) disables
+# the cache.
+#   Expects an integer number.
+FILE_PROCESS_CHUNK_CACHE_MB: int = int(getenv("FILE_PROCESS_CHUNK_CACHE_MB", "0"))
+
+# The folder used by FILE_PROCESS_CHUNK_CACHE_MB, it will be created (readable only by the user
+# running data processing) if it does not exist.  Defaults to a folder in the system temp folder.
+#   Expects a folder path.
+FILE_PROCESS_CHUNK_CACHE_DIRECTORY: str = getenv("FILE_PROCESS_CHUNK_CACHE_DIRECTORY", "")
+
+# Setting this to a positive number lets data processing add new data for a recent hour of data as
+# a small separate "segment" file, instead of downloading, merging, and re-uploading that hour's
+# whole file every time a participant uploads.  The value is the most segments an hour of data may
+# have, after that the whole file is rewritten.  Segments are merged back into their hour's file
+# by data processing once the hour is FILE_PROCESS_SEGMENT_COMPACTION_HOURS old.  Downloaded data is
+# always merged with its segments, this setting has no effect on the data researchers receive.
+# 0 (the default) never writes segments (existing segments are still merged and compacted).
+#   Expects an integer number.
+FILE_PROCESS_CHUNK_SEGMENTS: int = int(getenv("FILE_PROCESS_CHUNK_SEGMENTS", "0"))
+
+# The number of hours after the end of an hour of data before its segments are merged into it, see
+# FILE_PROCESS_CHUNK_SEGMENTS.  New data for older hours is merged directly into their files.
+#   Expects an integer number.
+FILE_PROCESS_SEGMENT_COMPACTION_HOURS: int = int(getenv("FILE_PROCESS_SEGMENT_COMPACTION_HOURS", "6"))
 
 #
 # Push Notification directives
@@ -12,6 +12,7 @@ CHUNK_FIELDS = [
     "study_id",
     "survey_id",
     "survey__object_id",
+    "segment_count",
 ]
 
 # minimal set of fields needed to generate file paths.
@@ -20,4 +21,5 @@ REDUCED_CHUNK_FIELDS = [
     "participant__patient_id",
     "time_bin",
     "data_type",
+    "segment_count",
 ]
@@ -116,10 +116,16 @@ MY_BEIWE_SERVER = "https://example.com"
     
     # WARNING: this endpoint can return a very large amount of data.
 
+# TARGET_ENDPOINT_URL = f"{MY_BEIWE_SERVER}/get-data-processing-summary/v1"
+    # This endpoint takes no parameters, and is only available to site admins.
+    # Returns a json dictionary of the totals of the data processing runs of the last hour (files,
+    # bytes, queries, and the seconds spent in each stage of processing), and the slowest runs
+    # with their participant's id.
+
 # TARGET_ENDPOINT_URL = f"{MY_BEIWE_SERVER}/get-participant-notification-history/v1"
     # Endpoint takes one required parameter, participant_id, which must match a participant id in a
     # study the user has access to.
-    
+
     # This endpoint takes exactly one optional parameter, `utc`.  If this parameter is present with
     # any value the timestamps will be returned in the UTC timezone, in the usual shorthand
     # indicator of a Z.  If this parameter is not present the timestamps will be returned in the
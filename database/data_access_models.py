@@ -4,8 +4,9 @@ from collections import Counter
 from datetime import datetime, UTC
 from typing import TYPE_CHECKING
 
-from django.db import models
+from django.db import models, transaction
 from django.db.models import QuerySet
+from django.utils import timezone
 
 from constants.common_constants import EARLIEST_POSSIBLE_DATA_DATETIME
 from constants.data_processing_constants import CHUNK_TIMESLICE_QUANTUM
@@ -23,6 +24,10 @@ class UnchunkableDataTypeError(Exception): pass
 class ChunkableDataTypeError(Exception): pass
 
 
+# rows per statement for the bulk ChunkRegistry writes, bulk_update builds a CASE clause per row.
+CHUNK_REGISTRY_BULK_BATCH_SIZE = 500
+
+
 #
 # BIG FAT WARNING: the ChunkRegistry gets Huge. If you are in the context of a webserver endpoint
 # and querying it for any other purpose than downloading files from s3 then you are doing it wrong,
@@ -58,10 +63,13 @@ class ChunkRegistry(TimestampedModel):
         'Survey', blank=True, null=True, on_delete=models.PROTECT, related_name='chunk_registries',
         db_index=True
     )
+    # New data for a recent chunk may be written as small "segment" files next to the chunk instead
+    # of rewriting the whole chunk, this many of them.  See libs/file_processing/chunk_segments.py.
+    segment_count = models.PositiveSmallIntegerField(default=0)
     
     def s3_retrieve(self) -> bytes:
-        from libs.s3 import s3_retrieve
-        return s3_retrieve(self.chunk_path, self.study.object_id, raw_path=True)
+        from libs.file_processing.chunk_segments import retrieve_chunk
+        return retrieve_chunk(self.chunk_path, self.study.object_id, self.segment_count)
     
     register_required = {
         "study_id": int,
@@ -74,9 +82,13 @@ class ChunkRegistry(TimestampedModel):
         "file_size": int,
     }
     
+    # the fields updated on an existing chunk when its data changes.
+    chunk_update_fields = ("chunk_hash", "file_size", "last_updated")
+    
     @classmethod
-    def register_chunked_data(cls, **kwargs):
+    def clean_register_kwargs(cls, kwargs: dict) -> dict:
         # validate required kwargs, extra kwargs not present, data type is chunkable
+        kwargs = dict(kwargs)  # don't modify the caller's dict
         if missing := [k for k in cls.register_required if k not in kwargs]:
             raise ValueError(f"Missing required parameters: {missing}")
         if unexpected:= [k for k in kwargs if k not in cls.register_required]:
@@ -91,8 +103,84 @@ class ChunkRegistry(TimestampedModel):
         
         if isinstance(kwargs["chunk_hash"], bytes):  # just fix type on chunk hash because
             kwargs["chunk_hash"] = kwargs["chunk_hash"].decode()
+        return kwargs
+    
+    @classmethod
+    def register_chunked_data(cls, **kwargs):
+        ChunkRegistry(is_chunkable=True, **cls.clean_register_kwargs(kwargs)).save()  # create with validation
+    
+    @classmethod
+    def bulk_register_chunked_data(
+        cls, new_chunks: list[dict], updated_chunks: dict[str, dict]
+    ) -> list[tuple[datetime, str, int]]:
+        """ Registers a page of processed chunks in one transaction, instead of a validated save()
+        per new chunk and an update query per existing chunk.
         
-        ChunkRegistry(is_chunkable=True, **kwargs).save()  # create with validation
+        new_chunks are kwargs for register_chunked_data.  If a chunk was registered since the caller
+        checked (e.g. a task that was retried after registering part of its page) it is updated
+        instead of raising an IntegrityError, and its change in file size is found by a query in the
+        transaction.  (A chunk registered by a concurrent transaction after that query is counted at
+        its full size, the stats can drift in that case.)
+        
+        updated_chunks maps chunk paths of existing chunks to their new chunk_hash, file_size and
+        segment_count, chunks that no longer exist are ignored, as with update().  When the
+        segment_count is not 0 a segment was added to the chunk, the segment_count and file_size
+        are updated and the chunk_hash is not.
+        
+        Foreign keys and chunk_path uniqueness are enforced by the database rather than by a query per
+        row in full_clean(), other fields are validated as in save().
+        
+        Returns the time bin, data type and change in file size of each chunk, for the data quantity
+        stats. """
+        now = timezone.now()
+        file_size_changes: list[tuple[datetime, str, int]] = []
+        
+        to_create = []
+        for kwargs in new_chunks:
+            chunk = ChunkRegistry(is_chunkable=True, **cls.clean_register_kwargs(kwargs))
+            chunk.clean_fields(exclude=["study", "participant", "survey"])
+            to_create.append(chunk)
+        
+        with transaction.atomic():
+            if to_create:
+                existing_file_sizes = dict(
+                    cls.objects.filter(chunk_path__in=[chunk.chunk_path for chunk in to_create])
+                    .values_list("chunk_path", "file_size")
+                )
+                for chunk in to_create:
+                    file_size_change = (chunk.file_size or 0) - (existing_file_sizes.get(chunk.chunk_path) or 0)
+                    file_size_changes.append((chunk.time_bin, chunk.data_type, file_size_change))
+                cls.objects.bulk_create(
+                    to_create,
+                    batch_size=CHUNK_REGISTRY_BULK_BATCH_SIZE,
+                    update_conflicts=True,
+                    unique_fields=["chunk_path"],
+                    update_fields=cls.chunk_update_fields,
+                )
+            
+            if updated_chunks:
+                to_update = []
+                query = cls.objects.filter(chunk_path__in=list(updated_chunks)) \
+                    .only("pk", "chunk_path", "time_bin", "data_type", "file_size", "segment_count")
+                for chunk in query:
+                    chunk_kwargs = updated_chunks[chunk.chunk_path]
+                    file_size_changes.append(
+                        (chunk.time_bin, chunk.data_type, chunk_kwargs["file_size"] - (chunk.file_size or 0))
+                    )
+                    if "segment_count" in chunk_kwargs:
+                        chunk.segment_count = chunk_kwargs["segment_count"]
+                    if not chunk_kwargs.get("segment_count"):
+                        chunk.chunk_hash = chunk_kwargs["chunk_hash"]
+                    chunk.file_size = chunk_kwargs["file_size"]
+                    chunk.last_updated = now  # auto_now is not applied by bulk_update
+                    to_update.append(chunk)
+                cls.objects.bulk_update(
+                    to_update,
+                    (*cls.chunk_update_fields, "segment_count"),
+                    batch_size=CHUNK_REGISTRY_BULK_BATCH_SIZE,
+                )
+        
+        return file_size_changes
     
     @classmethod
     def register_unchunked_data(cls, data_type, unix_timestamp, chunk_path, study_id, participant_id,
@@ -114,15 +202,82 @@ class ChunkRegistry(TimestampedModel):
             file_size=len(file_contents),
         )
     
+    @classmethod
+    def build_unchunked_registration(
+        cls, data_type: str, unix_timestamp: int, chunk_path: str, study_id: int, participant_id: int,
+        file_size: int,
+    ) -> ChunkRegistry:
+        """ The unsaved ChunkRegistry of register_unchunked_data, validated as in save() other than
+        foreign keys, for bulk_register_unchunked_data. """
+        if data_type in CHUNKABLE_FILES:
+            raise ChunkableDataTypeError
+        chunk = cls(
+            is_chunkable=False,
+            chunk_path=chunk_path,
+            chunk_hash='',
+            data_type=data_type,
+            time_bin=datetime.fromtimestamp(unix_timestamp, UTC),
+            study_id=study_id,
+            participant_id=participant_id,
+            file_size=file_size,
+        )
+        chunk.clean_fields(exclude=["study", "participant", "survey"])
+        return chunk
+    
+    @classmethod
+    def bulk_register_unchunked_data(cls, chunks: list[ChunkRegistry]) -> list[tuple[datetime, str, int]]:
+        """ register_unchunked_data and update_registered_unchunked_data for a page of files, the
+        chunks are from build_unchunked_registration.  Existing chunk paths are found in one query
+        and updated in bulk, the new paths are created in bulk.  If a path was registered since the
+        query it is updated instead of raising an IntegrityError, its full file size is counted and
+        the stats can drift in that case.  When a path is in the page more than once the last file
+        wins.
+        
+        Returns the time bin, data type and change in file size of each file, for the data quantity
+        stats. """
+        registrations = {chunk.chunk_path: chunk for chunk in chunks}
+        
+        now = timezone.now()
+        file_size_changes: list[tuple[datetime, str, int]] = []
+        with transaction.atomic():
+            to_update = []
+            query = cls.objects.filter(chunk_path__in=list(registrations)).only("pk", "chunk_path", "file_size")
+            for chunk in query:
+                registration = registrations.pop(chunk.chunk_path)
+                file_size_changes.append(
+                    (registration.time_bin, registration.data_type, registration.file_size - (chunk.file_size or 0))
+                )
+                chunk.file_size = registration.file_size
+                chunk.last_updated = now  # auto_now is not applied by bulk_update
+                to_update.append(chunk)
+            cls.objects.bulk_update(
+                to_update, ("file_size", "last_updated"), batch_size=CHUNK_REGISTRY_BULK_BATCH_SIZE
+            )
+            
+            to_create = list(registrations.values())
+            for chunk in to_create:
+                file_size_changes.append((chunk.time_bin, chunk.data_type, chunk.file_size))
+            cls.objects.bulk_create(
+                to_create,
+                batch_size=CHUNK_REGISTRY_BULK_BATCH_SIZE,
+                update_conflicts=True,
+                unique_fields=["chunk_path"],
+                update_fields=["file_size", "last_updated"],
+            )
+        
+        return file_size_changes
+    
     @classmethod
     def update_registered_unchunked_data(cls, data_type, chunk_path, file_contents):
         """ Updates the data in case a user uploads an unchunkable file more than once,
-        and updates the file size just in case it changed. """
+        and updates the file size just in case it changed.  Returns the change in file size. """
         if data_type in CHUNKABLE_FILES:
             raise ChunkableDataTypeError
         chunk = cls.objects.get(chunk_path=chunk_path)
+        file_size_change = len(file_contents) - (chunk.file_size or 0)
         chunk.file_size = len(file_contents)
         chunk.save()
+        return file_size_change
     
     @classmethod
     def get_chunks_time_range(
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.11 on 2026-10-17 08:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0148_delete_iosdecryptionkey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkregistry',
+            name='segment_count',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
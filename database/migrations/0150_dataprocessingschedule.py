@@ -0,0 +1,30 @@
+# Generated by Django 5.2.11 on 2026-10-17 08:36
+
+import database.common_models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0149_chunkregistry_segment_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataProcessingSchedule',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('participant_count', models.PositiveIntegerField()),
+                ('task_count', models.PositiveIntegerField()),
+                ('already_running_count', models.PositiveIntegerField()),
+                ('pending_bytes', models.PositiveBigIntegerField()),
+                ('tasks', database.common_models.JSONTextField()),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.11 on 2026-10-17 08:57
+
+import database.common_models
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('database', '0150_dataprocessingschedule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataProcessingRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('seconds', models.FloatField()),
+                ('errored', models.BooleanField()),
+                ('files', models.PositiveIntegerField()),
+                ('failed_files', models.PositiveIntegerField()),
+                ('file_bytes', models.PositiveBigIntegerField()),
+                ('bytes_in', models.PositiveBigIntegerField()),
+                ('bytes_out', models.PositiveBigIntegerField()),
+                ('chunks', models.PositiveIntegerField()),
+                ('queries', models.PositiveIntegerField()),
+                ('peak_memory_mb', models.FloatField()),
+                ('stages', database.common_models.JSONTextField()),
+                ('participant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='data_processing_runs', to='database.participant')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created_on'], name='dpr_created_on_idx')],
+            },
+        ),
+    ]
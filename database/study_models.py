@@ -73,7 +73,8 @@ class Study(TimestampedModel, ObjectIDModel):
     files_to_process: Manager[FileToProcess]
     
     def save(self, *args, **kwargs):
-        """ Ensure there is a study device settings attached to this study. """
+        """ Ensure there is a study device settings attached to this study, and drop this process's
+        cached key and object id of this study. """
         # First we just save. This code has vacillated between throwing a validation error and not
         # during study creation.  Our current fix is to save, then test whether a device settings
         # object exists.  If not, create it.
@@ -87,6 +88,10 @@ class Study(TimestampedModel, ObjectIDModel):
             settings.save()
             # update the study object to have a device settings object (possibly unnecessary?).
             super().save(*args, **kwargs)
+        
+        # S3 operations cache the encryption key and object id of studies
+        from libs.s3 import StudyKeyCache
+        StudyKeyCache.invalidate(self.pk)
     
     @classmethod
     def create_with_object_id(cls, **kwargs) -> Study:
@@ -6,7 +6,7 @@ from typing import Self
 
 from django.db import models
 
-from database.common_models import TimestampedModel
+from database.common_models import JSONTextField, TimestampedModel
 from database.user_models_researcher import Researcher
 from libs.utils.timeout_cache import timeout_cache
 
@@ -98,3 +98,41 @@ class DataProcessingStatus(SingletonModel):
     """ Very simple model for tracking the last background processing run. (on, not works.) """
     
     last_run = models.DateTimeField(null=True, blank=True)
+
+
+class DataProcessingSchedule(TimestampedModel):
+    """ A record of the data processing tasks queued by one run of create_file_processing_tasks, for
+    inspecting how participants were prioritized.  tasks is a JSON list with an entry for each task,
+    in queue order, see libs/file_processing/processing_scheduler.py.  Old records are deleted. """
+    
+    participant_count = models.PositiveIntegerField()
+    task_count = models.PositiveIntegerField()
+    already_running_count = models.PositiveIntegerField()
+    pending_bytes = models.PositiveBigIntegerField()
+    tasks = JSONTextField()
+
+
+class DataProcessingRun(TimestampedModel):
+    """ Telemetry of one participant's data processing run, see FileProcessingTracker, for finding
+    slow participants and the stages they are slow in.  bytes_in and bytes_out are the bytes
+    downloaded from and uploaded to S3, peak_memory_mb is the high water mark of the process during
+    the run (on linux, elsewhere since the process started, see reset_peak_memory).  stages is a JSON object of the seconds spent in each stage, see
+    libs/utils/telemetry.py.  Old records are deleted. """
+    
+    class Meta:  # type: ignore
+        indexes = [models.Index(fields=["created_on"], name="dpr_created_on_idx")]
+    
+    participant = models.ForeignKey(
+        "Participant", on_delete=models.CASCADE, related_name="data_processing_runs"
+    )
+    seconds = models.FloatField()
+    errored = models.BooleanField()
+    files = models.PositiveIntegerField()
+    failed_files = models.PositiveIntegerField()
+    file_bytes = models.PositiveBigIntegerField()  # uncompressed size of the files processed
+    bytes_in = models.PositiveBigIntegerField()
+    bytes_out = models.PositiveBigIntegerField()
+    chunks = models.PositiveIntegerField()  # uploaded
+    queries = models.PositiveIntegerField()
+    peak_memory_mb = models.FloatField()
+    stages = JSONTextField()
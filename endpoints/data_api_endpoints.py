@@ -26,14 +26,15 @@ from endpoints.raw_data_api_endpoints import combined_chunk_query
 from libs.efficient_paginator import EfficientQueryPaginator
 from libs.endpoint_helpers.copy_study_helpers import study_settings_fileresponse
 from libs.endpoint_helpers.data_api_helpers import (check_request_for_omit_keys_param,
-    DeviceStatusHistoryPaginator, get_validate_participant_from_request,
-    participant_archived_event_dict)
+    data_processing_runs_summary, DeviceStatusHistoryPaginator,
+    get_validate_participant_from_request, participant_archived_event_dict)
 from libs.endpoint_helpers.participant_table_helpers import (common_data_extraction_for_apis,
     get_table_columns)
 from libs.endpoint_helpers.study_summaries_helpers import get_participant_data_upload_summary
 from libs.endpoint_helpers.summary_statistic_helpers import summary_statistics_request_handler
 from libs.intervention_utils import intervention_survey_data, survey_history_export
 from libs.streaming_zip import determine_base_file_name
+from middleware.abort_middleware import abort
 
 
 #
@@ -47,6 +48,19 @@ def background_processing_status(request: HttpRequest):
     return HttpResponse("", status=status)
 
 
+@require_POST
+@api_credential_check
+def get_data_processing_summary(request: ApiResearcherRequest):
+    """ Totals of the data processing runs of the last hour, and the slowest runs, site admins only. """
+    if not request.api_researcher.site_admin:
+        return abort(403)
+    return HttpResponse(
+        orjson.dumps(data_processing_runs_summary(timezone.now() - timedelta(hours=1))),
+        status=200,
+        content_type="application/json",
+    )
+
+
 ## Study Data API Endpoints
 
 
@@ -442,7 +456,8 @@ def get_participant_file_hashes(request: ApiStudyResearcherRequest):
     ret = dict[str, str]()
     for chunk in chunks:
         chunk["time_bin"] = chunk["time_bin"].isoformat()
-        ret[determine_base_file_name(chunk)] = chunk["sha1"]
+        # the sha1 of a chunk with segments does not include the segments, no hash means download it.
+        ret[determine_base_file_name(chunk)] = None if chunk["segment_count"] else chunk["sha1"]
     
     return HttpResponse(orjson.dumps(ret), status=200, content_type="application/json")
 
@@ -275,6 +275,11 @@ def filter_chunks_by_registry(
         hash_likely_md5 = registry_dict.get(path)
         hash_likely_sha1 = registry_dict.get(path.replace("CHUNKED_DATA/", "", 1))
         
+        # the hashes of a chunk with segments do not include the segments, it may have changed.
+        if chunkdata["segment_count"]:
+            yield chunkdata
+            continue
+        
         if hash_likely_md5 and (hash_likely_md5 == md5_hash or hash_likely_md5 or sha1_val):
             continue
         if hash_likely_sha1 and (hash_likely_sha1 == sha1_val or hash_likely_sha1 == md5_hash):
@@ -1,26 +1,202 @@
+from __future__ import annotations
+
 from os import urandom
 
 from Cryptodome.Cipher import AES
 
 
-# todo: use the buffer interface to make encryption/decryption faster/not use 2x memory (if possible)
+"""
+Server-side encryption of files on S3, with the encryption key of their study.
 
+The original (legacy) format is a 16 byte IV followed by AES-CFB with an 8 bit segment size, which
+runs the block cipher once per byte of data (~20MB/s).  New files are written in a versioned
+envelope: SERVER_ENCRYPTION_MAGIC, a version byte, and then the format of that version:
+    version 1: AES-GCM, a 12 byte nonce, the ciphertext, and the 16 byte tag.  (~10x faster than
+        CFB-8, and authenticated, corrupted data or the wrong key raise a ValueError.)
+decrypt_server reads every format.  Legacy files have no header, they start with their random IV,
+so one could start with the magic bytes, the odds of that are 1 in 2^64 for each file.
 
-def encrypt_for_server(data: bytes, encryption_key: bytes) -> bytes:
-    """ Encrypts config using the ENCRYPTION_KEY, prepends the generated initialization vector.
-    Use this function on an entire file (as a bytes). """
+Legacy files can be rewritten in the current format with scripts/script_that_reencrypts_s3_data.py.
+"""
+
+SERVER_ENCRYPTION_MAGIC = b"\x00BEIWE\xe5\x5a"
+SERVER_ENCRYPTION_GCM = 1
+SERVER_ENCRYPTION_VERSION = SERVER_ENCRYPTION_GCM  # the version of new files
+
+GCM_HEADER = SERVER_ENCRYPTION_MAGIC + bytes([SERVER_ENCRYPTION_GCM])
+GCM_NONCE_LENGTH = 12
+GCM_TAG_LENGTH = 16
+GCM_OVERHEAD = len(GCM_HEADER) + GCM_NONCE_LENGTH + GCM_TAG_LENGTH
+
+
+def validate_encryption_key(encryption_key: bytes):
     if not isinstance(encryption_key, bytes):
         raise Exception(f"received non-bytes object {type(encryption_key)}")
     if len(encryption_key) != 32:
         raise Exception(f"received encryption key with bad length: {len(encryption_key)}")
+
+
+def encrypt_for_server(data: bytes, encryption_key: bytes) -> bytes:
+    """ Encrypts config using the ENCRYPTION_KEY, in the current version of the server encryption
+    format.  Use this function on an entire file (as a bytes). """
+    validate_encryption_key(encryption_key)
+    nonce = urandom(GCM_NONCE_LENGTH)
+    cipher = AES.new(encryption_key, AES.MODE_GCM, nonce=nonce, mac_len=GCM_TAG_LENGTH)
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    return b"".join((GCM_HEADER, nonce, ciphertext, tag))
+
+
+def encrypt_for_server_into(
+    data: bytes | bytearray | memoryview, encryption_key: bytes, output: bytearray | memoryview
+) -> int:
+    """ Encrypts like encrypt_for_server, writing into output, a writable buffer of at least
+    encrypted_size(len(data)) bytes, instead of allocating the result.  Returns the number of bytes
+    written. """
+    validate_encryption_key(encryption_key)
+    view = memoryview(output).cast("B")
+    size = encrypted_size(memoryview(data).nbytes)
+    if len(view) < size:
+        raise ValueError(f"output buffer of {len(view)} bytes is too small, {size} bytes are required")
+    
+    nonce = urandom(GCM_NONCE_LENGTH)
+    nonce_start = len(GCM_HEADER)
+    ciphertext_start = nonce_start + GCM_NONCE_LENGTH
+    view[:nonce_start] = GCM_HEADER
+    view[nonce_start:ciphertext_start] = nonce
+    cipher = AES.new(encryption_key, AES.MODE_GCM, nonce=nonce, mac_len=GCM_TAG_LENGTH)
+    cipher.encrypt(data, output=view[ciphertext_start:size - GCM_TAG_LENGTH])
+    view[size - GCM_TAG_LENGTH:size] = cipher.digest()
+    return size
+
+
+def encrypted_size(size: int) -> int:
+    """ The size of data of this size after encrypt_for_server. """
+    return size + GCM_OVERHEAD
+
+
+def legacy_encrypt_for_server(data: bytes, encryption_key: bytes) -> bytes:
+    """ Encrypts in the legacy AES-CFB-8 format, prepends the generated initialization vector.  Only
+    for testing and benchmarks, new files must use encrypt_for_server. """
+    validate_encryption_key(encryption_key)
     iv: bytes = urandom(16)  # bytes
     return iv + AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=iv).encrypt(data)
 
 
+def is_legacy_server_encryption(data: bytes | bytearray | memoryview) -> bool:
+    return memoryview(data)[:len(SERVER_ENCRYPTION_MAGIC)] != SERVER_ENCRYPTION_MAGIC
+
+
 def decrypt_server(data: bytes, encryption_key: bytes) -> bytes:
-    """ Decrypts config encrypted by the encrypt_for_server function. """
+    """ Decrypts config encrypted by the encrypt_for_server function, in any version of the format. """
+    return _decrypt_server(data, encryption_key, None)
+
+
+def decrypt_server_into(
+    data: bytes | bytearray | memoryview, encryption_key: bytes, output: bytearray | memoryview
+) -> int:
+    """ Decrypts like decrypt_server, writing into output, a writable buffer of at least
+    decrypted_size(data) bytes, instead of allocating the result.  Returns the number of bytes
+    written. """
+    size = decrypted_size(data)
+    view = memoryview(output).cast("B")
+    if len(view) < size:
+        raise ValueError(f"output buffer of {len(view)} bytes is too small, {size} bytes are required")
+    _decrypt_server(data, encryption_key, view[:size])
+    return size
+
+
+def decrypted_size(data: bytes | bytearray | memoryview) -> int:
+    """ The size of the data that decrypt_server returns for this encrypted data. """
+    size = memoryview(data).nbytes
+    if is_legacy_server_encryption(data):
+        return max(size - 16, 0)
+    return max(size - GCM_OVERHEAD, 0)
+
+
+def _decrypt_server(
+    data: bytes | bytearray | memoryview, encryption_key: bytes, output: memoryview | None
+) -> bytes | None:
+    # with an output buffer the ciphers write into it and return None
     if not isinstance(encryption_key, bytes):
         raise Exception(f"received non-bytes object {type(encryption_key)}")
-    iv = data[:16]
-    data = data[16:]  # gr arg, memcopy operation...
-    return AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=iv).decrypt(data)
+    
+    view = memoryview(data).cast("B")  # slices of a memoryview don't copy the data
+    if is_legacy_server_encryption(view):
+        cipher = AES.new(encryption_key, AES.MODE_CFB, segment_size=8, IV=view[:16])
+        return cipher.decrypt(view[16:], output=output)
+    
+    version = view[len(SERVER_ENCRYPTION_MAGIC)]
+    if version == SERVER_ENCRYPTION_GCM:
+        if len(view) < GCM_OVERHEAD:
+            raise ValueError(f"server encrypted data is too short: {len(view)} bytes")
+        nonce_start = len(GCM_HEADER)
+        nonce = view[nonce_start:nonce_start + GCM_NONCE_LENGTH]
+        cipher = AES.new(encryption_key, AES.MODE_GCM, nonce=nonce, mac_len=GCM_TAG_LENGTH)
+        return cipher.decrypt_and_verify(
+            view[nonce_start + GCM_NONCE_LENGTH:-GCM_TAG_LENGTH], view[-GCM_TAG_LENGTH:], output=output
+        )
+    
+    raise ValueError(f"unknown server encryption version: {version}")
+
+
+class ServerDecryptor:
+    """ Decrypts server encrypted data (any version of the format) that arrives in pieces, e.g. an S3
+    download read in blocks.  update returns the plaintext of each piece as soon as it can, finalize
+    returns the rest and, for authenticated versions, verifies the data and raises a ValueError if it
+    is corrupted or the key is wrong.  (So plaintext is returned before it is verified, consumers
+    must not act on it before finalize succeeds.) """
+    
+    def __init__(self, encryption_key: bytes):
+        if not isinstance(encryption_key, bytes):
+            raise Exception(f"received non-bytes object {type(encryption_key)}")
+        self.encryption_key = encryption_key
+        self.pending = bytearray()  # received, not yet decrypted
+        self.cipher = None
+        self.held_back = 0  # the tag at the end of the data is not ciphertext
+    
+    def update(self, data: bytes | bytearray | memoryview) -> bytes:
+        self.pending += data
+        if self.cipher is None:
+            # enough for the header and nonce of every version, and the iv of legacy files.
+            if len(self.pending) < len(GCM_HEADER) + GCM_NONCE_LENGTH:
+                return b""
+            self._start()
+        
+        decryptable = len(self.pending) - self.held_back
+        if decryptable <= 0:
+            return b""
+        piece = bytes(self.pending[:decryptable])
+        del self.pending[:decryptable]
+        return self.cipher.decrypt(piece)
+    
+    def finalize(self) -> bytes:
+        if self.cipher is None:
+            self._start()
+        if len(self.pending) < self.held_back:
+            raise ValueError("server encrypted data is too short")
+        decryptable = len(self.pending) - self.held_back
+        plaintext = self.cipher.decrypt(bytes(self.pending[:decryptable]))
+        if self.held_back:
+            self.cipher.verify(bytes(self.pending[decryptable:]))
+        self.pending.clear()
+        return plaintext
+    
+    def _start(self):
+        # consumes the header from pending, sets up the cipher of the version
+        if is_legacy_server_encryption(self.pending):
+            iv = bytes(self.pending[:16])
+            del self.pending[:16]
+            self.cipher = AES.new(self.encryption_key, AES.MODE_CFB, segment_size=8, IV=iv)
+            return
+        
+        magic_length = len(SERVER_ENCRYPTION_MAGIC)
+        version = self.pending[magic_length] if len(self.pending) > magic_length else None
+        if version != SERVER_ENCRYPTION_GCM:
+            raise ValueError(f"unknown server encryption version: {version}")
+        if len(self.pending) < len(GCM_HEADER) + GCM_NONCE_LENGTH:
+            raise ValueError("server encrypted data is too short")
+        nonce_start = len(GCM_HEADER)
+        nonce = bytes(self.pending[nonce_start:nonce_start + GCM_NONCE_LENGTH])
+        del self.pending[:nonce_start + GCM_NONCE_LENGTH]
+        self.cipher = AES.new(self.encryption_key, AES.MODE_GCM, nonce=nonce, mac_len=GCM_TAG_LENGTH)
+        self.held_back = GCM_TAG_LENGTH
@@ -66,8 +66,8 @@ class DebugCeleryApp(Task):
         if not RUNNING_TESTS:
             print(f"apply_async running {self.an_function.__name__}, args:{args}, kwargs:{kwargs}")
         if "args" not in kwargs:
-            return self.an_function()
-        return self.an_function(*kwargs["args"])
+            return self.an_function(**kwargs.get("kwargs", {}))
+        return self.an_function(*kwargs["args"], **kwargs.get("kwargs", {}))
 
 
 TaskLike = Task|DebugCeleryApp
@@ -245,10 +245,15 @@ def _get_job_ids(celery_query_dict, celery_app_suffix):
         #  ... but only on one of 3 newly updated servers. ...  Buh?
         args = job_arg if isinstance(job_arg, list) else json.loads(job_arg)
         # safety/sanity check, assert that there is only 1 integer id in a list and that it is a list.
+        # (batched data processing tasks have 1 list of integer ids.)
         assert isinstance(args, list)
         assert len(args) == 1
-        assert isinstance(args[0], int)
-        all_args.append(args[0])
+        if isinstance(args[0], list):
+            assert all(isinstance(arg, int) for arg in args[0])
+            all_args.extend(args[0])
+        else:
+            assert isinstance(args[0], int)
+            all_args.append(args[0])
     
     return all_args
 
@@ -5,7 +5,7 @@ import orjson
 
 from authentication.data_access_authentication import ApiStudyResearcherRequest
 from constants.message_strings import MESSAGE_SEND_SUCCESS
-from database.models import Participant
+from database.models import DataProcessingRun, Participant
 from database.user_models_participant import Participant, SurveyNotificationReport
 from database.user_models_researcher import StudyRelation
 from libs.efficient_paginator import EfficientQueryPaginator
@@ -102,3 +102,34 @@ def participant_archived_event_dict(p: Participant, tz: tzinfo) -> dict:
             }
         )
     return dict(jsonable_data)
+
+
+# counters of DataProcessingRuns that are summed in data_processing_runs_summary
+RUN_TOTAL_FIELDS = (
+    "files", "failed_files", "file_bytes", "bytes_in", "bytes_out", "chunks", "queries"
+)
+SLOWEST_RUNS_COUNT = 10
+
+
+def data_processing_runs_summary(since: datetime) -> dict:
+    """ Totals of the data processing runs since a time, including the seconds spent in each stage,
+    and the slowest runs. """
+    runs = list(
+        DataProcessingRun.objects.filter(created_on__gte=since).order_by("-seconds").values(
+            "participant__patient_id", "seconds", "errored", "peak_memory_mb", "stages", *RUN_TOTAL_FIELDS
+        )
+    )
+    stage_totals: defaultdict[str, float] = defaultdict(float)
+    for run in runs:
+        run["stages"] = orjson.loads(run["stages"])
+        for stage_name, seconds in run["stages"].items():
+            stage_totals[stage_name] += seconds
+    
+    return {
+        "runs": len(runs),
+        "errored_runs": sum(run["errored"] for run in runs),
+        "seconds": round(sum(run["seconds"] for run in runs), 3),
+        **{field: sum(run[field] for run in runs) for field in RUN_TOTAL_FIELDS},
+        "stages": {stage_name: round(seconds, 3) for stage_name, seconds in sorted(stage_totals.items())},
+        "slowest_runs": runs[:SLOWEST_RUNS_COUNT],
+    }
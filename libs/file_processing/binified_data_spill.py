@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+from tempfile import TemporaryFile
+from typing import BinaryIO
+
+
+# Rough per-row memory overhead of a list[bytes] row: the list object, its pointer array, and the
+# header of each bytes object.  Only used to estimate memory use, it does not need to be exact.
+LIST_OVERHEAD = 56
+BYTES_OVERHEAD = 33 + 8  # bytes object header plus the pointer to it in the list
+
+
+def estimate_rows_size(rows: list[list[bytes]]) -> int:
+    """ Estimates the memory footprint of a list of rows from the first row.  Rows from a single
+    file are homogeneous enough that this is a reasonable estimate, and it is O(1). """
+    if not rows:
+        return 0
+    first_row = rows[0]
+    per_row = LIST_OVERHEAD + sum(len(field) + BYTES_OVERHEAD for field in first_row)
+    return per_row * len(rows)
+
+
+class SpillableRows(list):
+    """ A list of rows (lists of bytes) that can move its contents out to an anonymous temporary
+    file, and later load them back.
+    
+    Rows are written in a compact form, one line per row with fields joined by commas.  Rows are
+    lines of csvs split on some of their commas, they are loaded back split on the first comma only,
+    into the timestamp and the rest of the line, as binning_pool.unpack_rows does.  Rows joined with
+    commas are unchanged either way.  Rows appended after a spill stay in memory, load_spilled
+    places the spilled rows back in front of them so that the original row order is preserved. """
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.spill_file: BinaryIO | None = None
+        self.spilled_row_count = 0
+    
+    @property
+    def has_spilled(self) -> bool:
+        return self.spill_file is not None
+    
+    def spill(self) -> int:
+        """ Writes the in-memory rows to the spill file and clears them, returns bytes written. """
+        if not self:
+            return 0
+        if self.spill_file is None:
+            self.spill_file = TemporaryFile(prefix="beiwe_binified_")
+        
+        data = b"\n".join(b",".join(row) for row in self) + b"\n"
+        self.spill_file.write(data)
+        self.spilled_row_count += len(self)
+        self.clear()
+        return len(data)
+    
+    def load_spilled(self):
+        """ Reads spilled rows back in (in front of any in-memory rows) and closes the spill file. """
+        if self.spill_file is None:
+            return
+        
+        self.spill_file.seek(0)
+        data = self.spill_file.read()
+        self.spill_file.close()
+        self.spill_file = None
+        self.spilled_row_count = 0
+        
+        self[:0] = [line.split(b",", 1) for line in data.splitlines()]
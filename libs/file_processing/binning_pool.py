@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from database.data_access_models import FileToProcess
+from libs.file_processing.file_for_processing import FileForProcessing
+from libs.file_processing.utility_functions_simple import binify_rows
+
+
+"""
+Splitting, fixing, and binning the rows of uploaded files is pure Python, so it runs on one cpu core
+no matter how many threads download the files.  When FILE_PROCESS_BINNING_WORKERS is enabled the
+FileProcessingTracker sends the contents of a page's chunkable files to a pool of worker processes,
+one task per data stream, and merges the results exactly like it merges files binned in-process.
+
+Workers never touch the database or S3, they get file contents and return binned rows.  Rows are
+returned packed, each bin as one bytes object of comma-joined rows separated by newlines (the form
+SpillableRows uses), which pickles far faster than lists of lists of bytes objects.  The parent
+unpacks them splitting only the timestamp column, rows joined with commas are unchanged either way.
+"""
+
+FileToProcessPK = int
+# primary key, s3 file path, os type, file contents
+StreamFile = tuple[FileToProcessPK, str, str, bytes]
+# header and packed rows by time bin, None when the file has no data
+BinnedFile = tuple[bytes, dict[int, bytes]] | None
+
+
+def pack_rows(rows: list[list[bytes]]) -> bytes:
+    return b"\n".join([b",".join(row) for row in rows])
+
+
+def unpack_rows(packed_rows: bytes) -> list[list[bytes]]:
+    return [line.split(b",", 1) for line in packed_rows.split(b"\n")]
+
+
+def bin_file_contents(s3_file_path: str, os_type: str, file_contents: bytes) -> BinnedFile:
+    """ The binning of FileProcessingTracker.process_csv_data, on file contents. """
+    file_to_process = FileToProcess(s3_file_path=s3_file_path, os_type=os_type)  # never saved
+    file_for_processing = FileForProcessing(file_to_process, None, file_contents=file_contents)
+    del file_contents
+    file_for_processing.prepare_data()
+    rows, header = file_for_processing.file_lines, file_for_processing.header
+    file_for_processing.clear_file_lines()
+    
+    if not rows or not header:
+        return None
+    binned_rows = binify_rows(rows)
+    del rows
+    if not binned_rows:
+        return None
+    return header, {time_bin: pack_rows(bin_rows) for time_bin, bin_rows in binned_rows.items()}
+
+
+def bin_stream_files(stream_files: list[StreamFile]) -> list[tuple[FileToProcessPK, BinnedFile | Exception]]:
+    """ Runs in a worker process.  Bins the files of one data stream, an error binning a file is
+    returned in place of its result so that it only fails that file. """
+    results: list[tuple[FileToProcessPK, BinnedFile | Exception]] = []
+    while stream_files:
+        pk, s3_file_path, os_type, file_contents = stream_files.pop()
+        try:
+            results.append((pk, bin_file_contents(s3_file_path, os_type, file_contents)))
+        except Exception as e:
+            results.append((pk, e))
+        del file_contents
+    return results
+
+
+_binning_pool: ProcessPoolExecutor | None = None
+
+
+def get_binning_pool(workers: int) -> ProcessPoolExecutor:
+    """ The pool of binning processes of this data processing task, it is created on first use and
+    reused.  The number of processes is capped at the number of cpu cores. """
+    global _binning_pool
+    if _binning_pool is None:
+        # spawned, not forked, a fork of a process with running threads and database connections is
+        # not safe.  Worker processes start once, so the import time of a spawned process is paid once.
+        _binning_pool = ProcessPoolExecutor(
+            min(workers, os.cpu_count() or 1), mp_context=get_context("spawn")
+        )
+    return _binning_pool
+
+
+def shutdown_binning_pool():
+    """ Discards the pool, e.g. after a worker process has died, which breaks the pool. """
+    global _binning_pool
+    if _binning_pool is not None:
+        _binning_pool.shutdown(wait=False, cancel_futures=True)
+        _binning_pool = None
@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+from tempfile import gettempdir
+
+from config.settings import FILE_PROCESS_CHUNK_CACHE_DIRECTORY, FILE_PROCESS_CHUNK_CACHE_MB
+from libs.utils.compression import decompress
+from libs.utils.telemetry import DECOMPRESS, stage
+
+
+SHA1_LENGTH = 20
+
+# when the cache is over its size limit it evicts down to this fraction of the limit, so that we
+# don't have to scan the directory on every write.
+EVICT_TO_FRACTION = 0.8
+
+
+class ChunkCache:
+    """ A size-bounded, least-recently-used cache of chunk files on local disk, shared by all the
+    processes on a data processing server.
+    
+    Participants upload all the time, so the chunk for the current hour is written by one processing
+    run and then downloaded again a few minutes later by the next one.  After a chunk is uploaded we
+    keep its compressed, (decrypted) contents here, keyed by chunk path and the sha1 of the
+    contents.  The caller looks the sha1 up in the S3File table, so a chunk that has been rewritten
+    since it was cached (by any server) misses instead of returning stale data, and the contents are
+    checked against the sha1 on every hit.
+    
+    There is one file per chunk path, a new version of a chunk replaces the old one.  The first 20
+    bytes of a file are the sha1, the rest is the zstd compressed chunk.  Files are written to a
+    temporary name and renamed into place, so readers in other processes never see a partial file.
+    Recency is the file modification time, which is updated on every hit. """
+    
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, mode=0o700, exist_ok=True)  # contents are not encrypted
+        
+        # counters, for this process
+        self.hits = 0
+        self.misses = 0
+        self.invalid = 0  # entries that failed validation, also counted as misses
+        self.evictions = 0
+        
+        # our estimate of the size of the cache directory, other processes write to it too.
+        self.estimated_size = self.evict() if max_bytes else 0
+    
+    def entry_path(self, chunk_path: str) -> str:
+        return os.path.join(self.directory, hashlib.sha1(chunk_path.encode()).hexdigest())
+    
+    def get(self, chunk_path: str, sha1: bytes) -> bytes | None:
+        """ Returns the decompressed contents of a chunk if we have the version with this sha1. """
+        entry_path = self.entry_path(chunk_path)
+        try:
+            with open(entry_path, "rb") as f:
+                if f.read(SHA1_LENGTH) != sha1:
+                    self.misses += 1  # a different version of this chunk
+                    return None
+                compressed_contents = f.read()
+            os.utime(entry_path)  # most recently used
+        except OSError:  # usually FileNotFoundError, the cache is best effort.
+            self.misses += 1
+            return None
+        
+        try:
+            with stage(DECOMPRESS):
+                contents = decompress(compressed_contents)
+        except Exception:
+            contents = None
+        
+        if contents is None or hashlib.sha1(contents).digest() != sha1:
+            self.invalid += 1
+            self.misses += 1
+            self.discard(entry_path)
+            return None
+        
+        self.hits += 1
+        return contents
+    
+    def put(self, chunk_path: str, sha1: bytes, compressed_contents: bytes):
+        """ Stores (or replaces) a chunk, sha1 is of the uncompressed contents.  Never raises an
+        OSError, a full disk should not fail data processing. """
+        assert len(sha1) == SHA1_LENGTH, "sha1 must be a 20 byte bytes object"
+        entry_path = self.entry_path(chunk_path)
+        temp_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(sha1)
+                f.write(compressed_contents)
+            os.replace(temp_path, entry_path)
+        except OSError as e:
+            print(f"chunk cache: could not write {chunk_path}: {e}")
+            self.discard(temp_path)
+            self.discard(entry_path)  # could be an older version
+            return
+        
+        self.estimated_size += SHA1_LENGTH + len(compressed_contents)
+        if self.estimated_size > self.max_bytes:
+            self.estimated_size = self.evict()
+    
+    def discard(self, entry_path: str):
+        try:
+            os.remove(entry_path)
+        except OSError:
+            pass
+    
+    def evict(self) -> int:
+        """ Removes the least recently used entries until the cache is under EVICT_TO_FRACTION of
+        its size limit (if it is over the limit), returns the size of the cache. """
+        entries = []
+        for dir_entry in os.scandir(self.directory):
+            try:
+                stat = dir_entry.stat()
+            except FileNotFoundError:
+                continue  # removed by another process
+            entries.append((stat.st_mtime, stat.st_size, dir_entry.path))
+        
+        total_size = sum(size for _, size, _ in entries)
+        if total_size <= self.max_bytes:
+            return total_size
+        
+        target = self.max_bytes * EVICT_TO_FRACTION
+        for _, size, entry_path in sorted(entries):
+            if total_size <= target:
+                break
+            self.discard(entry_path)
+            self.evictions += 1
+            total_size -= size
+        return total_size
+    
+    def report(self) -> str:
+        return f"chunk cache: {self.hits} hits, {self.misses} misses ({self.invalid} invalid), " \
+            f"{self.evictions} evictions, ~{self.estimated_size} bytes"
+
+
+_worker_chunk_cache: ChunkCache | None = None
+
+
+def get_worker_chunk_cache() -> ChunkCache | None:
+    """ The chunk cache of this data processing server, None if FILE_PROCESS_CHUNK_CACHE_MB is 0. """
+    global _worker_chunk_cache
+    if not FILE_PROCESS_CHUNK_CACHE_MB:
+        return None
+    if _worker_chunk_cache is None:
+        _worker_chunk_cache = ChunkCache(
+            FILE_PROCESS_CHUNK_CACHE_DIRECTORY or os.path.join(gettempdir(), "beiwe_chunk_cache"),
+            FILE_PROCESS_CHUNK_CACHE_MB * 1024 * 1024,
+        )
+    return _worker_chunk_cache
@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING
+
+from cronutils import ErrorHandler
+from django.db import transaction
+from django.utils import timezone
+
+from config.settings import FILE_PROCESS_SEGMENT_COMPACTION_HOURS
+from database.data_access_models import ChunkRegistry
+from database.profiling_models import S3File
+from database.user_models_participant import Participant
+from libs.file_processing.data_qty_stats import apply_data_quantity_changes
+from libs.file_processing.utility_functions_csvs import existing_data_csv_splitter
+from libs.file_processing.utility_functions_simple import merge_sorted_rows_as_csv_bytes
+from libs.s3 import s3_delete, s3_retrieve, s3_upload
+from libs.utils.security_utils import chunk_hash
+
+
+if TYPE_CHECKING:
+    from libs.s3 import StrPartStudy
+
+
+"""
+Segments are an alternative to rewriting a whole chunk (an hour of one data stream) every time new
+data arrives for it.  When FILE_PROCESS_CHUNK_SEGMENTS is enabled, data processing writes the new
+rows for an existing, recent, chunk as a small sorted csv next to the chunk:
+    CHUNKED_DATA/study_id/patient_id/data_stream/time_bin.csv                 <- the chunk
+    CHUNKED_DATA/study_id/patient_id/data_stream/time_bin.csv.segments/1.csv  <- its segments
+The ChunkRegistry's segment_count is the number of segments.  Segments are never modified, and
+everything that reads a chunk merges its segments into it (retrieve_chunk).  The merge is the same
+one data processing uses, so the merged chunk is identical to the chunk that processing would have
+written without segments.  Once the hour is old enough compact_chunk_segments merges the segments
+into the chunk and deletes them.
+
+While a chunk has segments its ChunkRegistry's chunk_hash is the hash of the chunk without its
+segments, and its file_size is the sum of the chunk and its segments.
+"""
+
+
+def construct_segment_path(chunk_path: str, segment_number: int) -> str:
+    return f"{chunk_path}.segments/{segment_number}.csv"
+
+
+def segment_paths(chunk_path: str, segment_count: int) -> list[str]:
+    return [construct_segment_path(chunk_path, n) for n in range(1, segment_count + 1)]
+
+
+def chunk_upload_path(chunk_path: str, chunk_kwargs: dict) -> str:
+    """ The S3 path to upload processed data to, the chunk_kwargs of a new segment have the segment
+    count that includes it.  (A rewritten chunk has a segment count of 0, it includes its segments.) """
+    if chunk_kwargs.get("segment_count"):
+        return construct_segment_path(chunk_path, chunk_kwargs["segment_count"])
+    return chunk_path
+
+
+def compactable_before(now: datetime | None = None) -> datetime:
+    """ Chunks with a time bin before this are old enough to have their segments compacted.  (A time
+    bin is the start of its hour.) """
+    return (now or timezone.now()) - timedelta(hours=FILE_PROCESS_SEGMENT_COMPACTION_HOURS + 1)
+
+
+def merge_chunk_segments(chunk_contents: bytes, segments: list[bytes]) -> bytes:
+    """ Merges segments, in order, into the contents of their chunk.  Clears the list of segments. """
+    if not segments:
+        return chunk_contents
+    
+    header, rows = existing_data_csv_splitter(chunk_contents)
+    del chunk_contents
+    segment_rows = []
+    for segment in segments:
+        segment_rows.extend(existing_data_csv_splitter(segment)[1])
+    segments.clear()
+    # the segment rows are sorted back into one list, ties keep segment order, like the chunk rewrites
+    return merge_sorted_rows_as_csv_bytes(header, rows, segment_rows)
+
+
+def retrieve_segments(chunk_path: str, obj: StrPartStudy, segment_count: int) -> list[bytes]:
+    return [s3_retrieve(path, obj, raw_path=True) for path in segment_paths(chunk_path, segment_count)]
+
+
+def retrieve_chunk(chunk_path: str, obj: StrPartStudy, segment_count: int) -> bytes:
+    """ Downloads a chunk, merged with its segments. """
+    contents = s3_retrieve(chunk_path, obj, raw_path=True)
+    if not segment_count:
+        return contents
+    return merge_chunk_segments(contents, retrieve_segments(chunk_path, obj, segment_count))
+
+
+def delete_chunk_segments(chunk_path: str, segment_count: int):
+    """ Deletes the segments of a chunk and their S3Files, only once the ChunkRegistry no longer
+    refers to them. """
+    paths = [path + ".zst" for path in segment_paths(chunk_path, segment_count)]
+    for path in paths:
+        s3_delete(path)
+    S3File.objects.filter(path__in=paths).delete()
+
+
+def compact_chunk_segments(participant: Participant, error_handler: ErrorHandler) -> int:
+    """ Merges the segments of a participant's chunks that are old enough into their chunks, and
+    deletes the segments.  This runs in the participant's data processing task, after their files
+    are processed, so it never runs at the same time as processing of the same chunks.  Returns the
+    number of chunks compacted. """
+    study = participant.study  # the S3 operations need the encryption key
+    query = ChunkRegistry.objects.filter(
+        participant=participant, segment_count__gt=0, time_bin__lt=compactable_before()
+    ).values_list("pk", "chunk_path", "segment_count", "file_size", "time_bin", "data_type")
+    
+    compacted = 0
+    for pk, chunk_path, segment_count, file_size, time_bin, data_type in list(query):
+        with error_handler:
+            contents = retrieve_chunk(chunk_path, study, segment_count)
+            s3_upload(chunk_path, contents, study, raw_path=True)
+            
+            with transaction.atomic():
+                ChunkRegistry.objects.filter(pk=pk).update(
+                    segment_count=0,
+                    chunk_hash=chunk_hash(contents),
+                    file_size=len(contents),
+                    last_updated=timezone.now(),
+                )
+                apply_data_quantity_changes(
+                    participant, [(time_bin, data_type, len(contents) - (file_size or 0))]
+                )
+            
+            delete_chunk_segments(chunk_path, segment_count)
+            compacted += 1
+    
+    return compacted
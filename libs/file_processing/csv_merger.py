@@ -1,25 +1,37 @@
 from __future__ import annotations
 
 import hashlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
 
 from botocore.exceptions import ReadTimeoutError
 from cronutils import ErrorHandler
 
+from config.settings import (FILE_PROCESS_CHUNK_SEGMENTS, FILE_PROCESS_COMPRESSION_BUFFER_MB,
+    FILE_PROCESS_COMPRESSION_WORKERS)
 from constants.common_constants import CHUNKS_FOLDER, RUNNING_TEST_OR_FROM_A_SHELL
 from constants.data_processing_constants import (SURVEY_TIMINGS, AllBinifiedData, BinifyKey,
     CHUNK_TIMESLICE_QUANTUM, DEBUG_FILE_PROCESSING, REFERENCE_CHUNKREGISTRY_HEADERS)
 from constants.data_stream_constants import SURVEY_DATA_FILES
 from database.data_access_models import ChunkRegistry
+from database.profiling_models import S3File
 from database.system_models import GenericEvent
 from database.user_models_participant import Participant
+from libs.file_processing.binified_data_spill import SpillableRows
+from libs.file_processing.chunk_cache import ChunkCache
+from libs.file_processing.chunk_segments import (compactable_before, merge_chunk_segments,
+    retrieve_segments)
 from libs.file_processing.utility_functions_csvs import (construct_csv_as_bytes,
     existing_data_csv_splitter, unix_time_to_string)
 from libs.file_processing.utility_functions_simple import (
-    convert_unix_to_human_readable_timestamps, ensure_sorted_by_timestamp)
+    convert_unix_to_human_readable_timestamps, ensure_sorted_by_timestamp,
+    merge_sorted_rows_as_csv_bytes)
 from libs.s3 import s3_retrieve
 from libs.utils.compression import compress
 from libs.utils.dev_utils import Timer
 from libs.utils.security_utils import chunk_hash
+from libs.utils.telemetry import COMPRESS, stage
 
 
 FileToProcessPK = int
@@ -29,9 +41,25 @@ ChunkPath = str
 ByteCount = int
 Sha1Hash = bytes
 Uploadable = tuple[dict, ChunkPath, FinalOutputContent, Sha1Hash, ByteCount, bool]
+# an existing ChunkRegistry of a time bin: its pk, file_size, time_bin and segment_count.
+ExistingChunk = tuple[int, int | None, datetime, int]
+FinishedChunk = tuple[str, Sha1Hash, FinalOutputContent]  # md5 chunk_hash, sha1, compressed content
+# a chunk being hashed and compressed on the pool, with the details needed to build its Uploadable.
+PendingChunk = tuple[Future[FinishedChunk], dict, ChunkPath, ByteCount, bool, list[FileToProcessPK]]
 class ChunkFailedToExist(Exception): pass
 
 
+# Number of chunk paths to look up per `chunk_path IN (...)` query when resolving which binified
+# data chunks already exist. Postgres is fine with large IN clauses, this just bounds query size.
+EXISTING_CHUNK_QUERY_BATCH_SIZE = 1000
+
+
+def hash_and_compress(contents: bytes) -> FinishedChunk:
+    # all three of these release the GIL, so this is safe and useful to run on a thread pool.
+    with stage(COMPRESS):
+        return chunk_hash(contents), hashlib.sha1(contents).digest(), compress(contents)
+
+
 def log(*args, **kwargs):
     """ A simple wrapper around print to make it easier to change logging later. """
     if DEBUG_FILE_PROCESSING:
@@ -56,6 +84,10 @@ class CsvMerger:
         participant: Participant,
         survey_object_id: str | None,
         survey_pk: int | None,
+        compression_workers: int = FILE_PROCESS_COMPRESSION_WORKERS,
+        compression_buffer_mb: int = FILE_PROCESS_COMPRESSION_BUFFER_MB,
+        chunk_cache: ChunkCache | None = None,
+        max_segments: int = FILE_PROCESS_CHUNK_SEGMENTS,
     ):
         assert isinstance(participant, Participant)
         assert survey_object_id is None or isinstance(survey_object_id, str)
@@ -72,12 +104,33 @@ class CsvMerger:
         # The type definition of items in merged_data must match the do_upload function.
         self.upload_these: list[Uploadable] = []  # chunk, chunk_path, file content
         
+        # Hashing and compression of chunks can run on a thread pool, finished chunks are added to
+        # upload_these in the order they were merged.  The buffer limits the uncompressed bytes that
+        # are waiting on the pool.
+        self.compression_workers = compression_workers
+        self.compression_buffer = compression_buffer_mb * 1024 * 1024
+        self.compression_pool: ThreadPoolExecutor | None = None
+        self.pending_chunks = deque[PendingChunk]()
+        self.pending_bytes: ByteCount = 0
+        
         # Track the earliest and latest time bins, to return them at the end of the function
         self.earliest_time_bin: int | None = None
         self.latest_time_bin: int | None = None
         
         self.binified_data: AllBinifiedData = binified_data
         self.error_handler = error_handler
+        
+        # existing chunks can be read from the local chunk cache, if their sha1 (from the S3File
+        # table) matches the cached version.
+        self.chunk_cache = chunk_cache
+        self.existing_chunk_sha1s: dict[ChunkPath, Sha1Hash] = {}
+        
+        # new data for recent existing chunks can be written as segments, see chunk_segments.py.
+        self.max_segments = max_segments
+        self.segments_after = compactable_before()
+        
+        # a map of chunk path to existing ChunkRegistry details, populated in bulk before iterating.
+        self.existing_chunks: dict[ChunkPath, ExistingChunk] = self.resolve_existing_chunks()
         self.iterate()
     
     def get_retirees(self) -> tuple[set[FileToProcessPK], set[FileToProcessPK], int | None, int | None]:
@@ -86,22 +139,70 @@ class CsvMerger:
         return self.ftps_to_retire.difference(self.failed_ftps), \
             self.failed_ftps, self.earliest_time_bin, self.latest_time_bin
     
+    def resolve_existing_chunks(self) -> dict[ChunkPath, ExistingChunk]:
+        """ Returns the existing ChunkRegistries of the time bins in the binified data by chunk path,
+        their pk, file size, time bin and segment count, queried in batches of chunk paths.  Time bins
+        without a ChunkRegistry are absent.  Also looks up the sha1s of the existing chunks when
+        there is a chunk cache. """
+        chunk_paths = set[ChunkPath]()
+        for study_object_id, patient_id, data_stream, time_bin, _ in self.binified_data:
+            try:
+                chunk_paths.add(construct_s3_chunk_path(
+                    study_object_id, patient_id, data_stream, time_bin, self.survey_object_id
+                ))
+            except ValueError:
+                # this error is raised again, and correctly handled, inside inner_iterate.
+                continue
+        
+        existing_chunks: dict[ChunkPath, ExistingChunk] = {}
+        chunk_paths_list = sorted(chunk_paths)
+        the_fields = ("chunk_path", "pk", "file_size", "time_bin", "segment_count")
+        for i in range(0, len(chunk_paths_list), EXISTING_CHUNK_QUERY_BATCH_SIZE):
+            batch = chunk_paths_list[i:i + EXISTING_CHUNK_QUERY_BATCH_SIZE]
+            query = ChunkRegistry.objects.filter(chunk_path__in=batch).values_list(*the_fields)
+            for chunk_path, pk, file_size, time_bin, segment_count in query:
+                existing_chunks[chunk_path] = (pk, file_size, time_bin, segment_count)
+        
+        if self.chunk_cache is not None:
+            self.resolve_existing_chunk_sha1s(sorted(existing_chunks))
+        return existing_chunks
+    
+    def resolve_existing_chunk_sha1s(self, chunk_paths_list: list[ChunkPath]):
+        """ The sha1s of the current versions of existing chunks, the key for the chunk cache. """
+        for i in range(0, len(chunk_paths_list), EXISTING_CHUNK_QUERY_BATCH_SIZE):
+            batch = [path + ".zst" for path in chunk_paths_list[i:i + EXISTING_CHUNK_QUERY_BATCH_SIZE]]
+            query = S3File.objects.filter(path__in=batch, sha1__isnull=False).values_list("path", "sha1")
+            for s3_path, sha1 in query:
+                self.existing_chunk_sha1s[s3_path[:-4]] = bytes(sha1)  # may be a memoryview
+    
     def iterate(self):
         # this is the core loop. Iterate over all binified data and merge it into chunks, then
         # handle ChunkRegistry parameter setup for the next stage of processing.
         ftp_list: list[int]
         data_bin: BinifyKey
-        while True:
-            # this construction consumes elements from the dictionary as we iterate over them, it
-            # saves memory because we are building up large byte arrays as we go from the data we
-            # are pulling out of the dictionary.
-            try:
-                data_bin, (data_rows_list, ftp_list) = self.binified_data.popitem()
+        if self.compression_workers > 0:
+            self.compression_pool = ThreadPoolExecutor(
+                self.compression_workers, thread_name_prefix="chunk_compression"
+            )
+        try:
+            while True:
+                # this construction consumes elements from the dictionary as we iterate over them, it
+                # saves memory because we are building up large byte arrays as we go from the data we
+                # are pulling out of the dictionary.
+                try:
+                    data_bin, (data_rows_list, ftp_list) = self.binified_data.popitem()
+                
+                except KeyError:
+                    break
+                with self.error_handler:
+                    self.inner_iterate(data_bin, data_rows_list, ftp_list)
             
-            except KeyError:
-                break
-            with self.error_handler:
-                self.inner_iterate(data_bin, data_rows_list, ftp_list)
+            while self.pending_chunks:
+                self.collect_pending_chunk()
+        finally:
+            if self.compression_pool is not None:
+                self.compression_pool.shutdown(cancel_futures=True)
+                self.compression_pool = None
     
     def inner_iterate(
         self, data_bin: BinifyKey, data_rows_list: list[list[bytes]], ftp_list: list[int]
@@ -109,6 +210,10 @@ class CsvMerger:
         study_object_id, patient_id, data_stream, time_bin, original_header, updated_header = None, None, None, None, None, None  # yuck need to prepopulate these for error cases, just leave it like this its better this way
         
         try:
+            # binified data may have been spilled to disk to save memory, load it (just this bin).
+            if isinstance(data_rows_list, SpillableRows):
+                data_rows_list.load_spilled()
+            
             #     str            str          str        int         bytes
             study_object_id, patient_id, data_stream, time_bin, original_header = data_bin
             # Update earliest and latest time bins
@@ -124,14 +229,17 @@ class CsvMerger:
                 study_object_id, patient_id, data_stream, time_bin, self.survey_object_id
             )
             
-            # two core cases
-            if ChunkRegistry.objects.filter(chunk_path=chunk_path).exists():
+            # two core cases (existence was resolved in bulk by resolve_existing_chunks), and
+            # existing chunks may get a new segment instead.
+            if chunk_path in self.existing_chunks and self.should_write_segment(chunk_path):
+                self.chunk_segment_case(chunk_path, updated_header, data_stream, data_rows_list, ftp_list)
+            elif chunk_path in self.existing_chunks:
                 self.chunk_exists_case(
-                    chunk_path, study_object_id, updated_header, data_rows_list, data_stream
+                    chunk_path, study_object_id, updated_header, data_rows_list, data_stream, ftp_list
                 )
             else:
                 self.chunk_not_exists_case(
-                    chunk_path, updated_header, data_stream, time_bin, data_rows_list
+                    chunk_path, updated_header, data_stream, time_bin, data_rows_list, ftp_list
                 )
         
         except Exception:
@@ -156,6 +264,7 @@ class CsvMerger:
         data_stream: str,
         time_bin: int,
         rows: list[list[bytes]],
+        ftp_list: list[FileToProcessPK],
     ):
         name = chunk_path[38:]
         final_header = self.validate_one_header(updated_header, data_stream)
@@ -168,23 +277,53 @@ class CsvMerger:
         rows.clear(); del rows  # memory usage paranoia begins
         
         size_uncompressed = len(new_contents)  # we don't use this anymore in the final return
-        md5_hash = chunk_hash(new_contents)
-        sha1_hash = hashlib.sha1(new_contents).digest()
-        new_contents = compress(new_contents)  # This file hangs around in memory, compress it asap.
         log(f"CsvMerger: constructed {size_uncompressed} bytes (new) for {name} in {t.fseconds} seconds.")
         
-        # this object will get **kwargs'd into ChunkRegistry.register_chunked_data
+        # this object will get **kwargs'd into ChunkRegistry.register_chunked_data, chunk_hash is
+        # filled in by finish_chunk.
         chunk_params = {
             "study_id": self.participant.study_id,
             "participant_id": self.participant.id,
             "data_type": data_stream,
             "chunk_path": chunk_path,
-            "chunk_hash": md5_hash,
+            "chunk_hash": None,
             "time_bin": time_bin,
             "survey_id": self.survey_pk,
             "file_size": size_uncompressed,  # we don't use this anymore in the final return...
         }
-        self.upload_these.append((chunk_params, chunk_path, new_contents, sha1_hash, size_uncompressed, True))
+        # This file hangs around in memory, compress it asap.
+        self.finish_chunk(chunk_params, chunk_path, new_contents, True, ftp_list)
+    
+    def should_write_segment(self, chunk_path: ChunkPath) -> bool:
+        _, _, time_bin, segment_count = self.existing_chunks[chunk_path]
+        return segment_count < self.max_segments and time_bin >= self.segments_after
+    
+    def chunk_segment_case(
+        self,
+        chunk_path: str,
+        updated_header: bytes,
+        data_stream: str,
+        rows: list[list[bytes]],
+        ftp_list: list[FileToProcessPK],
+    ):
+        """ Writes the new rows as a segment of the existing chunk, without downloading it. """
+        name = chunk_path[38:]
+        final_header = self.validate_one_header(updated_header, data_stream)
+        
+        ensure_sorted_by_timestamp(rows)
+        with Timer() as t:
+            new_contents = construct_csv_as_bytes(final_header, rows)
+        rows.clear(); del rows
+        log(f"CsvMerger: constructed {len(new_contents)} bytes (segment) for {name} in {t.fseconds} seconds.")
+        
+        # the segment count in the kwargs makes this a segment upload, and the ChunkRegistry keeps
+        # the chunk hash of the chunk.  (If this chunk is in the data again, e.g. with another
+        # header, that becomes the next segment.)
+        pk, file_size, time_bin, segment_count = self.existing_chunks[chunk_path]
+        file_size = (file_size or 0) + len(new_contents)
+        self.existing_chunks[chunk_path] = (pk, file_size, time_bin, segment_count + 1)
+        chunk_kwargs = {"chunk_hash": None, "file_size": file_size, "segment_count": segment_count + 1}
+        self.finish_chunk(chunk_kwargs, chunk_path, new_contents, False, ftp_list)
     
     def chunk_exists_case(
         self,
@@ -193,12 +332,13 @@ class CsvMerger:
         updated_header: bytes,
         new_rows: list[list[bytes]],
         data_stream: str,
+        ftp_list: list[FileToProcessPK],
     ):
         name = chunk_path[38:]
         
         with Timer() as t_retrieve:
             try:
-                old_s3_file_data = [s3_retrieve(chunk_path, study_object_id, raw_path=True)]
+                old_s3_file_data = [self.retrieve_existing_chunk(chunk_path, study_object_id)]
             except ReadTimeoutError as e:
                 # The following check was correct for boto 2, still need to hit with boto3 test.
                 if "The specified key does not exist." == str(e):
@@ -225,28 +365,75 @@ class CsvMerger:
         log(f"CsvMerger: merged {orig_size} bytes for {name} in {t_unpack.fseconds} seconds.")
         
         final_header = self.validate_two_headers(s3_header, updated_header, data_stream)
-        output_rows.extend(new_rows)
-        new_rows.clear(); del new_rows  # memory paranoia...
-        
-        ensure_sorted_by_timestamp(output_rows)  # merges data together with a sort and deduplicate
         
-        # this construction ensures there is no reference to the output of construct_csv_string
-        # in memory after this line.  Hopefully the gc is deterministic enough to benefit from that.
-        # Construct csv string also deduplicates rows.
+        # The existing chunk is already sorted, this merges the new rows into it in linear time,
+        # deduplicates, and builds the csv directly, without a combined list of rows or a full sort.
+        # Both lists of rows are cleared by the merge.
         with Timer() as t_construct:
-            new_contents = construct_csv_as_bytes(final_header, output_rows)
+            new_contents = merge_sorted_rows_as_csv_bytes(final_header, output_rows, new_rows)
         
-        output_rows.clear(); del output_rows  # Some more paranoia
-        log(f"CsvMerger: compressed new data for {name} in {t_construct.fseconds} seconds.")
+        del output_rows, new_rows  # memory paranoia...
+        log(f"CsvMerger: merged new data for {name} in {t_construct.fseconds} seconds.")
         
-        # get metadata before compressing
+        # the rewritten chunk includes its segments, they are deleted once it is registered.
+        chunk_kwargs = {"chunk_hash": None, "file_size": len(new_contents), "segment_count": 0}
+        self.finish_chunk(chunk_kwargs, chunk_path, new_contents, False, ftp_list)
+    
+    def retrieve_existing_chunk(self, chunk_path: ChunkPath, study_object_id: str) -> bytes:
+        """ The existing chunk merged with its segments, from the chunk cache if possible. """
+        contents = None
+        if self.chunk_cache is not None and chunk_path in self.existing_chunk_sha1s:
+            contents = self.chunk_cache.get(chunk_path, self.existing_chunk_sha1s[chunk_path])
+        if contents is None:
+            contents = s3_retrieve(chunk_path, study_object_id, raw_path=True)
+        
+        if segment_count := self.existing_chunks[chunk_path][3]:
+            contents = merge_chunk_segments(contents, retrieve_segments(chunk_path, study_object_id, segment_count))
+        return contents
+    
+    def finish_chunk(
+        self,
+        chunk_kwargs: dict,
+        chunk_path: ChunkPath,
+        new_contents: bytes,
+        is_new: bool,
+        ftp_list: list[FileToProcessPK],
+    ):
+        """ Hashes and compresses a merged chunk and adds it to upload_these.  With a compression
+        pool this is submitted to the pool instead, waiting on earlier chunks first if the buffer of
+        uncompressed data is full. """
         size_uncompressed = len(new_contents)
-        chunk_kwargs = {"chunk_hash": chunk_hash(new_contents), "file_size": size_uncompressed}
         
-        # reuse variable to zero references to the uncompressed data
-        sha1_hash = hashlib.sha1(new_contents).digest()
-        new_contents = compress(new_contents)
-        self.upload_these.append((chunk_kwargs, chunk_path, new_contents, sha1_hash, size_uncompressed, False))
+        if self.compression_pool is None:
+            chunk_kwargs["chunk_hash"], sha1_hash, compressed = hash_and_compress(new_contents)
+            self.upload_these.append((chunk_kwargs, chunk_path, compressed, sha1_hash, size_uncompressed, is_new))
+            return
+        
+        # collect anything that is already done, then make room in the buffer.  A chunk larger than
+        # the whole buffer still goes through once everything before it is done.
+        while self.pending_chunks and self.pending_chunks[0][0].done():
+            self.collect_pending_chunk()
+        while self.pending_chunks and self.pending_bytes + size_uncompressed > self.compression_buffer:
+            self.collect_pending_chunk()
+        
+        future = self.compression_pool.submit(hash_and_compress, new_contents)
+        self.pending_chunks.append((future, chunk_kwargs, chunk_path, size_uncompressed, is_new, ftp_list))
+        self.pending_bytes += size_uncompressed
+    
+    def collect_pending_chunk(self):
+        """ Waits on the oldest chunk on the compression pool and adds it to upload_these.  Failures
+        are attributed to the files of that chunk, not whichever bin is currently being merged. """
+        future, chunk_kwargs, chunk_path, size_uncompressed, is_new, ftp_list = self.pending_chunks.popleft()
+        self.pending_bytes -= size_uncompressed
+        
+        with self.error_handler:
+            try:
+                chunk_kwargs["chunk_hash"], sha1_hash, compressed = future.result()
+            except Exception:
+                self.failed_ftps.update(ftp_list)
+                log(f"FAILED TO COMPRESS: chunk_path:{chunk_path}")
+                raise
+            self.upload_these.append((chunk_kwargs, chunk_path, compressed, sha1_hash, size_uncompressed, is_new))
     
     def validate_one_header(self, header: bytes, data_stream: str) -> bytes:
         # pp(self.participant)
@@ -1,6 +1,9 @@
 from collections import defaultdict
+from collections.abc import Iterable
 from datetime import date, datetime, tzinfo
 
+from django.db import transaction
+from django.db.models import Sum
 from django.db.models.query import QuerySet
 
 from constants.common_constants import UTC
@@ -12,6 +15,14 @@ from database.user_models_participant import Participant
 from libs.utils.date_utils import date_to_end_of_day, date_to_start_of_day, get_timezone_shortcode
 
 
+# a time bin (or file timestamp), a data type, and a number of bytes (a change in bytes can be negative)
+DataQuantityChange = tuple[datetime, str, int | None]
+# a dict[date][data_type] = total_bytes
+DailyDataQuantities = defaultdict[date, defaultdict[str, int]]
+
+DATA_QUANTITY_FIELDS = {data_type: f"beiwe_{data_type}_bytes" for data_type in ALL_DATA_STREAMS}
+
+
 def timeslice_to_start_of_day(timeslice: int, tz: tzinfo):
     """ We use an integer to represent time, it must be multiplied by CHUNK_TIMESLICE_QUANTUM to
     yield a unix timestamp."""
@@ -28,24 +39,57 @@ def timeslice_to_end_of_day(timeslice: int, tz: tzinfo):
     return date_to_end_of_day(day, tz)
 
 
-def populate_data_quantity(
-    chunkregistry_query: QuerySet, study_timezone: tzinfo
-) -> defaultdict[date, defaultdict[str, int]]:
-    time_bin: datetime;   chunk_data_type: str;   file_size: int
-    
-    # a dict[date][data_type] = total_bytes
-    daily_data_quantities: defaultdict[date, defaultdict[str, int]] = defaultdict(lambda: defaultdict[str, int](int))
-    the_fields = ("time_bin", "data_type", "file_size")
+def daily_data_quantities(
+    data_quantities: Iterable[DataQuantityChange], study_timezone: tzinfo
+) -> DailyDataQuantities:
+    """ Sums bytes by day (in the study's timezone) and data type. Chunks are hourly, so the same time
+    bin shows up over and over, we only work out the day of each distinct time bin once. """
+    daily_data_quantities: DailyDataQuantities = defaultdict(lambda: defaultdict[str, int](int))
+    days_of_time_bins: dict[datetime, date] = {}
     
-    # get the date in the study's timezone, identify the size of that chunk, add based on data type
-    for time_bin, chunk_data_type, file_size in chunkregistry_query.values_list(*the_fields):
-        day = time_bin.astimezone(study_timezone).date()
-        file_size = 0 if file_size is None else file_size
-        daily_data_quantities[day][chunk_data_type] += file_size
+    for time_bin, data_type, byte_count in data_quantities:
+        try:
+            day = days_of_time_bins[time_bin]
+        except KeyError:
+            day = days_of_time_bins[time_bin] = time_bin.astimezone(study_timezone).date()
+        daily_data_quantities[day][data_type] += 0 if byte_count is None else byte_count
     
     return daily_data_quantities
 
 
+def populate_data_quantity(chunkregistry_query: QuerySet, study_timezone: tzinfo) -> DailyDataQuantities:
+    # the database sums file sizes per time bin and data type, we only have to assign them to days.
+    query = chunkregistry_query.values_list("time_bin", "data_type") \
+        .annotate(total_bytes=Sum("file_size")).order_by()
+    return daily_data_quantities(query, study_timezone)
+
+
+def upsert_data_quantities(participant: Participant, daily_quantities: dict[date, dict[str, int]]):
+    """ Writes the totals to the SummaryStatisticDaily of each day in one query, all beiwe bytes fields
+    of those days are overwritten (a data type with no data is None).  Other fields are untouched. """
+    study_timezone: tzinfo = participant.study.timezone
+    summaries = []
+    for day, day_data in daily_quantities.items():
+        summary = SummaryStatisticDaily(
+            the_study_id=participant.study_id,
+            participant_id=participant.pk,
+            date=day,
+            timezone=get_timezone_shortcode(day, study_timezone),
+        )
+        for data_type, total_bytes in day_data.items():
+            if data_type in DATA_QUANTITY_FIELDS:
+                setattr(summary, DATA_QUANTITY_FIELDS[data_type], total_bytes)
+        summaries.append(summary)
+    
+    if summaries:
+        SummaryStatisticDaily.objects.bulk_create(
+            summaries,
+            update_conflicts=True,
+            unique_fields=["date", "participant"],
+            update_fields=["timezone", "last_updated", *DATA_QUANTITY_FIELDS.values()],
+        )
+
+
 def calculate_data_quantity_stats(
     participant: Participant,
     earliest_time_bin_number: int|None = None,
@@ -68,16 +112,71 @@ def calculate_data_quantity_stats(
         time_bin__gte=timeslice_to_start_of_day(earliest_time_bin_number, study_timezone),
         time_bin__lt=timeslice_to_end_of_day(latest_time_bin_number, study_timezone)
     )
+    upsert_data_quantities(participant, populate_data_quantity(query, study_timezone))
+
+
+def apply_data_quantity_changes(participant: Participant, changes: list[DataQuantityChange]):
+    """ Updates the SummaryStatisticDaily stats for a participant by the changes in ChunkRegistry file
+    sizes made by a data processing run, instead of recalculating each affected day from the
+    ChunkRegistry.  Days that don't have a SummaryStatisticDaily yet are calculated from the
+    ChunkRegistry, so call this after the changes have been saved.
     
-    # For each date, create a DataQuantity object
-    for day, day_data in populate_data_quantity(query, study_timezone).items():
-        data_quantity = {
-            "the_study_id": participant.study_id,
-            "participant_id": participant.pk,
-            "date": day,
-            "defaults": {"timezone": get_timezone_shortcode(day, study_timezone)}
-        }
-        for data_type, total_bytes in day_data.items():
-            if data_type in ALL_DATA_STREAMS:
-                data_quantity["defaults"][f"beiwe_{data_type}_bytes"] = total_bytes
-        SummaryStatisticDaily.objects.update_or_create(**data_quantity)
+    scripts/script_that_reconciles_data_quantity_stats.py checks these against a full recalculation. """
+    if not changes:
+        return
+    
+    study_timezone: tzinfo = participant.study.timezone
+    daily_changes = daily_data_quantities(changes, study_timezone)
+    
+    with transaction.atomic():
+        existing = SummaryStatisticDaily.objects.filter(participant=participant, date__in=list(daily_changes))
+        daily_totals: dict[date, dict[str, int]] = {}
+        for day, *byte_counts in existing.values_list("date", *DATA_QUANTITY_FIELDS.values()):
+            day_totals = {
+                data_type: byte_count
+                for data_type, byte_count in zip(DATA_QUANTITY_FIELDS, byte_counts) if byte_count is not None
+            }
+            for data_type, change in daily_changes[day].items():
+                # a negative total means the stats were already wrong, the reconciliation script fixes it
+                day_totals[data_type] = max(day_totals.get(data_type, 0) + change, 0)
+            daily_totals[day] = day_totals
+        
+        if missing_days := [day for day in daily_changes if day not in daily_totals]:
+            query = ChunkRegistry.objects.filter(
+                participant=participant,
+                time_bin__gte=date_to_start_of_day(min(missing_days), study_timezone),
+                time_bin__lt=date_to_end_of_day(max(missing_days), study_timezone),
+            )
+            calculated = populate_data_quantity(query, study_timezone)
+            for day in missing_days:
+                daily_totals[day] = calculated[day]
+        
+        upsert_data_quantities(participant, daily_totals)
+
+
+def reconcile_data_quantity_stats(participant: Participant, fix: bool = True) -> list[date]:
+    """ Recalculates all of a participant's data quantity stats from the ChunkRegistry and compares
+    them to the SummaryStatisticDaily values.  Returns the days that differ, and fixes them. """
+    study_timezone: tzinfo = participant.study.timezone
+    calculated = populate_data_quantity(
+        ChunkRegistry.objects.filter(participant=participant), study_timezone
+    )
+    
+    current = SummaryStatisticDaily.objects.filter(participant=participant) \
+        .values_list("date", *DATA_QUANTITY_FIELDS.values())
+    days_with_stats = set()
+    wrong: dict[date, dict[str, int]] = {}
+    for day, *byte_counts in current:
+        days_with_stats.add(day)
+        day_data = calculated.get(day, {})
+        expected = [day_data.get(data_type) for data_type in DATA_QUANTITY_FIELDS]
+        if byte_counts != expected:
+            wrong[day] = day_data
+    
+    for day, day_data in calculated.items():  # days with data but no stats at all
+        if day not in days_with_stats:
+            wrong[day] = day_data
+    
+    if fix:
+        upsert_data_quantities(participant, wrong)
+    return sorted(wrong)
@@ -10,6 +10,7 @@ from constants.user_constants import ANDROID_API
 from database.models import FileToProcess, Study
 from libs.file_processing.data_fixes import (fix_app_log_file, fix_call_log_csv, fix_identifier_csv,
     fix_survey_timings, fix_wifi_csv)
+from libs.file_processing.utility_functions_csvs import split_csv_rows
 from libs.file_processing.utility_functions_simple import s3_file_path_to_data_type
 from libs.s3 import s3_retrieve
 
@@ -37,8 +38,11 @@ class FileForProcessing():
     the real logic that handles data manipulation.  This is necessary because Python's garbage
     collection struggles with our code. """
     
-    def __init__(self, file_to_process: FileToProcess, study: Study):
-        # purpose of study is to avoid a database query in a few spots, including decryption key
+    def __init__(
+        self, file_to_process: FileToProcess, study: Study | None, file_contents: bytes | None = None
+    ):
+        # purpose of study is to avoid a database query in a few spots, including decryption key.
+        # (it is only used to download the file, it can be None if file_contents are provided.)
         self.study = study
         
         self.file_to_process: FileToProcess = file_to_process
@@ -54,7 +58,10 @@ class FileForProcessing():
         self.exception: Exception | None = None
         self.traceback: OptExcInfo | None = None
         
-        self.download_file_contents()  # magically populate at instantiation
+        if file_contents is None:
+            self.download_file_contents()  # magically populate at instantiation
+        else:
+            self.file_contents = file_contents
     
     def clear_file_content(self):
         assert self.file_contents is not None, "misuse, file_contents was already deleted."
@@ -70,6 +77,7 @@ class FileForProcessing():
         """ This (actually instantiation) is called inside a threadpool, we handles network errors
         and update state accordingly. """
         assert self.file_lines is None, "file_lines was not deleted."
+        assert self.study is not None, "study is required to download a file."
         
         # Try to retrieve the file contents. If any errors are raised, store them to be reraised by
         # the parent function.
@@ -83,9 +91,10 @@ class FileForProcessing():
             self.exception = e
             raise SomeException(e)
     
-    def raw_csv_to_line_list(self):
+    def raw_csv_to_line_list(self, maxsplit: int = -1):
         """ Grab a list elements from of every line in the csv, strips off trailing whitespace. dumps
-        them into a new list (of lists), and returns the header line along with the list of rows. """
+        them into a new list (of lists), and returns the header line along with the list of rows.
+        Lines are split on at most maxsplit commas, see leading_columns. """
         assert self.file_contents is not None, "file_contents was not populated. (1)"
         
         # case: the file coming in is just a single line, e.g. the header.
@@ -99,10 +108,19 @@ class FileForProcessing():
             return
         
         # normal case
-        lines = self.file_contents.splitlines()
+        self.header, self.file_lines = split_csv_rows(self.file_contents, maxsplit)
         self.clear_file_content()
-        self.header = lines.pop(0)  # annoyingly slow, but after a lot of tests, this is the best/fastest way.
-        self.file_lines = [line.split(b",") for line in lines]
+    
+    def leading_columns(self) -> int:
+        """ The number of leading columns that data fixes and binning need to be separate fields,
+        the rest of each line is kept as one field. """
+        # the call log fix moves column 2 to the front, the survey timings fix inserts at column 2.
+        if self.file_to_process.os_type == ANDROID_API and self.data_type == CALL_LOG:
+            return 3
+        if self.data_type == SURVEY_TIMINGS:
+            return 2
+        # binning needs the timestamp, the other fixes insert a column at the front.
+        return 1
     
     def prepare_data(self):
         """ We need to apply fixes (in the correct order), and get the list of csv lines."""
@@ -116,7 +134,7 @@ class FileForProcessing():
             )
         
         # convert the file to a list of lines and columns
-        self.raw_csv_to_line_list()
+        self.raw_csv_to_line_list(self.leading_columns())
         assert self.file_lines is not None, "file_lines was not populated."
         assert self.header is not None, "header was not populated (1)."
         
@@ -1,34 +1,85 @@
 from __future__ import annotations
 
-from collections import Counter, defaultdict
+import json
+from collections import Counter, defaultdict, deque
 from collections.abc import Generator
-from datetime import timedelta
-from time import mktime
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from time import mktime, perf_counter
 
 from cronutils.error_handler import ErrorHandler
-from django.core.exceptions import ValidationError
+from django.db import connection, transaction
 from django.utils import timezone
 
-from config.settings import FILE_PROCESS_PAGE_SIZE
+from config.settings import (FILE_PROCESS_BINNING_WORKERS, FILE_PROCESS_CHUNK_SEGMENTS,
+    FILE_PROCESS_MEMORY_BUDGET_MB, FILE_PROCESS_PAGE_MB, FILE_PROCESS_PAGE_SIZE,
+    FILE_PROCESS_PIPELINE_DEPTH)
 from constants import common_constants
-from constants.data_processing_constants import AllBinifiedData, BinifyDict, DEBUG_FILE_PROCESSING
+from constants.data_processing_constants import (AllBinifiedData, BinifyDict, BinifyKey,
+    DEBUG_FILE_PROCESSING)
 from constants.data_stream_constants import (ACCELEROMETER, DATA_STREAM_TO_S3_FILE_NAME_STRING,
     DEVICEMOTION, GPS, GYRO, MAGNETOMETER)
 from database.common_models import Q
 from database.data_access_models import ChunkRegistry, FileToProcess
-from database.models import Participant, S3File, Study
-from libs.file_processing.csv_merger import CsvMerger, FinalOutputContent, Sha1Hash
-from libs.file_processing.data_qty_stats import calculate_data_quantity_stats
+from database.models import DataProcessingRun, Participant, S3File, Study
+from libs.file_processing.binified_data_spill import estimate_rows_size, SpillableRows
+from libs.file_processing.binning_pool import (bin_stream_files, BinnedFile, get_binning_pool,
+    shutdown_binning_pool, StreamFile, unpack_rows)
+from libs.file_processing.chunk_cache import ChunkCache, get_worker_chunk_cache
+from libs.file_processing.chunk_segments import (chunk_upload_path, compact_chunk_segments,
+    delete_chunk_segments)
+from libs.file_processing.csv_merger import (ChunkPath, construct_s3_chunk_path, CsvMerger,
+    FinalOutputContent, Sha1Hash, Uploadable)
+from libs.file_processing.data_qty_stats import apply_data_quantity_changes, DataQuantityChange
 from libs.file_processing.file_for_processing import FileForProcessing
-from libs.file_processing.utility_functions_simple import (BadTimecodeError, binify_from_timecode,
+from libs.file_processing.utility_functions_simple import (BadTimecodeError, binify_rows,
     clean_java_timecode, resolve_survey_id_from_file_name)
-from libs.s3 import s3_upload_no_compression
+from libs.s3 import S3Storage, s3_upload_no_compression
 from libs.sentry import SentryUtils
 from libs.utils.dev_utils import Timer
-from libs.utils.threadpool_utils import drain_in_reverse, s3_op_threaded_iterate
+from libs.utils.telemetry import (BINNING, BYTES_DOWNLOADED, BYTES_UPLOADED, count, MERGE,
+    peak_memory_mb, REGISTER, reset_peak_memory, stage, STATS, Telemetry)
+from libs.utils.threadpool_utils import (drain_in_reverse, s3_op_threaded_iterate,
+    s3_op_threadpool, threadpool_iterate)
 
 
 FileToProcessPK = int
+SurveyObjectId = str | None
+Retirees = tuple[set[FileToProcessPK], set[FileToProcessPK], int | None, int | None]
+UploadedChunk = tuple[S3Storage, dict, ChunkPath, bool]  # storage, chunk_kwargs, chunk_path, create_new_chunk
+ChunkRegistration = tuple[dict, ChunkPath, bool]  # chunk_kwargs, chunk_path, create_new_chunk
+# an unchunkable file waiting to be registered: FileToProcess pk, its validated unsaved ChunkRegistry
+UnchunkableFile = tuple[FileToProcessPK, ChunkRegistry]
+# an upload running in the background, the retirees of the merge, and the chunk paths being uploaded
+PendingUpload = tuple[Future[list[UploadedChunk]], Retirees, set[ChunkPath]]
+
+# A participant's processing stops after the page that runs past this time limit.
+PROCESSING_TIME_LIMIT = timedelta(minutes=29, seconds=30)
+
+# participant id, seconds, and how the participant's run in a batch ended
+ParticipantRun = tuple[int, float, str]
+RUN_FINISHED = "finished"
+RUN_FAILED = "failed"
+RUN_SKIPPED = "skipped"  # out of time
+
+# Page sizes come from the S3File table.  Files with only a compressed size are assumed to compress
+# about this well (our csv data compresses 4-10x), files with no sizes at all get the estimate.
+ESTIMATED_COMPRESSION_RATIO = 5
+UNKNOWN_FILE_SIZE_ESTIMATE = 1024 * 1024
+S3FILE_QUERY_BATCH_SIZE = 1000
+
+# telemetry counters of a run, see DataProcessingRun, records of runs are kept for a week.
+FILES = "files"
+FAILED_FILES = "failed_files"
+FILE_BYTES = "file_bytes"
+CHUNKS = "chunks"
+QUERIES = "queries"
+RUN_RECORD_RETENTION = timedelta(days=7)
+
+# When the previous page shows that the next full page would use more than this fraction of the
+# remaining time, the page is made smaller.
+PAGE_TIME_FRACTION = 0.5
 
 # LIST CANNOT INCLUDE THE WIFI DATA STREAM
 DUPLICATE_CLEARABLE_TYPES = (
@@ -50,14 +101,59 @@ def logd(*args, **kwargs):
     print(*args, **kwargs)
 
 
-def easy_run(participant: Participant):
+def easy_run(
+    participant: Participant,
+    time_limit: timedelta = PROCESSING_TIME_LIMIT,
+    thread_pool: ThreadPool | None = None,
+):
     """ Just a handy way to just run data processing in the terminal, use with caution, does not
     test for celery activity. """
     logd(f"processing files for {participant.patient_id}")
-    processor = FileProcessingTracker(participant)
+    processor = FileProcessingTracker(participant, time_limit=time_limit, thread_pool=thread_pool)
     processor.remove_already_purged_s3files()
     # processor.clear_duplicate_ftps()  # not currently used on a live instance
     processor.process_user_file_chunks()
+    processor.compact_chunk_segments()
+
+
+def easy_run_batch(
+    participant_ids: list[int],
+    time_limit: timedelta = PROCESSING_TIME_LIMIT,
+    error_handler: ErrorHandler | None = None,
+) -> list[ParticipantRun]:
+    """ Runs data processing for several participants one after another, sharing one S3 thread pool
+    and one time limit.  An error with one participant is reported and the next participant runs.
+    Participants that don't get a turn before the time limit are skipped, they will be queued again.
+    Returns how each participant's run ended and the time it took. """
+    deadline = timezone.now() + time_limit
+    participants = Participant.objects.in_bulk(participant_ids)
+    runs: list[ParticipantRun] = []
+    
+    thread_pool = s3_op_threadpool()
+    try:
+        for participant_id in participant_ids:
+            time_remaining = deadline - timezone.now()
+            if time_remaining <= timedelta(0):
+                runs.append((participant_id, 0.0, RUN_SKIPPED))
+                continue
+            
+            outcome = RUN_FAILED
+            t_start = perf_counter()
+            with error_handler or SentryUtils.report_data_processing(participant_id=participant_id):
+                easy_run(participants[participant_id], time_remaining, thread_pool)
+                outcome = RUN_FINISHED
+            runs.append((participant_id, perf_counter() - t_start, outcome))
+    finally:
+        thread_pool.close()
+        thread_pool.join()
+        thread_pool.terminate()
+    
+    log("batch:", ", ".join(f"{pk} {outcome} in {seconds:.1f}s" for pk, seconds, outcome in runs))
+    return runs
+
+
+def delete_old_processing_runs():
+    DataProcessingRun.objects.filter(created_on__lt=timezone.now() - RUN_RECORD_RETENTION).delete()
 
 
 """########################## Hourly Update Tasks ###########################"""
@@ -68,7 +164,17 @@ def easy_run(participant: Participant):
 class FileProcessingTracker():
     
     def __init__(
-        self, participant: Participant, page_size: int = FILE_PROCESS_PAGE_SIZE,
+        self,
+        participant: Participant,
+        page_size: int = FILE_PROCESS_PAGE_SIZE,
+        page_mb: int = FILE_PROCESS_PAGE_MB,
+        memory_budget_mb: int = FILE_PROCESS_MEMORY_BUDGET_MB,
+        pipeline_depth: int = FILE_PROCESS_PIPELINE_DEPTH,
+        chunk_cache: ChunkCache | None = None,
+        max_segments: int = FILE_PROCESS_CHUNK_SEGMENTS,
+        time_limit: timedelta = PROCESSING_TIME_LIMIT,
+        thread_pool: ThreadPool | None = None,
+        binning_workers: int = FILE_PROCESS_BINNING_WORKERS,
     ) -> None:
         self.error_handler: ErrorHandler = SentryUtils.report_data_processing(
             tags={'patient_id': participant.patient_id}
@@ -83,8 +189,33 @@ class FileProcessingTracker():
         self.study_object_id: str = self.study.object_id
         self.patient_id: str = participant.patient_id
         
-        # we operate on a page of files at a time, this is the size of the page.
+        # we operate on a page of files at a time, this is the size of the page, in files and in
+        # (uncompressed) bytes, 0 bytes pages by file count only.
         self.page_size = page_size
+        self.page_bytes = page_mb * 1024 * 1024
+        
+        # processing stops after the page that runs past this, the scheduler may shorten it.
+        self.time_limit = time_limit
+        
+        # the (estimated) bytes per second that pages are processed at, for their byte budget, see
+        # get_paginated_files_to_process.
+        self.page_bytes_per_second: float | None = None
+        self.file_size_estimates: dict[FileToProcessPK, int] = {}
+        
+        # number of pages to download ahead of processing, 0 processes pages serially.
+        self.pipeline_depth = pipeline_depth
+        
+        # files are downloaded on this thread pool if provided, otherwise one is created per page.
+        self.thread_pool = thread_pool
+        
+        # files are binned in a pool of this many processes, 0 bins them in this process.
+        self.binning_workers = binning_workers
+        
+        # uploaded chunks are cached on local disk, see FILE_PROCESS_CHUNK_CACHE_MB.
+        self.chunk_cache = chunk_cache if chunk_cache is not None else get_worker_chunk_cache()
+        
+        # new data for recent chunks may be written as segments, see FILE_PROCESS_CHUNK_SEGMENTS.
+        self.max_segments = max_segments
         
         # It is possible for devices to record data from unreasonable times, like the unix epoch
         # start. This heuristic is a safety measure to clear out bad data.
@@ -92,9 +223,30 @@ class FileProcessingTracker():
             int(mktime((timezone.now() + timedelta(days=90)).timetuple()))
         
         # a defaultdict of a tuple of 2 lists - this stores the data that is being processed.
-        self.all_binified_data: AllBinifiedData = defaultdict(lambda: ([], []))
+        # The rows lists can spill to disk, see enforce_memory_budget.
+        self.all_binified_data: AllBinifiedData = defaultdict(lambda: (SpillableRows(), []))
+        
+        # memory budget for binified data (in bytes, 0 disables), and the estimated size of each bin
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.binified_size_estimates: defaultdict[BinifyKey, int] = defaultdict(int)
+        self.binified_size_estimate = 0
+        
+        # metrics - the highest estimated size of binified data, and the number of bins spilled
+        self.binified_high_water_mark = 0
+        self.spill_count = 0
+        self.spilled_bytes = 0
         
         self.buggy_files = set[FileToProcessPK]()  # only used in logging
+        
+        # unchunkable files of the page, registered together after the page is binned.
+        self.unchunkable_files: list[UnchunkableFile] = []
+        
+        # changes in registered file sizes of unchunkable files, applied to the data quantity stats
+        # when the page is retired.  (Chunks update the stats when they are registered.)
+        self.data_quantity_changes: list[DataQuantityChange] = []
+        
+        # time spent in each stage and counters of a run, saved as a DataProcessingRun.
+        self.telemetry = Telemetry()
     
     #
     ## Outer Loop
@@ -112,6 +264,19 @@ class FileProcessingTracker():
         return dict(d)
     
     def get_paginated_files_to_process(self) -> Generator[list[FileToProcess], None, None]:
+        """ Yields the participant's files to process a page at a time, see the page size settings.
+        
+        Pages are filled up to the byte budget.  The time limit is only checked between pages, so
+        pages also shrink as it approaches: the time pages take gives a processing rate, and a page
+        is kept to a fraction of the time remaining at that rate.  This means a run ends with several
+        small pages rather than one huge page that overruns the time limit.
+        
+        Processed serially a page takes the time until the next page is requested.  Pipelined, the
+        next pages are requested while a page is processed, so that time says nothing about the page.
+        Instead the pipeline times the processing stage of each page on its own (binning and merging,
+        see process_user_file_chunks_pipelined).  That rate leaves out the downloads and uploads that
+        overlap with processing, when they are the slower stage it is optimistic, which the fraction
+        of the remaining time a page is kept to has to absorb. """
         # we want to be able to delete database objects at any time so we get the whole contents of
         # the query. The memory overhead is not very high, if it ever is change this to a query for
         # pks and then each pagination is a separate query. (only memory overhead matters.)
@@ -125,14 +290,64 @@ class FileProcessingTracker():
         
         logd("Number Files To Process:", len(pks))
         
-        # yield 100 files at a time
-        ret = []
-        for pk in pks:
-            ret.append(pk)
-            if len(ret) == self.page_size:
-                yield ret
-                ret = []
-        yield ret
+        if not self.page_bytes:
+            # yield 100 files at a time
+            ret = []
+            for pk in pks:
+                ret.append(pk)
+                if len(ret) == self.page_size:
+                    yield ret
+                    ret = []
+            yield ret
+            return
+        
+        if not pks:
+            yield []
+            return
+        
+        file_sizes = self.file_size_estimates = self.estimate_file_sizes(pks)
+        self.page_bytes_per_second = None
+        deadline = perf_counter() + self.time_limit.total_seconds()
+        i = 0
+        while i < len(pks):
+            page_budget = self.page_byte_budget(deadline - perf_counter(), self.page_bytes_per_second)
+            page, page_bytes = [], 0
+            while i < len(pks) and len(page) < self.page_size:
+                file_size = file_sizes[pks[i].pk]
+                if page and page_bytes + file_size > page_budget:
+                    break
+                page.append(pks[i])
+                page_bytes += file_size
+                i += 1
+            
+            logd(f"page of {len(page)} files, ~{page_bytes / 1024 / 1024:.1f} MB")
+            t_start = perf_counter()
+            yield page
+            if self.pipeline_depth == 0 and (elapsed := perf_counter() - t_start) > 0:
+                self.page_bytes_per_second = page_bytes / elapsed
+    
+    def estimate_file_sizes(self, ftps: list[FileToProcess]) -> dict[FileToProcessPK, int]:
+        """ The uncompressed size of each file, from the S3File table, or an estimate. """
+        paths = [ftp.s3_file_path + ".zst" for ftp in ftps]  # (match the S3File raw path with .zst)
+        known_sizes: dict[str, int] = {}
+        for i in range(0, len(paths), S3FILE_QUERY_BATCH_SIZE):
+            query = S3File.objects.filter(path__in=paths[i:i + S3FILE_QUERY_BATCH_SIZE]) \
+                .values_list("path", "size_uncompressed", "size_compressed")
+            for path, size_uncompressed, size_compressed in query:
+                if size_uncompressed is not None:
+                    known_sizes[path] = size_uncompressed
+                elif size_compressed is not None:
+                    known_sizes[path] = size_compressed * ESTIMATED_COMPRESSION_RATIO
+        
+        return {
+            ftp.pk: known_sizes.get(path, UNKNOWN_FILE_SIZE_ESTIMATE) for ftp, path in zip(ftps, paths)
+        }
+    
+    def page_byte_budget(self, remaining_seconds: float, bytes_per_second: float | None) -> int:
+        if bytes_per_second is None:  # the first page
+            return self.page_bytes
+        time_limited = int(bytes_per_second * max(remaining_seconds, 0) * PAGE_TIME_FRACTION)
+        return min(self.page_bytes, time_limited)
     
     def remove_already_purged_s3files(self):
         # paths may be removed from S3Files / S3 itself (usually because they are duplicates) but
@@ -181,8 +396,52 @@ class FileProcessingTracker():
         print(self.participant.files_to_process.filter(s3_file_path__in=paths_to_remove).delete())
     
     def process_user_file_chunks(self):
-        """ Call this function to process data for a participant. """
-        
+        """ Call this function to process data for a participant.  The run is recorded as a
+        DataProcessingRun, including when it raises an error. """
+        t_start = perf_counter()
+        reset_peak_memory()  # this run's own peak, not the worker process's
+        errored = True
+        try:
+            # all database operations happen on this thread, so this counts all of the run's queries.
+            with self.telemetry, connection.execute_wrapper(self.count_query):
+                if self.pipeline_depth > 0:
+                    self.process_user_file_chunks_pipelined()
+                else:
+                    self.process_user_file_chunks_serial()
+            errored = False
+        finally:
+            with self.error_handler:  # never hide the error of the run
+                self.record_run(perf_counter() - t_start, errored)
+    
+    def count_query(self, execute, sql, params, many, context):
+        count(QUERIES)
+        return execute(sql, params, many, context)
+    
+    def record_run(self, seconds: float, errored: bool) -> DataProcessingRun:
+        counters = self.telemetry.counters
+        stages = self.telemetry.rounded_stage_seconds()
+        memory_mb = peak_memory_mb()
+        logd(
+            f"processed {counters[FILES]} files ({counters[FAILED_FILES]} failed) in {seconds:.1f} "
+            f"seconds, {counters[QUERIES]} queries, peak memory {memory_mb:.0f} MB, stages: "
+            + ", ".join(f"{name} {stage_seconds}s" for name, stage_seconds in stages.items())
+        )
+        return DataProcessingRun.objects.create(
+            participant=self.participant,
+            seconds=seconds,
+            errored=errored,
+            files=counters[FILES],
+            failed_files=counters[FAILED_FILES],
+            file_bytes=counters[FILE_BYTES],
+            bytes_in=counters[BYTES_DOWNLOADED],
+            bytes_out=counters[BYTES_UPLOADED],
+            chunks=counters[CHUNKS],
+            queries=counters[QUERIES],
+            peak_memory_mb=round(memory_mb, 1),
+            stages=json.dumps(stages),
+        )
+    
+    def process_user_file_chunks_serial(self):
         start = timezone.now()  # one participant running too long looks like a down processing server
         
         survey_pk_lookup = dict(self.participant.study.surveys.values_list("object_id", "pk"))
@@ -190,10 +449,7 @@ class FileProcessingTracker():
         
         for page_of_ftps in self.get_paginated_files_to_process():
             
-            if (timezone.now() - start) > timedelta(minutes=29, seconds=30):
-                # case is 30 seconds under 30 minutes so that a big multihour hog will at least get
-                # rescheduled if it is running immediately after queueing.
-                logd("processing time exceeded 30 minutes, exiting early to be polite.")
+            if self.out_of_time(start):
                 return
             
             if not page_of_ftps:
@@ -211,36 +467,142 @@ class FileProcessingTracker():
             
             self.buggy_files = set()
     
+    def out_of_time(self, start: datetime) -> bool:
+        if (timezone.now() - start) > self.time_limit:
+            # case is 30 seconds under 30 minutes so that a big multihour hog will at least get
+            # rescheduled if it is running immediately after queueing.
+            logd(f"processing time exceeded {self.time_limit}, exiting early to be polite.")
+            return True
+        return False
+    
     def generate_FileForProcessing(self, ftp: FileToProcess) -> FileForProcessing:
         # We pass in the study in order to save a database query for the encryption key
         return FileForProcessing(ftp, self.study)
     
-    def do_process_user_file_chunks(self, files_to_process: list[FileToProcess]):
-        """ Run through the files to process, pull their data, sort data into time bins. Run the
-        file through the appropriate logic path based on file type. """
-        
+    def download_files(self, files_to_process: list[FileToProcess]) -> list[FileForProcessing]:
         # Threading this increases speed but increases memory usage.
         with Timer() as t:
-            files = list(s3_op_threaded_iterate(self.generate_FileForProcessing, files_to_process))
+            if self.thread_pool is None:
+                files = s3_op_threaded_iterate(self.generate_FileForProcessing, files_to_process)
+            else:
+                files = threadpool_iterate(self.thread_pool, self.generate_FileForProcessing, files_to_process)
         log(f"downloaded all files in {t.fseconds} for processing.")
-        
-        for file_for_processing in drain_in_reverse(files):
+        count(FILES, len(files))
+        count(FILE_BYTES, sum(len(f.file_contents) for f in files if f.file_contents is not None))
+        return files
+    
+    def binify_files(self, files: list[FileForProcessing]):
+        with stage(BINNING):
+            if self.binning_workers:
+                binned_files = self.bin_files_in_processes(files)
+            else:
+                binned_files = {}
+            
+            for file_for_processing in drain_in_reverse(files):
+                succeeded = False
+                with self.error_handler:
+                    pk = file_for_processing.file_to_process.pk
+                    if pk in binned_files:
+                        self.process_binned_file(file_for_processing, binned_files.pop(pk))
+                    else:
+                        self.process_one_file(file_for_processing)
+                    succeeded = True
+                if not succeeded:
+                    count(FAILED_FILES)
+            
+            unchunkable_count = len(self.unchunkable_files)
+            succeeded = False
             with self.error_handler:
-                self.process_one_file(file_for_processing)
-        del file_for_processing  # type: ignore - it will be bound
+                self.register_unchunkable_files()
+                succeeded = True
+            if not succeeded:
+                count(FAILED_FILES, unchunkable_count)
+    
+    def bin_files_in_processes(
+        self, files: list[FileForProcessing]
+    ) -> dict[FileToProcessPK, BinnedFile | Exception]:
+        """ Bins the chunkable files in the binning pool, one task per data stream, see
+        FILE_PROCESS_BINNING_WORKERS.  Returns the binned files (or their errors) by primary key,
+        the files' contents are cleared. """
+        streams: defaultdict[str, list[StreamFile]] = defaultdict(list)
+        for file_for_processing in files:
+            if file_for_processing.chunkable and not file_for_processing.exception:
+                ftp = file_for_processing.file_to_process
+                streams[file_for_processing.data_type].append(
+                    (ftp.pk, ftp.s3_file_path, ftp.os_type, file_for_processing.file_contents)
+                )
+                file_for_processing.clear_file_content()
+        
+        with Timer() as t:
+            futures = {}
+            stream_pks = {}
+            for data_type, stream_files in streams.items():
+                stream_pks[data_type] = [stream_file[0] for stream_file in stream_files]
+                try:
+                    pool = get_binning_pool(self.binning_workers)
+                    futures[data_type] = pool.submit(bin_stream_files, stream_files)
+                except Exception as e:
+                    # e.g. the pool could not start its processes, or is already broken.  The stream's
+                    # files fail below like those of a broken pool.
+                    futures[data_type] = Future()
+                    futures[data_type].set_exception(e)
+            streams.clear()  # the contents have been sent to the workers
+            
+            binned_files: dict[FileToProcessPK, BinnedFile | Exception] = {}
+            for data_type, future in futures.items():
+                try:
+                    binned_files.update(future.result())
+                except Exception as e:
+                    # e.g. a worker process died, which breaks the pool.  These files fail, and are
+                    # retried by the next run.
+                    shutdown_binning_pool()
+                    binned_files.update((pk, e) for pk in stream_pks[data_type])
+        log(f"binned {len(binned_files)} files of {len(futures)} data streams in worker processes in {t.fseconds}.")
+        return binned_files
+    
+    def process_binned_file(self, file_for_processing: FileForProcessing, binned_file: BinnedFile | Exception):
+        """ process_chunkable_file for a file binned in the binning pool. """
+        if isinstance(binned_file, Exception):
+            raise binned_file
+        
+        ftp = file_for_processing.file_to_process
+        if binned_file is None:
+            ftp.delete()  # delete empty files from FilesToProcess
+            return
+        
+        header, packed_bins = binned_file
+        data_type = file_for_processing.data_type
+        newly_binified_data: BinifyDict = {
+            (self.study_object_id, self.patient_id, data_type, time_bin, header): unpack_rows(packed_rows)
+            for time_bin, packed_rows in packed_bins.items()
+        }
+        self.append_binified_csvs(newly_binified_data, ftp)
+    
+    def do_process_user_file_chunks(self, files_to_process: list[FileToProcess]):
+        """ Run through the files to process, pull their data, sort data into time bins. Run the
+        file through the appropriate logic path based on file type. """
+        self.binify_files(self.download_files(files_to_process))
         
         # there are several failure modes and success modes, information for what to do with different
         # files percolates back to here.  Delete various database objects accordingly.
-        ftps_to_remove, bad_files, earliest_time_bin, latest_time_bin = self.upload_binified_data()
+        retirees = self.upload_binified_data()
+        self.binified_size_estimates.clear()  # all binified data has been consumed by the merge
+        self.binified_size_estimate = 0
+        self.retire_files(retirees, len(files_to_process) > 0)
+    
+    def retire_files(self, retirees: Retirees, processed_files: bool):
+        ftps_to_remove, bad_files, _, _ = retirees
         self.buggy_files.update(bad_files)
+        count(FAILED_FILES, len(bad_files))
         logd(f"Successfully processed {len(ftps_to_remove)} files ({self.participant.patient_id}), "
               f"there have been a total of {len(self.buggy_files)} failed files.")
         
-        # Update the data quantity stats (if it actually processed any files)
-        if len(files_to_process) > 0:
-            with Timer() as t:
-                calculate_data_quantity_stats(self.participant, earliest_time_bin, latest_time_bin)
-            log(f"FileProcessingCore: calculate_data_quantity_stats took {t.fseconds} seconds")
+        # Update the data quantity stats for unchunkable files (if it actually processed any files)
+        if processed_files and self.data_quantity_changes:
+            with Timer() as t, stage(STATS):
+                apply_data_quantity_changes(self.participant, self.data_quantity_changes)
+            log(f"FileProcessingCore: apply_data_quantity_changes took {t.fseconds} seconds")
+            self.data_quantity_changes = []
         
         # Actually delete the processed FTPs from the database now that we are done.
         FileToProcess.objects.filter(pk__in=ftps_to_remove).delete()
@@ -257,7 +619,7 @@ class FileProcessingTracker():
         else:
             self.process_unchunkable_file(file_for_processing)
     
-    def upload_binified_data(self) -> tuple[set[FileToProcessPK], set[FileToProcessPK], int|None, int|None]:
+    def upload_binified_data(self) -> Retirees:
         """ Takes in binified csv data and handles uploading/downloading+updating
             older data to/from S3 for each chunk.
             
@@ -265,9 +627,7 @@ class FileProcessingTracker():
             Returns a list of FTPs that failed.
             Returns the earliest and latest time bins handled. """
         # Track the earliest and latest time bins, to return them at the end of the function
-        merged_data = CsvMerger(
-            self.all_binified_data, self.error_handler, self.participant, self.survey_object_id, self.survey_pk
-        )
+        merged_data = self.merge_binified_data()
         # a failed upload will require the user gets rerun entirely.
         len_merged_data = len(merged_data.upload_these)
         with Timer() as t:
@@ -275,16 +635,39 @@ class FileProcessingTracker():
         log(f"FileProcessingCore: do_uploads took {t.fseconds} seconds for {len_merged_data} files")
         return merged_data.get_retirees()
     
+    def merge_binified_data(self) -> CsvMerger:
+        with stage(MERGE):
+            merged_data = CsvMerger(
+                self.all_binified_data,
+                self.error_handler,
+                self.participant,
+                self.survey_object_id,
+                self.survey_pk,
+                chunk_cache=self.chunk_cache,
+                max_segments=self.max_segments,
+            )
+        if self.chunk_cache is not None:
+            log(self.chunk_cache.report())
+        return merged_data
+    
     def do_uploads(self, merged_data: CsvMerger):
         # upload handler - used to be multithreaded, not doing that anymore for memory reasons.
-        
-        while True:
-            try:
+        # ChunkRegistries are written in bulk after the uploads, including when an upload fails, so
+        # that every chunk that made it to S3 is registered.
+        registrations: list[ChunkRegistration] = []
+        try:
+            while True:
+                try:
+                    uploadable = merged_data.upload_these.pop(-1)
+                except IndexError:
+                    break
                 # if the upload fails we simply error out and try again later in a separate run.
                 # The type definition of items in merged_data must match the do_upload function.
-                self.do_upload(*merged_data.upload_these.pop(-1))
-            except IndexError:
-                break
+                self.do_upload(*uploadable)
+                registrations.append((uploadable[0], uploadable[1], uploadable[5]))
+                del uploadable
+        finally:
+            self.register_chunks(registrations)
     
     def do_upload(
         self,
@@ -295,27 +678,214 @@ class FileProcessingTracker():
         size_uncompressed: int,
         create_new_chunk: bool,
     ):
-        """ Even if the upload succeeds and then something goes wrong with the database update,
+        """ Uploads a chunk, its ChunkRegistry is written by register_chunks afterwards.
+        Even if the upload succeeds and then something goes wrong with the database update,
         that's fine.  If there is an error it is raised and the FTP is not deleted.  The next time
         file processing runs it will duplicate work, but the code deduplicates output lines, so data
         remains intact. We briefly have a period where data size and hashes are off.  Tolerable. """
         
         # self.study saves a db query for the encryption key
+        upload_path = chunk_upload_path(chunk_path, chunk_kwargs)
         s3_upload_no_compression(
-            chunk_path,
+            upload_path,
             compressed_contents,
             self.study,
             size_uncompressed,
             sha1_hash,
             raw_path=True,
         )
-        
-        if create_new_chunk:  # validates, creates
-            ChunkRegistry.register_chunked_data(**chunk_kwargs)
-        else:  # update info about an existing ChunkRegistry
-            ChunkRegistry.objects.filter(chunk_path=chunk_path).update(
-                last_updated=timezone.now(), **chunk_kwargs
+        if self.chunk_cache is not None and upload_path == chunk_path:  # not segments
+            self.chunk_cache.put(chunk_path, sha1_hash, compressed_contents)
+        count(CHUNKS)
+    
+    def register_chunks(self, registrations: list[ChunkRegistration]):
+        """ Creates the new and updates the existing ChunkRegistries of a page, and applies the
+        change in their sizes to the data quantity stats, in one transaction.  Then deletes the
+        segments of rewritten chunks, which include them now. """
+        if not registrations:
+            return
+        rewritten_chunk_paths = [
+            chunk_path for chunk_kwargs, chunk_path, create_new_chunk in registrations
+            if not create_new_chunk and chunk_kwargs.get("segment_count") == 0
+        ]
+        replaced_segments: list[tuple[ChunkPath, int]] = []
+        with Timer() as t, stage(REGISTER), transaction.atomic():
+            if rewritten_chunk_paths:
+                replaced_segments = list(
+                    ChunkRegistry.objects.filter(chunk_path__in=rewritten_chunk_paths, segment_count__gt=0)
+                    .values_list("chunk_path", "segment_count")
+                )
+            file_size_changes = ChunkRegistry.bulk_register_chunked_data(
+                [chunk_kwargs for chunk_kwargs, _, create_new_chunk in registrations if create_new_chunk],
+                {
+                    chunk_path: chunk_kwargs
+                    for chunk_kwargs, chunk_path, create_new_chunk in registrations if not create_new_chunk
+                },
             )
+            with stage(STATS):
+                apply_data_quantity_changes(self.participant, file_size_changes)
+        log(f"FileProcessingCore: registered {len(registrations)} chunks in {t.fseconds} seconds")
+        
+        # only once the ChunkRegistries no longer refer to them, a failure leaves unused files.
+        for chunk_path, segment_count in replaced_segments:
+            with self.error_handler:
+                delete_chunk_segments(chunk_path, segment_count)
+    
+    def compact_chunk_segments(self):
+        """ Merges the segments of chunks that are old enough, see chunk_segments.py. """
+        with Timer() as t:
+            compacted = compact_chunk_segments(self.participant, self.error_handler)
+        if compacted:
+            logd(f"compacted the segments of {compacted} chunks in {t.fseconds} seconds.")
+    
+    #
+    ## Pipelined Processing
+    #
+    
+    # The pipeline runs the S3 network operations of three pages at once: page N+1 (and up to
+    # pipeline_depth pages) downloads on one thread, page N is binified and merged on this thread,
+    # and page N-1 uploads on another thread.  Memory is bounded by the number of pages in flight:
+    # downloads are only queued as pages are consumed, and only one page may be uploading, the
+    # next page blocks until it finishes.  All database operations happen on this thread (the
+    # background threads only touch S3), which keeps ChunkRegistry, S3File and FileToProcess
+    # updates in the same order as serial processing.
+    
+    def process_user_file_chunks_pipelined(self):
+        """ Pipelined version of process_user_file_chunks, see FILE_PROCESS_PIPELINE_DEPTH. """
+        
+        start = timezone.now()  # one participant running too long looks like a down processing server
+        
+        survey_pk_lookup = dict(self.participant.study.surveys.values_list("object_id", "pk"))
+        survey_pk_lookup[None] = None  # for non-survey ftps
+        
+        pages = self.get_paginated_files_to_process()
+        downloads: deque[Future[dict[SurveyObjectId, list[FileForProcessing]]]] = deque()
+        pending_upload: PendingUpload | None = None
+        
+        with ThreadPoolExecutor(1, "download_stage") as download_stage, \
+                ThreadPoolExecutor(1, "upload_stage") as upload_stage:
+            
+            def queue_downloads():
+                # backpressure - only download up to pipeline_depth pages ahead of processing.
+                while len(downloads) < self.pipeline_depth:
+                    page_of_ftps = next(pages, None)
+                    if page_of_ftps is None:
+                        return
+                    downloads.append(download_stage.submit(self.download_page, page_of_ftps))
+            
+            try:
+                queue_downloads()
+                while downloads:
+                    if self.out_of_time(start):
+                        return
+                    
+                    page_of_files = downloads.popleft().result()
+                    queue_downloads()
+                    
+                    if not page_of_files:
+                        logd("no more files to process for this participant.")
+                        continue
+                    logd(f"will process {sum(len(files) for files in page_of_files.values())} files.")
+                    page_bytes = sum(
+                        self.file_size_estimates.get(file_for_processing.file_to_process.pk, 0)
+                        for files in page_of_files.values() for file_for_processing in files
+                    )
+                    processing_seconds = 0.0  # this page's binning and merging, not the waits on other pages
+                    
+                    for survey_id, files in page_of_files.items():
+                        self.survey_object_id = survey_id
+                        self.survey_pk = survey_pk_lookup[survey_id]
+                        t_start = perf_counter()
+                        self.binify_files(files)
+                        processing_seconds += perf_counter() - t_start
+                        
+                        # if the uploading page has a chunk that this page merges into we need that
+                        # chunk to be uploaded and registered first.
+                        if pending_upload and not pending_upload[2].isdisjoint(self.binified_chunk_paths()):
+                            pending_upload, finish_this = None, pending_upload
+                            self.finish_pipelined_upload(finish_this)
+                        
+                        t_start = perf_counter()
+                        merged_data = self.merge_binified_data()
+                        processing_seconds += perf_counter() - t_start
+                        self.binified_size_estimates.clear()  # all binified data has been consumed by the merge
+                        self.binified_size_estimate = 0
+                        
+                        # backpressure - only one page uploads at a time.
+                        if pending_upload:
+                            pending_upload, finish_this = None, pending_upload
+                            self.finish_pipelined_upload(finish_this)
+                        pending_upload = self.start_pipelined_upload(upload_stage, merged_data)
+                    
+                    if processing_seconds > 0:
+                        self.page_bytes_per_second = page_bytes / processing_seconds
+                    self.buggy_files = set()
+            finally:
+                for download in downloads:  # don't wait on downloads we will never process
+                    download.cancel()
+                # uploads that complete must be registered, even if we are exiting with an error.
+                if pending_upload:
+                    self.finish_pipelined_upload(pending_upload)
+    
+    def download_page(self, page_of_ftps: list[FileToProcess]) -> dict[SurveyObjectId, list[FileForProcessing]]:
+        """ The download stage, runs on a background thread, must not touch the database. """
+        return {
+            survey_id: self.download_files(ftps)
+            for survey_id, ftps in self.filter_survey_ids(page_of_ftps).items()
+        }
+    
+    def binified_chunk_paths(self) -> set[ChunkPath]:
+        chunk_paths = set[ChunkPath]()
+        for study_object_id, patient_id, data_stream, time_bin, _ in self.all_binified_data:
+            try:
+                chunk_paths.add(construct_s3_chunk_path(
+                    study_object_id, patient_id, data_stream, time_bin, self.survey_object_id
+                ))
+            except ValueError:
+                continue  # handled in the CsvMerger
+        return chunk_paths
+    
+    def start_pipelined_upload(self, upload_stage: ThreadPoolExecutor, merged_data: CsvMerger) -> PendingUpload:
+        uploadables, merged_data.upload_these = merged_data.upload_these, []
+        chunk_paths = {uploadable[1] for uploadable in uploadables}
+        future = upload_stage.submit(self.do_pipelined_uploads, uploadables)
+        return future, merged_data.get_retirees(), chunk_paths
+    
+    def do_pipelined_uploads(self, uploadables: list[Uploadable]) -> list[UploadedChunk]:
+        """ The upload stage, runs on a background thread, must not touch the database. """
+        uploaded_chunks = []
+        with Timer() as t:
+            while uploadables:
+                chunk_kwargs, chunk_path, compressed_contents, sha1_hash, size_uncompressed, create_new_chunk = \
+                    uploadables.pop(-1)
+                upload_path = chunk_upload_path(chunk_path, chunk_kwargs)
+                storage = s3_upload_no_compression(
+                    upload_path,
+                    compressed_contents,
+                    self.study,
+                    size_uncompressed,
+                    sha1_hash,
+                    raw_path=True,
+                    defer_db_update=True,
+                )
+                if self.chunk_cache is not None and upload_path == chunk_path:  # not segments
+                    self.chunk_cache.put(chunk_path, sha1_hash, compressed_contents)
+                del compressed_contents
+                uploaded_chunks.append((storage, chunk_kwargs, chunk_path, create_new_chunk))
+                count(CHUNKS)
+        log(f"FileProcessingCore: pipelined uploads took {t.fseconds} seconds for {len(uploaded_chunks)} files")
+        return uploaded_chunks
+    
+    def finish_pipelined_upload(self, pending_upload: PendingUpload):
+        """ Waits for an upload to complete, then does the database operations of do_upload and
+        do_process_user_file_chunks for it. An upload error is raised here. """
+        future, retirees, _ = pending_upload
+        registrations: list[ChunkRegistration] = []
+        for storage, chunk_kwargs, chunk_path, create_new_chunk in future.result():
+            storage.update_s3_table()
+            registrations.append((chunk_kwargs, chunk_path, create_new_chunk))
+        self.register_chunks(registrations)
+        self.retire_files(retirees, True)
     
     #
     ## Chunkable File Processing
@@ -336,9 +906,34 @@ class FileProcessingTracker():
         """ Appends new binified rows to existing binified row data structure, in-place. """
         # data_bin: BinifyKey = study_object_id, patient_id, data_type, timecode int, header bytes
         for data_bin, rows in new_binified_rows.items():
+            size_estimate = estimate_rows_size(rows)
+            self.binified_size_estimates[data_bin] += size_estimate
+            self.binified_size_estimate += size_estimate
             self.all_binified_data[data_bin][0].extend(rows)  # Add data rows
             self.all_binified_data[data_bin][1].append(file_for_processing.pk)  # Add ftp
-        return
+        
+        self.binified_high_water_mark = max(self.binified_high_water_mark, self.binified_size_estimate)
+        self.enforce_memory_budget()
+    
+    def enforce_memory_budget(self):
+        """ If the estimated size of binified data is over the memory budget, spill the largest bins
+        to disk until we are down to half the budget (so that we don't spill on every new file).
+        Spilled rows are loaded back, one bin at a time, by the CsvMerger. """
+        if not self.memory_budget or self.binified_size_estimate <= self.memory_budget:
+            return
+        
+        target = self.memory_budget // 2
+        largest_first = sorted(self.binified_size_estimates.items(), key=lambda kv: kv[1], reverse=True)
+        for data_bin, size_estimate in largest_first:
+            if self.binified_size_estimate <= target:
+                break
+            rows: SpillableRows = self.all_binified_data[data_bin][0]  # type: ignore[assignment]
+            self.spilled_bytes += rows.spill()
+            self.spill_count += 1
+            self.binified_size_estimate -= size_estimate
+            self.binified_size_estimates[data_bin] = 0
+        
+        log(f"spilled binified data to disk, {self.spill_count} bins and {self.spilled_bytes} bytes so far.")
     
     def process_csv_data(self, file_for_processing: FileForProcessing) -> BinifyDict | None:
         """ Constructs a binified dict of a given list of a csv rows, catches csv files with known
@@ -362,61 +957,51 @@ class FileProcessingTracker():
             Sorts data points into the appropriate bin based on the rounded down hour
             value of the entry's unix(ish) timestamp. (based CHUNK_TIMESLICE_QUANTUM)
             Returns a dict of form {(study_id, patient_id, data_type, time_bin, header):rows_lists}. """
-        ret: BinifyDict = defaultdict(list)
-        for row in rows_list:
-            # August 7 2017, looks like there was an empty line at the end of a file? row was a ['']
-            if row and row[0]:
-                # this is the first thing that will hit corrupted timecode values errors (origin of which is unknown).
-                try:
-                    timecode = binify_from_timecode(row[0])
-                except BadTimecodeError:
-                    continue
-                ret[(self.study_object_id, self.patient_id, data_type, timecode, header)].append(row)
-        return ret
+        return {
+            (self.study_object_id, self.patient_id, data_type, timecode, header): rows
+            for timecode, rows in binify_rows(rows_list).items()
+        }
     
     #
     ## Unchunkable File Processing
     #
     
     def process_unchunkable_file(self, file_for_processing: FileForProcessing):
-        """ Processes a file that is not chunkable. Registers it in the ChunkRegistry directly."""
+        """ Processes a file that is not chunkable.  Queues it to be registered in the ChunkRegistry
+        with the rest of the page's unchunkable files, see register_unchunkable_files. """
+        ftp = file_for_processing.file_to_process
         try:
             # if the timecode is bad, we scrap this file. We just don't care.
-            timestamp = clean_java_timecode(
-                file_for_processing.file_to_process.s3_file_path.rsplit("/", 1)[-1][:-4]
-            )
+            timestamp = clean_java_timecode(ftp.s3_file_path.rsplit("/", 1)[-1][:-4])
         except BadTimecodeError:
-            file_for_processing.file_to_process.delete()
+            ftp.delete()
             return
         
-        # Since we aren't binning the data by hour, just create a ChunkRegistry that
-        # points to the already existing S3 file.
-        try:
-            ChunkRegistry.register_unchunked_data(
-                file_for_processing.data_type,
-                timestamp,
-                file_for_processing.file_to_process.s3_file_path,
-                file_for_processing.study.pk,
-                file_for_processing.file_to_process.participant.pk,
-                file_for_processing.file_contents,
+        # Since we aren't binning the data by hour, the ChunkRegistry just points to the already
+        # existing S3 file.  It is validated here so that a bad file fails on its own, not the page.
+        chunk = ChunkRegistry.build_unchunked_registration(
+            file_for_processing.data_type,
+            timestamp,
+            ftp.s3_file_path,
+            self.study.pk,
+            self.participant.pk,
+            len(file_for_processing.file_contents),
+        )
+        self.unchunkable_files.append((ftp.pk, chunk))
+    
+    def register_unchunkable_files(self):
+        """ Registers the queued unchunkable files in the ChunkRegistry and deletes their
+        FileToProcess objects, in one transaction.  Participants with continuous ambient audio
+        upload thousands of these files a day, this is a few queries per page instead of several
+        per file.  If it fails the files stay in FileToProcess and are retried by the next run. """
+        if not self.unchunkable_files:
+            return
+        unchunkable_files, self.unchunkable_files = self.unchunkable_files, []
+        
+        with Timer() as t, stage(REGISTER), transaction.atomic():
+            file_size_changes = ChunkRegistry.bulk_register_unchunked_data(
+                [chunk for _, chunk in unchunkable_files]
             )
-            file_for_processing.file_to_process.delete()
-        except ValidationError as ve:
-            if len(ve.messages) != 1:
-                # case: the error case (below) is very specific, we only want that singular error.
-                raise
-            
-            # case: an unchunkable file was re-uploaded, causing a duplicate file path collision
-            # we detect this specific case and update the registry with the new file size
-            # (hopefully it doesn't actually change)
-            if 'Chunk registry with this Chunk path already exists.' in ve.messages:
-                ChunkRegistry.update_registered_unchunked_data(
-                    file_for_processing.data_type,
-                    file_for_processing.file_to_process.s3_file_path,
-                    file_for_processing.file_contents,
-                )
-                file_for_processing.file_to_process.delete()
-            else:
-                # any other errors, add
-                raise
-        return
+            FileToProcess.objects.filter(pk__in=[pk for pk, _ in unchunkable_files]).delete()
+        self.data_quantity_changes.extend(file_size_changes)
+        log(f"FileProcessingCore: registered {len(unchunkable_files)} unchunkable files in {t.fseconds} seconds")
@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import json
+from collections.abc import Iterable
+from datetime import datetime, timedelta
+
+from django.db.models import BigIntegerField, Count, F, Min, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Concat
+from django.utils import timezone
+
+from database.models import DataProcessingSchedule, FileToProcess, S3File, Study
+from libs.file_processing.file_processing_core import (ESTIMATED_COMPRESSION_RATIO,
+    PROCESSING_TIME_LIMIT, UNKNOWN_FILE_SIZE_ESTIMATE)
+
+
+"""
+Data processing tasks are queued every 6 minutes, one participant at a time used to be queued in no
+particular order, and a few participants with huge backlogs (each task runs for up to 30 minutes)
+could hold every worker while thousands of participants with a few small files waited until their
+tasks expired.  The scheduler ranks participants with files to process by:
+    1) study priority - participants in active studies come before stopped or ended studies.
+    2) backlog size - small backlogs, then normal, then large, by the (estimated) bytes to process.
+    3) age - the participant with the oldest file waiting to be processed comes first.
+Participants with small backlogs are batched together into one task (they take seconds each, the
+fixed cost of a task dominates).  Participants with large backlogs are given a shorter time limit,
+so their backlog is processed over consecutive tasks, and the participants queued behind them on
+their worker get a turn in between.  Each run of the scheduler is recorded in DataProcessingSchedule.
+"""
+
+MB = 1024 * 1024
+
+# participants with less than this much data to process are batched together
+SMALL_BACKLOG_BYTES = 16 * MB
+BATCH_MAX_PARTICIPANTS = 25
+BATCH_MAX_BYTES = 128 * MB
+
+# participants with more than this much data to process get a shorter time limit
+LARGE_BACKLOG_BYTES = 2048 * MB
+LARGE_BACKLOG_TIME_LIMIT = timedelta(minutes=10)
+
+ACTIVE_STUDY_PRIORITY = 1
+STOPPED_STUDY_PRIORITY = 0
+
+SCHEDULE_RECORD_RETENTION = timedelta(days=7)
+
+# participant id, study priority, number of files, pending bytes, oldest file's creation time
+ParticipantBacklog = tuple[int, int, int, int, datetime]
+# participant ids, time limit
+ScheduledTask = tuple[list[int], timedelta]
+
+
+def get_participant_backlogs(exclude_participant_ids: Iterable[int] = ()) -> list[ParticipantBacklog]:
+    """ Summarizes the files to process of every participant that has any in one query.  File sizes
+    come from the S3File table, estimated the same way as pages of files to process. """
+    file_size = Subquery(
+        S3File.objects.filter(path=Concat(OuterRef("s3_file_path"), Value(".zst")))
+        .annotate(size=Coalesce(
+            "size_uncompressed",
+            F("size_compressed") * ESTIMATED_COMPRESSION_RATIO,
+            output_field=BigIntegerField(),
+        )).values("size")[:1]
+    )
+    file_size = Coalesce(file_size, Value(UNKNOWN_FILE_SIZE_ESTIMATE), output_field=BigIntegerField())
+    query = FileToProcess.objects.exclude(participant_id__in=list(exclude_participant_ids)) \
+        .values("participant_id", "participant__study_id") \
+        .annotate(
+            file_count=Count("id"),
+            pending_bytes=Sum(file_size),
+            oldest=Min("created_on"),
+        ).order_by() \
+        .values_list("participant_id", "participant__study_id", "file_count", "pending_bytes", "oldest")
+    
+    active_study_ids = {study.pk for study in Study.active_studies()}
+    return [
+        (
+            participant_id,
+            ACTIVE_STUDY_PRIORITY if study_id in active_study_ids else STOPPED_STUDY_PRIORITY,
+            file_count,
+            pending_bytes,
+            oldest,
+        )
+        for participant_id, study_id, file_count, pending_bytes, oldest in query
+    ]
+
+
+def backlog_size_class(pending_bytes: int) -> int:
+    if pending_bytes < SMALL_BACKLOG_BYTES:
+        return 0
+    if pending_bytes > LARGE_BACKLOG_BYTES:
+        return 2
+    return 1
+
+
+def rank_backlogs(backlogs: list[ParticipantBacklog]) -> list[ParticipantBacklog]:
+    # (participant id is the tie breaker so that the order is deterministic)
+    return sorted(backlogs, key=lambda b: (-b[1], backlog_size_class(b[3]), b[4], b[0]))
+
+
+def plan_processing_tasks(backlogs: list[ParticipantBacklog]) -> list[ScheduledTask]:
+    """ Ranks the backlogs and turns them into tasks, in the order they should be queued. """
+    tasks: list[ScheduledTask] = []
+    batch: list[int] = []
+    batch_bytes = 0
+    batch_priority = None
+    
+    # small backlogs are ranked first within their priority, so each priority's batches are queued
+    # before its other tasks, and batches never mix priorities.
+    for participant_id, priority, _, pending_bytes, _ in rank_backlogs(backlogs):
+        size_class = backlog_size_class(pending_bytes)
+        if batch and (
+            size_class != 0
+            or priority != batch_priority
+            or len(batch) == BATCH_MAX_PARTICIPANTS
+            or batch_bytes + pending_bytes > BATCH_MAX_BYTES
+        ):
+            tasks.append((batch, PROCESSING_TIME_LIMIT))
+            batch, batch_bytes = [], 0
+        
+        if size_class == 0:
+            batch.append(participant_id)
+            batch_bytes += pending_bytes
+            batch_priority = priority
+        elif size_class == 1:
+            tasks.append(([participant_id], PROCESSING_TIME_LIMIT))
+        else:
+            tasks.append(([participant_id], LARGE_BACKLOG_TIME_LIMIT))
+    
+    if batch:
+        tasks.append((batch, PROCESSING_TIME_LIMIT))
+    return tasks
+
+
+def record_schedule(
+    backlogs: list[ParticipantBacklog], tasks: list[ScheduledTask], already_running_count: int
+) -> DataProcessingSchedule:
+    """ Saves the scheduling decisions, and deletes old records. """
+    backlog_lookup = {backlog[0]: backlog for backlog in backlogs}
+    task_records = []
+    for participant_ids, time_limit in tasks:
+        task_backlogs = [backlog_lookup[participant_id] for participant_id in participant_ids]
+        task_records.append({
+            "participants": participant_ids,
+            "priority": max(b[1] for b in task_backlogs),
+            "files": sum(b[2] for b in task_backlogs),
+            "pending_bytes": sum(b[3] for b in task_backlogs),
+            "oldest": min(b[4] for b in task_backlogs).isoformat(),
+            "time_limit": int(time_limit.total_seconds()),
+        })
+    
+    DataProcessingSchedule.objects.filter(
+        created_on__lt=timezone.now() - SCHEDULE_RECORD_RETENTION
+    ).delete()
+    return DataProcessingSchedule.objects.create(
+        participant_count=len(backlogs),
+        task_count=len(tasks),
+        already_running_count=already_running_count,
+        pending_bytes=sum(b[3] for b in backlogs),
+        tasks=json.dumps(task_records),
+    )
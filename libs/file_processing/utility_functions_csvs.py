@@ -1,5 +1,6 @@
 import re
 from datetime import datetime
+from io import BytesIO
 
 from constants.common_constants import API_TIME_FORMAT, UTC
 
@@ -24,6 +25,35 @@ def existing_data_csv_splitter(file_bytes: bytes) -> tuple[bytes, list[list[byte
     return lines.pop(0), [line.split(b",", 1) for line in lines]
 
 
+# raw files are split into lines about this many bytes at a time, see split_csv_rows.
+SPLIT_BLOCK_SIZE = 1024 * 1024
+
+
+def split_csv_rows(file_contents: bytes, maxsplit: int = -1) -> tuple[bytes, list[list[bytes]]]:
+    """ Returns the header line and the rows of a csv, split on commas at most maxsplit times.  The
+    output is identical to:
+        lines = file_contents.splitlines()
+        lines.pop(0), [line.split(b",", maxsplit) for line in lines]
+    
+    That version holds the file, a list of every line, and the rows, all at once.  Here lines are
+    split out of a memoryview of the file a block (ending on a newline) at a time, so only one block
+    of lines exists at a time.  A maxsplit only separates the leading columns that processing looks
+    at, the rest of the line stays a single bytes object instead of one object per column.  Joining a
+    row with commas gives back its line either way. """
+    rows: list[list[bytes]] = []
+    extend = rows.extend
+    start, size = 0, len(file_contents)
+    with memoryview(file_contents) as view:
+        while start < size:
+            end = file_contents.find(b"\n", start + SPLIT_BLOCK_SIZE)
+            end = size if end == -1 else end + 1
+            extend([line.split(b",", maxsplit) for line in view[start:end].tobytes().splitlines()])
+            start = end
+    
+    # the header is on the first line, rejoin it
+    return b",".join(rows.pop(0)) if rows else b"", rows
+
+
 # keeping this around in case anyone encounters the bug in issue
 # https://github.com/onnela-lab/beiwe-backend/issues/373
 # def csv_to_list_of_list_of_bytes(file_bytes: bytes) -> tuple[bytes, list[list[bytes]]]:
@@ -105,9 +135,61 @@ def existing_data_csv_splitter(file_bytes: bytes) -> tuple[bytes, list[list[byte
 #     while lines:
 #         yield lines.pop(-1).split(b",")
 
+# rows sharing a timestamp are compared against a list until there are this many of them, then a set.
+TIMESTAMP_GROUP_SET_SIZE = 8
+
+
 def construct_csv_as_bytes(header: bytes, rows_list: list[list[bytes]]) -> bytes:
+    """ Takes a header list and a bytes-list and returns a single string of a csv, dropping
+    duplicate rows.
+    
+    Rows are almost always already sorted by timestamp, in which case a duplicate row can only be
+    adjacent to the other rows with its timestamp, so we only need to remember the distinct rows of
+    the current timestamp instead of every row of the chunk.  If the rows turn out not to be grouped
+    by timestamp we fall back to the set-of-all-rows version, output is identical either way. """
+    
+    output = BytesIO()
+    write = output.write  # micro optimizations
+    join = b",".join
+    write(header)
+    
+    current_timestamp = b""
+    timestamp_rows: list[bytes] | set[bytes] = []
+    
+    for row in rows_list:
+        joined_row = join(row)
+        timestamp = row[0] if row else b""
+        
+        if timestamp == current_timestamp:
+            if joined_row in timestamp_rows:
+                continue
+            if type(timestamp_rows) is list:
+                timestamp_rows.append(joined_row)
+                if len(timestamp_rows) == TIMESTAMP_GROUP_SET_SIZE:
+                    timestamp_rows = set(timestamp_rows)
+            else:
+                timestamp_rows.add(joined_row)  # type: ignore[union-attr]
+        else:
+            # timestamps are sorted as integers, which for digit strings is length-then-bytes order.
+            # Anything that goes backwards means a timestamp could reappear later, so we can't use
+            # the grouping.
+            if len(timestamp) < len(current_timestamp) or (
+                len(timestamp) == len(current_timestamp) and timestamp < current_timestamp
+            ):
+                return construct_csv_as_bytes_with_set(header, rows_list)
+            current_timestamp = timestamp
+            timestamp_rows = [joined_row]
+        
+        write(b"\n")
+        write(joined_row)
+    
+    return output.getvalue()
+
+
+def construct_csv_as_bytes_with_set(header: bytes, rows_list: list[list[bytes]]) -> bytes:
     """ Takes a header list and a bytes-list and returns a single string of a csv.
-        This has been optimized about as much as is possible for raw Python. """
+        This has been optimized about as much as is possible for raw Python, but it holds every
+        distinct row of the csv in a set, use construct_csv_as_bytes. """
     
     seen = set()          # track the presence of each row in a set
     seen_add = seen.add   # micro optimization for the add method (measurable improvement)
@@ -1,13 +1,30 @@
+from bisect import bisect_left, bisect_right
+from functools import partial
+from io import BytesIO
+from itertools import islice
+from operator import le
+from typing import NoReturn
+
+import numpy as np
+
 from constants import common_constants
 from constants.common_constants import EARLIEST_POSSIBLE_DATA_TIMESTAMP
 from constants.data_processing_constants import CHUNK_TIMESLICE_QUANTUM
 from constants.data_stream_constants import IDENTIFIERS, IOS_LOG_FILE, UPLOAD_FILE_TYPE_MAPPING
-from libs.file_processing.utility_functions_csvs import unix_time_to_string
+from libs.file_processing.utility_functions_csvs import (
+    construct_csv_as_bytes, TIMESTAMP_GROUP_SET_SIZE, unix_time_to_string)
 
 
 class BadTimecodeError(Exception): pass
 
 
+# The numpy versions of timestamp handling have some overhead, below this many rows the plain python
+# versions are faster.
+NUMPY_MIN_ROWS = 256
+MAX_NUMPY_TIMESTAMP_DIGITS = 18  # any 18 digit number fits in an int64
+MILLISECOND_STRINGS = [b".%03d" % i for i in range(1000)]
+
+
 def normalize_s3_file_path(s3_file_path: str) -> str:
     if "duplicate" in s3_file_path:
         # duplicate files are named blahblah/datastream/unixtime.csv-duplicate-[rando-string]
@@ -73,44 +90,307 @@ def ensure_sorted_by_timestamp(rows_of_lists_of_bytes: list[list[bytes]]):
     
     6) The `else None` is specific, None is not comparable via < with another None, which can
        occur if TWO values are non-digit strings. (there's a test)
+    
+    7) Data almost always arrives already sorted, or as a few sorted runs, so for 2+ rows we parse
+       the keys once, check whether they are already in order (one linear pass), and only sort if
+       they are not, see sort_rows_by_timestamp_numpy and sort_rows_by_timestamp_keys.  A bad row
+       is found while parsing the keys, before anything is modified.
     """
     
+    if len(rows_of_lists_of_bytes) >= NUMPY_MIN_ROWS and sort_rows_by_timestamp_numpy(rows_of_lists_of_bytes):
+        return
+    
+    if len(rows_of_lists_of_bytes) > 1:
+        sort_rows_by_timestamp_keys(rows_of_lists_of_bytes, timestamp_sort_keys(rows_of_lists_of_bytes))
+        return
+    
     try:
         # There is a type warning beecause `else None` is not an int - the type mixing is intentional
         rows_of_lists_of_bytes.sort(
             key=lambda row: int(bytes_item) if (bytes_item := row[0]).isdigit() else None  # type: ignore
         )
     except (AttributeError, TypeError) as e:
-        # this error is real hard to read, so let's make our lives easier:
-        for i, row in enumerate(rows_of_lists_of_bytes):
-            if not isinstance(row, (list, tuple)):
-                raise ValueError(f"invalid sort value in row {i}, `{row}`") from e
-            if not row:
-                raise ValueError(f"empty row at index {i}") from e
-            if not row[0]:
-                raise ValueError(f"falsey timestamp value in row {i}: `{row}`, {type(row[0])}") from e
-            if not isinstance(row[0], bytes):
-                raise ValueError(f"invalid sort value in row {i}, `{row}`, encountered {type(row[0])}") from e
-            if not row[0].isdigit():
-                raise ValueError(f"invalid sort value in row {i}, `{row}`") from e
-        raise  # raise other unexpected errors as normal
+        raise_sort_error(rows_of_lists_of_bytes, e)
+
+
+def raise_sort_error(rows_of_lists_of_bytes: list[list[bytes]], e: Exception) -> NoReturn:
+    """ Sort errors are real hard to read, so let's make our lives easier. Raises a ValueError
+    identifying the first bad row, or re-raises the original error. """
+    for i, row in enumerate(rows_of_lists_of_bytes):
+        if not isinstance(row, (list, tuple)):
+            raise ValueError(f"invalid sort value in row {i}, `{row}`") from e
+        if not row:
+            raise ValueError(f"empty row at index {i}") from e
+        if not row[0]:
+            raise ValueError(f"falsey timestamp value in row {i}: `{row}`, {type(row[0])}") from e
+        if not isinstance(row[0], bytes):
+            raise ValueError(f"invalid sort value in row {i}, `{row}`, encountered {type(row[0])}") from e
+        if not row[0].isdigit():
+            raise ValueError(f"invalid sort value in row {i}, `{row}`") from e
+    raise e  # raise other unexpected errors as normal
+
+
+def timestamp_sort_keys(rows_of_lists_of_bytes: list[list[bytes]]) -> list[int]:
+    """ Parses the timestamp (first) column of every row into a list of integers, the same key that
+    ensure_sorted_by_timestamp sorts on.  Raises the same ValueErrors on bad rows, but is stricter:
+    a single row with a non-digit timestamp also raises. """
+    keys: list[int] = []
+    keys_append = keys.append
+    try:
+        for row in rows_of_lists_of_bytes:
+            if not (bytes_item := row[0]).isdigit():
+                raise TypeError("non-digit timestamp")
+            keys_append(int(bytes_item))
+    except (AttributeError, TypeError, IndexError) as e:
+        raise_sort_error(rows_of_lists_of_bytes, e)
+    return keys
+
+
+def keys_are_sorted(keys: list[int]) -> bool:
+    """ A single linear pass, True if the keys are in ascending order. """
+    return all(map(le, keys, islice(keys, 1, None)))
+
+
+def sort_rows_by_timestamp_numpy(rows_of_lists_of_bytes: list[list[bytes]]) -> bool:
+    """ Stable in-place sort of rows with numpy-parsed timestamps, skipping the sort if the rows are
+    already in order. Returns False, without modifying the rows, if the timestamps are not all
+    digits of the same length, the python version handles those. """
+    try:
+        timestamps = [row[0] for row in rows_of_lists_of_bytes]
+    except (IndexError, TypeError):
+        return False
+    digits = timestamp_digits(timestamps)
+    if digits is None or not (digits <= 9).all():
+        return False
+    
+    keys = digits_to_int64(digits)
+    if (keys[1:] >= keys[:-1]).all():
+        return True
+    order = np.argsort(keys, kind="stable").tolist()
+    rows_of_lists_of_bytes[:] = [rows_of_lists_of_bytes[i] for i in order]
+    return True
+
+
+def sort_rows_by_timestamp_keys(rows_of_lists_of_bytes: list[list[bytes]], keys: list[int]):
+    """ Stable in-place sort of rows by their keys from timestamp_sort_keys, sorts the keys too.
+    
+    Skips sorting if the keys are already in order.  Otherwise the rows are sorted with the cached
+    keys: list.sort calls the key function exactly once per item, in order, so the key function can
+    just be the next item from the keys.  (This is much faster than parsing keys inside the sort.)
+    Python's sort detects already-sorted runs and merges them, so data that is a few sorted runs,
+    like concatenated files, sorts in close to linear time. """
+    if keys_are_sorted(keys):
+        return
+    rows_of_lists_of_bytes.sort(key=partial(next, iter(keys)))
+    keys.sort()
+
+
+def merge_sorted_rows_as_csv_bytes(
+    header: bytes, existing_rows: list[list[bytes]], new_rows: list[list[bytes]]
+) -> bytes:
+    """ Merges two lists of rows into a deduplicated csv.  The output is byte-identical to
+    concatenating the lists, sorting with ensure_sorted_by_timestamp, and calling
+    construct_csv_as_bytes - but without the O(n log n) sort or the combined list.
+    
+    Existing chunk data was written sorted, and new data almost always arrives sorted, so each side
+    gets a linear monotonicity check (and a real sort only if that fails), then we do a linear
+    two-way merge.  On timestamp ties existing rows come first, which matches the stable sort.
+    Duplicate rows necessarily have identical timestamps, so deduplication only holds the rows of
+    the current timestamp instead of the whole file, in a list that becomes a set past
+    TIMESTAMP_GROUP_SET_SIZE rows, as in construct_csv_as_bytes.
+    
+    Both row lists are cleared when this function returns. """
+    
+    # trivial cases skip the stricter key validation to match the original sort semantics exactly.
+    if len(existing_rows) + len(new_rows) <= 1:
+        existing_rows.extend(new_rows)
+        new_rows.clear()
+        ret = construct_csv_as_bytes(header, existing_rows)
+        existing_rows.clear()
+        return ret
+    
+    existing_keys = timestamp_sort_keys(existing_rows)
+    sort_rows_by_timestamp_keys(existing_rows, existing_keys)
+    new_keys = timestamp_sort_keys(new_rows)
+    sort_rows_by_timestamp_keys(new_rows, new_keys)
+    
+    output = BytesIO()
+    write = output.write
+    write(header)
+    join = b",".join
+    previous_key = None
+    previous_key_rows: list[bytes] | set[bytes] = []  # the (deduplicated) rows of the current timestamp
+    
+    def write_block(keys: list[int], rows: list[list[bytes]], start: int, stop: int):
+        nonlocal previous_key, previous_key_rows
+        for i in range(start, stop):
+            key, joined_row = keys[i], join(rows[i])
+            if key == previous_key:
+                if joined_row in previous_key_rows:
+                    continue
+                if type(previous_key_rows) is list:
+                    previous_key_rows.append(joined_row)
+                    if len(previous_key_rows) == TIMESTAMP_GROUP_SET_SIZE:
+                        previous_key_rows = set(previous_key_rows)
+                else:
+                    previous_key_rows.add(joined_row)  # type: ignore[union-attr]
+            else:
+                previous_key, previous_key_rows = key, [joined_row]
+            write(b"\n")
+            write(joined_row)
+    
+    # Merge by blocks: bisect finds the run of rows from one side that precede the next row of the
+    # other side, so the (usual) nearly-disjoint case is a couple of bisects and two long blocks.
+    # Existing rows win timestamp ties, hence bisect_right on existing and bisect_left on new.
+    i, j = 0, 0
+    len_existing, len_new = len(existing_rows), len(new_rows)
+    while i < len_existing and j < len_new:
+        stop = bisect_right(existing_keys, new_keys[j], i)
+        write_block(existing_keys, existing_rows, i, stop)
+        i = stop
+        if i == len_existing:
+            break
+        stop = bisect_left(new_keys, existing_keys[i], j)
+        write_block(new_keys, new_rows, j, stop)
+        j = stop
+    write_block(existing_keys, existing_rows, i, len_existing)
+    write_block(new_keys, new_rows, j, len_new)
+    
+    existing_rows.clear()
+    new_rows.clear()
+    return output.getvalue()
 
 
 def convert_unix_to_human_readable_timestamps(header: bytes, rows: list[list[bytes]]) -> bytes:
     """ Adds a new column to the end which is the unix time represented in
     a human readable time format.  Returns an appropriately modified header. """
-    for row in rows:
-        unix_millisecond = int(row[0])  # line can fail due to wrong os on the FileToProcess object.
-        time_string = unix_time_to_string(unix_millisecond // 1000)
-        # this line 0-pads millisecond values that have leading 0s.
-        time_string += b".%03d" % (unix_millisecond % 1000)
-        row.insert(1, time_string)
+    if len(rows) < NUMPY_MIN_ROWS or not insert_human_readable_timestamps_numpy(rows):
+        for row in rows:
+            unix_millisecond = int(row[0])  # line can fail due to wrong os on the FileToProcess object.
+            time_string = unix_time_to_string(unix_millisecond // 1000)
+            # this line 0-pads millisecond values that have leading 0s.
+            time_string += b".%03d" % (unix_millisecond % 1000)
+            row.insert(1, time_string)
     
     split_header: list[bytes] = header.split(b",")
     split_header.insert(1, b"UTC time")
     return b",".join(split_header)
 
 
+def insert_human_readable_timestamps_numpy(rows: list[list[bytes]]) -> bool:
+    """ The numpy version of the row loop in convert_unix_to_human_readable_timestamps, output is
+    identical. Parses the timestamp column in one go and formats each distinct second only once.
+    Returns False, without modifying the rows, if the timestamps are not all digits of the same
+    length, the python version handles (and raises the errors for) those. """
+    digits = timestamp_digits([row[0] for row in rows])
+    if digits is None or not (digits <= 9).all():
+        return False
+    
+    unix_milliseconds = digits_to_int64(digits)
+    unique_seconds, inverse = np.unique(unix_milliseconds // 1000, return_inverse=True)
+    second_strings = [unix_time_to_string(second) for second in unique_seconds.tolist()]
+    for row, second_index, millisecond in zip(rows, inverse.tolist(), (unix_milliseconds % 1000).tolist()):
+        row.insert(1, second_strings[second_index] + MILLISECOND_STRINGS[millisecond])
+    return True
+
+
+def binify_rows(rows: list[list[bytes]]) -> dict[int, list[list[bytes]]]:
+    """ Sorts rows into time bins by the unix(ish) timestamp in their first column, rows with bad
+    timecodes are dropped.  Returns the rows grouped by time bin, in their original order. """
+    # most files have a uniform numeric timestamp column, use the fast version when we can.
+    if len(rows) >= NUMPY_MIN_ROWS:
+        binned_rows = binify_rows_numpy(rows)
+        if binned_rows is not None:
+            return binned_rows
+    
+    ret: dict[int, list[list[bytes]]] = {}
+    for row in rows:
+        # August 7 2017, looks like there was an empty line at the end of a file? row was a ['']
+        if row and row[0]:
+            # this is the first thing that will hit corrupted timecode values errors (origin of which is unknown).
+            try:
+                timecode = binify_from_timecode(row[0])
+            except BadTimecodeError:
+                continue
+            if timecode in ret:
+                ret[timecode].append(row)
+            else:
+                ret[timecode] = [row]
+    return ret
+
+
+def binify_rows_numpy(rows: list[list[bytes]]) -> dict[int, list[list[bytes]]] | None:
+    """ The numpy version of binify_from_timecode over a list of rows, used by binify_rows.
+    Returns the rows grouped by time bin, in their original order, with bins in order of first
+    appearance, rows with bad timecodes are dropped.  Returns None if the first column is not all
+    bytes of the same length, the python version handles those. """
+    digits = timestamp_digits([row[0] if row else b"" for row in rows])
+    if digits is None:
+        return None
+    
+    # clean_java_timecode is int(timecode[:10]). A 10 character prefix containing a non-digit
+    # character can only ever parse as a number with 9 digits or fewer, which is always earlier
+    # than EARLIEST_POSSIBLE_DATA_TIMESTAMP, so any non-digit character means a bad timecode.
+    seconds_digits = digits[:, :10]
+    timestamps = digits_to_int64(seconds_digits)
+    valid = (seconds_digits <= 9).all(axis=1)
+    valid &= timestamps >= EARLIEST_POSSIBLE_DATA_TIMESTAMP
+    valid &= timestamps <= common_constants.LATEST_POSSIBLE_DATA_TIMESTAMP
+    
+    row_indexes = np.flatnonzero(valid)
+    time_bins = timestamps[row_indexes] // CHUNK_TIMESLICE_QUANTUM
+    
+    # a stable sort keeps rows in their original order inside each bin
+    order = np.argsort(time_bins, kind="stable")
+    time_bins = time_bins[order]
+    row_indexes = row_indexes[order]
+    starts = np.flatnonzero(np.diff(time_bins)) + 1
+    group_starts = [0] + starts.tolist()
+    group_ends = starts.tolist() + [len(time_bins)]
+    
+    # the first row of each bin is its earliest, sort bins by that to get order of first appearance.
+    groups = sorted(zip(group_starts, group_ends), key=lambda start_end: row_indexes[start_end[0]])
+    time_bins_list = time_bins.tolist()
+    row_indexes_list = row_indexes.tolist()
+    return {
+        time_bins_list[start]: [rows[i] for i in row_indexes_list[start:end]]
+        for start, end in groups if start < end
+    }
+
+
+def timestamp_digits(timestamps: list[bytes]) -> np.ndarray | None:
+    """ Converts a list of same-length byte strings (csv fields) into a 2d array of their character
+    values minus ord("0"), so digits are 0-9 and every other character is larger than 9. Returns
+    None if the values are not all bytes of the same length (up to MAX_NUMPY_TIMESTAMP_DIGITS). """
+    if not timestamps:
+        return None
+    width = len(timestamps[0])
+    if not 0 < width <= MAX_NUMPY_TIMESTAMP_DIGITS:
+        return None
+    try:
+        joined = b",".join(timestamps) + b","
+    except TypeError:
+        return None  # not bytes
+    
+    # csv fields can't contain commas, so if every comma is at the end of a row of width + 1
+    # characters then every value has exactly this width.
+    if len(joined) != len(timestamps) * (width + 1):
+        return None
+    characters = np.frombuffer(joined, dtype=np.uint8).reshape(len(timestamps), width + 1)
+    if not (characters[:, width] == ord(",")).all():
+        return None
+    return characters[:, :width] - np.uint8(ord("0"))
+
+
+def digits_to_int64(digits: np.ndarray) -> np.ndarray:
+    """ Converts a 2d array of digits, from timestamp_digits, into an array of integers. """
+    ret = np.zeros(digits.shape[0], dtype=np.int64)
+    for column in digits.T:
+        ret *= 10
+        ret += column
+    return ret
+
+
 def binify_from_timecode(unix_ish_time_code_string: bytes | str) -> int:
     """ Takes a unix-ish time code (accepts unix millisecond), and returns an
         integer value of the bin it should go in. """
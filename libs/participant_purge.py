@@ -6,6 +6,7 @@ from django.utils import timezone
 from constants import action_log_messages
 from constants.common_constants import CHUNKS_FOLDER, PROBLEM_UPLOADS
 from database.user_models_participant import Participant, ParticipantDeletionEvent
+from libs.rsa import ParticipantKeyCache
 from libs.s3 import s3_delete_many_versioned, s3_list_files, s3_list_versions
 from libs.utils.security_utils import generate_easy_alphanumeric_string
 
@@ -41,6 +42,7 @@ RELATED_NAMES = [
     "app_version_history",
     "notification_reports",
     "s3_files",
+    "data_processing_runs",
 ]
 
 
@@ -72,6 +74,7 @@ def run_next_queued_participant_data_deletion():
     participant.set_password(generate_easy_alphanumeric_string(50))
     
     delete_participant_data(deletion_event)
+    ParticipantKeyCache.invalidate(participant.patient_id)  # its keys were deleted
     # A meta test that checks that a test for every single related field is present will fail
     # whenever a new relation is added. You have to manually make that test.
     for name in RELATED_NAMES:
@@ -1,5 +1,10 @@
+import threading
+from collections import OrderedDict
+from time import perf_counter
+
 from Cryptodome.PublicKey import RSA
 
+from config.settings import PARTICIPANT_KEY_CACHE_SECONDS, PARTICIPANT_KEY_CACHE_SIZE
 from constants.security_constants import ASYMMETRIC_KEY_LENGTH
 
 
@@ -36,6 +41,7 @@ def create_participant_key_pair(patient_id: str, study_id: str):
     public, private = generate_key_pairing()
     s3_upload("keys/" + patient_id + "_private", private, study_id)
     s3_upload("keys/" + patient_id + "_public", public, study_id)
+    ParticipantKeyCache.invalidate(patient_id)
 
 
 def get_participant_public_key_string(patient_id: str, study_id: str) -> str:
@@ -53,10 +59,67 @@ def get_participant_public_key(patient_id: str, study_id: str) -> RSA.RsaKey:
 
 
 def get_participant_private_key(patient_id: str, study_id: str) -> RSA.RsaKey:
-    """Grabs a user's private key file from s3."""
-    from libs.s3 import s3_retrieve
-    key = s3_retrieve("keys/" + patient_id + "_private", study_id)
-    return get_RSA_cipher(key)
+    """Grabs a user's private key file from s3, unless it is in the ParticipantKeyCache."""
+    key = ParticipantKeyCache.get(patient_id, study_id)
+    if key is None:
+        from libs.s3 import s3_retrieve
+        key = get_RSA_cipher(s3_retrieve("keys/" + patient_id + "_private", study_id))
+        ParticipantKeyCache.put(patient_id, study_id, key)
+    return key
+
+
+# A participant's cached private key: expiry (a perf_counter time), study object id, the key
+CachedPrivateKey = tuple[float, str, RSA.RsaKey]
+
+
+class ParticipantKeyCache:
+    """ A process-wide cache of participants' imported private keys, by patient id, so that the
+    uploads of a participant don't each download (and decrypt, and import) the participant's key.
+    Keys expire after PARTICIPANT_KEY_CACHE_SECONDS, there are at most PARTICIPANT_KEY_CACHE_SIZE of
+    them (least recently used keys are dropped first).
+    
+    Safe under threads (gunicorn gthread workers), imported keys are only read.  The lock is not held
+    while a key is downloaded, so threads that miss on the same participant at once each download
+    it, a participant's uploads are mostly sequential. """
+    
+    lock = threading.Lock()
+    keys: OrderedDict[str, CachedPrivateKey] = OrderedDict()
+    
+    @classmethod
+    def get(cls, patient_id: str, study_id: str) -> RSA.RsaKey | None:
+        if PARTICIPANT_KEY_CACHE_SECONDS <= 0 or PARTICIPANT_KEY_CACHE_SIZE <= 0:
+            return None  # disabled, don't serialize lookups on the lock
+        with cls.lock:
+            cached = cls.keys.get(patient_id)
+            if cached is None:
+                return None
+            expiry, study_object_id, key = cached
+            if perf_counter() >= expiry or study_object_id != study_id:
+                del cls.keys[patient_id]
+                return None
+            cls.keys.move_to_end(patient_id)
+            return key
+    
+    @classmethod
+    def put(cls, patient_id: str, study_id: str, key: RSA.RsaKey):
+        if PARTICIPANT_KEY_CACHE_SECONDS <= 0 or PARTICIPANT_KEY_CACHE_SIZE <= 0:
+            return  # disabled
+        with cls.lock:
+            cls.keys[patient_id] = (perf_counter() + PARTICIPANT_KEY_CACHE_SECONDS, study_id, key)
+            cls.keys.move_to_end(patient_id)
+            while len(cls.keys) > PARTICIPANT_KEY_CACHE_SIZE:
+                cls.keys.popitem(last=False)
+    
+    @classmethod
+    def invalidate(cls, patient_id: str):
+        """ Only invalidates this process's cache, other processes see changes when theirs expire. """
+        with cls.lock:
+            cls.keys.pop(patient_id, None)
+    
+    @classmethod
+    def clear(cls):
+        with cls.lock:
+            cls.keys.clear()
 
 
 # pycryptodome: the following is correct for PKCS1_OAEP.
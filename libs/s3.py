@@ -1,8 +1,11 @@
 from __future__ import annotations
 
 import hashlib
+import threading
 from collections.abc import Generator
+from io import BufferedReader, BytesIO, RawIOBase
 from os.path import join as path_join
+from time import perf_counter
 from typing import TYPE_CHECKING
 from unittest.mock import MagicMock
 
@@ -11,11 +14,12 @@ import botocore
 from botocore.client import BaseClient
 from botocore.exceptions import ClientError as Boto3ClientError
 from botocore.paginate import Paginator
+from botocore.response import StreamingBody
 from cronutils import ErrorHandler
 from django.utils import timezone
 
 from config.settings import (BEIWE_SERVER_AWS_ACCESS_KEY_ID, BEIWE_SERVER_AWS_SECRET_ACCESS_KEY,
-    S3_BUCKET, S3_ENDPOINT, S3_REGION_NAME)
+    S3_BUCKET, S3_ENDPOINT, S3_REGION_NAME, STUDY_KEY_CACHE_SECONDS)
 from constants.common_constants import (CHUNKS_FOLDER, CUSTOM_ONDEPLOY_PREFIX, PROBLEM_UPLOADS,
     RUNNING_TESTS)
 from constants.s3_constants import (BAD_FOLDER, BAD_FOLDER_2, BadS3PathException, Boto3Response,
@@ -26,8 +30,12 @@ from constants.s3_constants import (BAD_FOLDER, BAD_FOLDER_2, BadS3PathException
     UNCOMPRESSED_DATA_MISSING_AT_COMPRESSION, UNCOMPRESSED_DATA_MISSING_ON_POP,
     UNCOMPRESSED_DATA_PRESENT_ON_ASSIGNMENT, UNCOMPRESSED_DATA_PRESENT_ON_DOWNLOAD,
     UNCOMPRESSED_DATA_PRESENT_WRONG_AT_UPLOAD)
-from libs.aes import decrypt_server, encrypt_for_server
-from libs.utils.compression import compress, decompress
+from libs.aes import (decrypt_server, encrypt_for_server, encrypt_for_server_into, encrypted_size,
+    is_legacy_server_encryption, ServerDecryptor)
+from libs.utils.compression import (compress, decompress, decompress_into, decompressed_size,
+    decompressing_reader)
+from libs.utils.telemetry import (BYTES_DOWNLOADED, BYTES_UPLOADED, COMPRESS, count, DECOMPRESS,
+    DECRYPT, DOWNLOAD, ENCRYPT, stage, UPLOAD)
 
 
 ## This file must be near-globally importable, including inside db models; so these imports fail.
@@ -66,14 +74,79 @@ class DataException(Exception): pass
 ## Smart Key and Path Getters
 #
 
+# A study's cached values: expiry (a perf_counter time), primary key, object id, encryption key
+CachedStudyKey = tuple[float, int, str, bytes]
+
+
+class StudyKeyCache:
+    """ A process-wide cache of the encryption key and object id of each study, by primary key and
+    by object id, so that S3 operations on a study's files look the study up once per process, not
+    once per file.  Values expire after STUDY_KEY_CACHE_SECONDS, and Study.save invalidates them.
+    
+    Safe under threads (gunicorn gthread workers, Celery thread pools): hits don't take the lock, a
+    miss takes it and checks again before looking the study up, so threads that miss on the same
+    study wait for the one lookup instead of all querying the database. """
+    
+    lock = threading.Lock()
+    by_pk: dict[int, CachedStudyKey] = {}
+    by_object_id: dict[str, CachedStudyKey] = {}
+    
+    @classmethod
+    def get_by_pk(cls, study_pk: int) -> CachedStudyKey:
+        return cls._get(cls.by_pk, "pk", study_pk)
+    
+    @classmethod
+    def get_by_object_id(cls, object_id: str) -> CachedStudyKey:
+        return cls._get(cls.by_object_id, "object_id", object_id)
+    
+    @classmethod
+    def _get(cls, cache: dict, field_name: str, value: int | str) -> CachedStudyKey:
+        if STUDY_KEY_CACHE_SECONDS <= 0:  # disabled, don't serialize lookups on the lock
+            pk, object_id, encryption_key = cls.lookup(**{field_name: value})
+            return (perf_counter(), pk, object_id, encryption_key.encode())
+        
+        cached = cache.get(value)
+        if cached is not None and perf_counter() < cached[0]:
+            return cached
+        
+        with cls.lock:
+            cached = cache.get(value)  # another thread may have looked it up while we waited
+            if cached is not None and perf_counter() < cached[0]:
+                return cached
+            pk, object_id, encryption_key = cls.lookup(**{field_name: value})
+            cached = (perf_counter() + STUDY_KEY_CACHE_SECONDS, pk, object_id, encryption_key.encode())
+            cls.by_pk[pk] = cached
+            cls.by_object_id[object_id] = cached
+            return cached
+    
+    @staticmethod
+    def lookup(**filters) -> tuple[int, str, str]:
+        from database.models import Study
+        return Study.fltr(**filters).values_list("pk", "object_id", "encryption_key").get()
+    
+    @classmethod
+    def invalidate(cls, study_pk: int):
+        """ Only invalidates this process's cache, other processes see changes when theirs expire. """
+        with cls.lock:
+            cached = cls.by_pk.pop(study_pk, None)
+            if cached is not None:
+                cls.by_object_id.pop(cached[2], None)
+    
+    @classmethod
+    def clear(cls):
+        with cls.lock:
+            cls.by_pk.clear()
+            cls.by_object_id.clear()
+
+
 def smart_get_study_encryption_key(obj: StrPartStudy) -> bytes:
     from database.models import Participant, Study
     if isinstance(obj, Participant):
-        return Study.value_get("encryption_key", pk=obj.study_id).encode()
+        return StudyKeyCache.get_by_pk(obj.study_id)[3]
     elif isinstance(obj, Study):
         return obj.encryption_key.encode()
     elif isinstance(obj, str) and len(obj) == 24:
-        return Study.value_get("encryption_key", object_id=obj).encode()
+        return StudyKeyCache.get_by_object_id(obj)[3]
     else:
         raise TypeError(SMART_GET_ERROR.format(type(obj)))
 
@@ -85,7 +158,7 @@ def s3_construct_study_key_path(key_path: str, obj: StrPartStudy) -> str:
 def get_just_prefix(obj: StrPartStudy) -> str:
     from database.models import Participant, Study
     if isinstance(obj, Participant):
-        return Study.value_get("object_id", pk=obj.study_id)
+        return StudyKeyCache.get_by_pk(obj.study_id)[2]
     elif isinstance(obj, Study):
         return obj.object_id
     elif isinstance(obj, str) and len(obj) == 24:  # extremely basic check
@@ -207,11 +280,12 @@ class S3Storage:
         self.compress_data_and_clear_uncompressed()
         self._s3_upload_zst()
     
-    def push_to_storage_precompressed_and_clear_memory(self):
+    def push_to_storage_precompressed_and_clear_memory(self, defer_db_update: bool = False):
         # when you have populated compressed_data in memory and want to push to s3
+        # (defer_db_update: the caller must call update_s3_table, e.g. from a thread without db access)
         assert hasattr(self, "compressed_data"), COMPRESSED_DATA_MISSING_AT_UPLOAD
         assert not hasattr(self, "uncompressed_data"), UNCOMPRESSED_DATA_PRESENT_WRONG_AT_UPLOAD
-        self._s3_upload_zst()
+        self._s3_upload_zst(defer_db_update)
         del self.compressed_data
     
     ## Compression
@@ -228,7 +302,8 @@ class S3Storage:
         self.metadata.size_uncompressed = len(self.uncompressed_data)
         # sha1 is twice as fast as md5, it is 20 bytes, we care about speed here.
         self.metadata.sha1 = hashlib.sha1(self.uncompressed_data).digest()
-        self.compressed_data = compress(self.uncompressed_data)
+        with stage(COMPRESS):
+            self.compressed_data = compress(self.uncompressed_data)
         self.metadata.size_compressed = len(self.compressed_data)
     
     ## Download
@@ -255,9 +330,26 @@ class S3Storage:
     def _download_decompress_clearing_compressed(self):
         # This line should be the error on when there is no compressed copy
         self.compressed_data = self._s3_retrieve_zst_and_profile()
-        self.uncompressed_data = decompress(self.compressed_data)
+        with stage(DECOMPRESS):
+            self.uncompressed_data = self._decompress_clearing_compressed()
         self.metadata.size_uncompressed = len(self.uncompressed_data)
+    
+    def _decompress_clearing_compressed(self) -> bytes:
+        # decompress briefly holds over twice the uncompressed size (and the compressed data), this
+        # decompresses into a buffer and clears the compressed data before the copy to bytes, so
+        # there are at most two copies of the uncompressed size.
+        size = decompressed_size(self.compressed_data)
+        if size is not None:
+            buffer = bytearray(size)
+            try:
+                decompress_into(self.compressed_data, buffer)
+                del self.compressed_data
+                return bytes(buffer)
+            except ValueError:
+                del buffer  # more than one zstd frame, the header only has the size of the first
+        uncompressed_data = decompress(self.compressed_data)
         del self.compressed_data
+        return uncompressed_data
     
     ## Download-Rewrite
     
@@ -271,6 +363,50 @@ class S3Storage:
         self._s3_delete_uncompressed()
         return raw_data
     
+    ## Streaming Download
+    
+    def open_zst_stream(self) -> BufferedReader:
+        """ Opens the compressed file as a file-like object of its uncompressed contents, which
+        downloads, decrypts and decompresses the file in blocks as it is read.  Raises
+        NoSuchKeyException if there is no compressed file.  Close it when done, it holds the
+        connection. """
+        key = self.encryption_key  # may have network/db op
+        with stage(DOWNLOAD):
+            response = _do_retrieve(self.s3_path_zst)
+        raw = S3DecryptingReader(response["Body"], key)
+        return BufferedReader(S3DecompressingReader(raw), S3_STREAM_BLOCK_SIZE)
+    
+    ## Re-encryption
+    
+    def reencrypt_legacy_zst(self) -> bool:
+        """ Rewrites the compressed file in the current server encryption format if it is in the
+        legacy format, returns whether it was rewritten.  The contents don't change, so neither does
+        the S3File entry.  The upload only succeeds if the file has not changed since the download,
+        e.g. a chunk that data processing merged new data into, that write used the current format. """
+        key = self.encryption_key  # may have network/db op
+        response = _do_retrieve(self.s3_path_zst)
+        data = response["Body"].read()
+        if not is_legacy_server_encryption(data):
+            return False
+        
+        compressed_data = decrypt_server(data, key)
+        del data
+        # CFB decrypts anything, check that it is what we uploaded before we overwrite it
+        if not compressed_data.startswith(b'(\xb5/\xfd'):
+            raise DataException(f"`{self.s3_path_zst}` did not decrypt to zstd data")
+        encrypted_compressed_data = encrypt_for_server(compressed_data, key)
+        del compressed_data
+        
+        try:
+            conn.put_object(
+                Body=encrypted_compressed_data, Bucket=S3_BUCKET, Key=self.s3_path_zst, IfMatch=response["ETag"]
+            )
+        except Boto3ClientError as e:
+            if e.response['Error']['Code'] == 'PreconditionFailed':
+                return False
+            raise
+        return True
+    
     #
     ## DB ops
     #
@@ -302,8 +438,7 @@ class S3Storage:
         from database.models import S3File
         S3File.fltr(path=self.s3_path_zst).delete()  # can't actually fail
     
-    # (these cached properties may need network/db ops)
-    # Todo: cache for real? do we want to cache the encryption keys globally?
+    # (these cached properties may need db ops, see StudyKeyCache)
     
     @property
     def encryption_key(self) -> bytes:
@@ -334,24 +469,31 @@ class S3Storage:
     
     ## Upload
     
-    def _s3_upload_zst(self):
+    def _s3_upload_zst(self, defer_db_update: bool = False):
         """ Manually manage these memory/reference count operations.  It matters.
         This is a critical performance path. DO NOT separate into further functions calls without
         profiling memory usage. """
         self.metadata_asserts()
         assert not self.metadata_committed, "you cannot reuse an S3Storage object"
         
-        encrypted_compressed_data = encrypt_for_server(self.compressed_data, self.encryption_key)
+        with stage(ENCRYPT):  # into a buffer, encrypt_for_server briefly holds two encrypted copies
+            encrypted_compressed_data = bytearray(encrypted_size(len(self.compressed_data)))
+            encrypt_for_server_into(self.compressed_data, self.encryption_key, encrypted_compressed_data)
         
-        _do_upload(self.s3_path_zst, encrypted_compressed_data)  # probable 2x memory usage
+        with stage(UPLOAD):
+            _do_upload(self.s3_path_zst, encrypted_compressed_data)  # probable 2x memory usage
+        count(BYTES_UPLOADED, len(encrypted_compressed_data))
         del encrypted_compressed_data  # remove copy asap
         
-        self.update_s3_table()
+        if not defer_db_update:
+            self.update_s3_table()
     
     ## Retrieve
     
     def _s3_retrieve_uncompressed(self) -> bytes:
-        return decrypt_server(self._raw_s3_retrieve(self.s3_path_uncompressed), self.encryption_key)
+        data = self._raw_s3_retrieve(self.s3_path_uncompressed)
+        with stage(DECRYPT):
+            return decrypt_server(data, self.encryption_key)
     
     def _s3_retrieve_zst_and_profile(self) -> bytes:
         key = self.encryption_key  # may have network/db op
@@ -362,14 +504,77 @@ class S3Storage:
             self.delete_s3_table_entry()  # if it doesn't exist, delete the entry in the database
             raise
         
-        ret = decrypt_server(data, key)
+        with stage(DECRYPT):
+            ret = decrypt_server(data, key)
         self.metadata.size_compressed = len(ret)  # after decryption, no iv or padding
         del data
         
         return ret
     
     def _raw_s3_retrieve(self, path: str) -> bytes:
-        return _do_retrieve(path).pop("Body").read()
+        with stage(DOWNLOAD):
+            data = _do_retrieve(path).pop("Body").read()
+        count(BYTES_DOWNLOADED, len(data))
+        return data
+
+
+#
+## Streaming readers
+#
+
+S3_STREAM_BLOCK_SIZE = 1024 * 1024
+
+
+class S3DecryptingReader:
+    """ Reads an encrypted S3 response body in blocks and decrypts each block as it arrives.  The
+    read of the last block raises a ValueError if the data doesn't verify, see ServerDecryptor. """
+    
+    def __init__(self, body: StreamingBody, encryption_key: bytes):
+        self.body = body
+        self.decryptor = ServerDecryptor(encryption_key)
+        self.finished = False
+    
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(S3_STREAM_BLOCK_SIZE), b""))
+        # the decryptor may hold back the end of a block, read until there is something to return
+        while not self.finished:
+            with stage(DOWNLOAD):
+                block = self.body.read(size)
+            count(BYTES_DOWNLOADED, len(block))
+            with stage(DECRYPT):
+                if block:
+                    plaintext = self.decryptor.update(block)
+                else:
+                    self.finished = True
+                    plaintext = self.decryptor.finalize()
+            if plaintext:
+                return plaintext
+        return b""
+    
+    def close(self):
+        self.body.close()
+
+
+class S3DecompressingReader(RawIOBase):
+    """ The raw stream of S3Storage.open_zst_stream, decompresses the decrypted blocks. """
+    
+    def __init__(self, decrypting_reader: S3DecryptingReader):
+        self.decrypting_reader = decrypting_reader
+        self.zstd_file = decompressing_reader(decrypting_reader)
+    
+    def readable(self) -> bool:
+        return True
+    
+    def readinto(self, buffer) -> int:
+        with stage(DECOMPRESS):  # (the download and decryption stages inside it are timed separately)
+            return self.zstd_file.readinto(buffer)
+    
+    def close(self):
+        if not self.closed:
+            self.zstd_file.close()
+            self.decrypting_reader.close()
+        super().close()
 
 
 #
@@ -402,10 +607,19 @@ def s3_upload(
 
 
 def s3_upload_no_compression(
-    key_path: str, data: bytes, obj: StrPartStudy, size_uncompressed: int, sha1: bytes, raw_path=False,
-):
+    key_path: str,
+    data: bytes,
+    obj: StrPartStudy,
+    size_uncompressed: int,
+    sha1: bytes,
+    raw_path=False,
+    defer_db_update=False,
+) -> S3Storage:
+    """ When defer_db_update is True the S3File table is not updated, the caller must call
+    update_s3_table on the returned S3Storage. """
     storage = S3Storage(key_path, obj, raw_path).set_file_content_precompressed(data, size_uncompressed, sha1)
-    storage.push_to_storage_precompressed_and_clear_memory()
+    storage.push_to_storage_precompressed_and_clear_memory(defer_db_update)
+    return storage
 
 
 def s3_upload_plaintext(upload_path: str, data_string: bytes) -> None:
@@ -436,6 +650,19 @@ def s3_retrieve(key_path: str, obj: StrPartStudy, raw_path: bool = False, number
     return S3Storage(key_path, obj, raw_path).download().pop_uncompressed_file_content()
 
 
+def s3_open(key_path: str, obj: StrPartStudy, raw_path: bool = False) -> BufferedReader | BytesIO:
+    """ Like s3_retrieve, but returns a file-like object of the contents, which downloads, decrypts
+    and decompresses the file in blocks as it is read, in bounded memory.  (A file that is not
+    compressed yet is downloaded and compressed whole, like s3_retrieve does.)  Close it when done. """
+    storage = S3Storage(key_path, obj, raw_path)
+    try:
+        return storage.open_zst_stream()
+    except NoSuchKeyException:
+        storage.delete_s3_table_entry()
+        storage._download_and_rewrite_s3_as_compressed_retaining_uncompressed()
+        return BytesIO(storage.pop_uncompressed_file_content())
+
+
 def s3_retrieve_no_decompress(key_path: str, obj: StrPartStudy, raw_path: bool = False) -> bytes:
     """ As s3_retrieve, but does not decompress the file. """
     return S3Storage(key_path, obj, raw_path).download_no_decompress().pop_compressed_file_content()
@@ -638,89 +865,7 @@ it in like this:
     botocore.response.StreamingBody.__len__ = monkeypatch_len
 
 But that just results in this error from pycryptodome:
-TypeError: Object type <class 'botocore.response.StreamingBody'> cannot be passed to C code """
-
-
-####################################################################################################
+TypeError: Object type <class 'botocore.response.StreamingBody'> cannot be passed to C code
 
-# This is a class that caches encryption keys and study object ids to reduce database calls for
-# those values, but it currently does not have tests.  And it is questionable if we should cache
-# encryption keys without purging them.  But I couldn't help myself from prototyping it.
-
-
-# class SmartKeyPath:
-
-#     object_id_to_keys: dict[str, bytes] = {}
-#     study_pk_to_keys: dict[int, bytes] = {}
-#     study_pk_to_object_id: dict[int, str] = {}
-
-#     both_fields = ("encryption_key", "object_id")
-
-#     @classmethod
-#     def populate(cls, obj: StrOrParticipantOrStudy) -> None:
-
-#         if isinstance(obj, Participant):
-#             cls._populate_participant(obj)  # query
-#         elif isinstance(obj, Study):
-#             cls._populate(obj.pk, obj.encryption_key.encode(), obj.object_id)  # we have it
-#         elif isinstance(obj, str) and len(obj) == 24:
-#             cls._populate_object_id_str(obj)  # query
-#         else:
-#             raise TypeError(f"expected Study, Participant, or 24 char str, received '{type(obj)}'")
-
-#     ## Populate
-
-#     @classmethod
-#     def _populate(cls, study_id: int, key: bytes, study_object_id: str):
-#         cls.study_pk_to_keys[study_id] = key
-#         cls.object_id_to_keys[study_object_id] = key
-#         cls.study_pk_to_object_id[study_id] = study_object_id
-
-#     @classmethod
-#     def _populate_participant(cls, p: Participant):
-#         key, study_object_id = Study.fltr(pk=p.study_id).values_list(*cls.both_fields).get()
-#         cls._populate(p.study_id, key.encode(), study_object_id)
-
-#     @classmethod
-#     def _populate_object_id_str(cls, s: str):
-#         pk, key, study_object_id = Study.fltr(object_id=s).values_list("pk", *cls.both_fields).get()
-#         cls._populate(pk, key.encode(), study_object_id)
-
-#     ## getters
-
-#     @classmethod
-#     def smart_get_study_encryption_key(cls, obj: StrOrParticipantOrStudy) -> bytes:
-#         # The easy one
-#         if isinstance(obj, Study):
-#             return obj.encryption_key.encode()
-
-#         # The annoying ones
-#         if isinstance(obj, Participant):
-#             if obj.study_id not in cls.study_pk_to_keys:
-#                 cls.populate(obj)
-#             return cls.study_pk_to_keys[obj.study_id]
-
-#         elif isinstance(obj, str) and len(obj) == 24:
-#             if obj not in cls.object_id_to_keys:
-#                 cls.populate(obj)
-#             return cls.object_id_to_keys[obj]
-
-#         else:
-#             raise TypeError(SMART_GET_ERROR.format(type(obj)))
-
-#     @classmethod
-#     def s3_construct_study_key_path(cls, key_path: str, obj: StrOrParticipantOrStudy):
-#         # The easy ones
-#         if isinstance(obj, Study):
-#             return obj.object_id + "/" + key_path
-#         elif isinstance(obj, str) and len(obj) == 24:
-#             return obj + "/" + key_path
-
-#         # The annoying one
-#         elif isinstance(obj, Participant):
-#             if obj.study_id not in cls.study_pk_to_object_id:
-#                 cls.populate(obj)
-#             return cls.study_pk_to_object_id[obj.study_id] + "/" + key_path
-
-#         else:
-#             raise TypeError(SMART_GET_ERROR.format(type(obj)))
+Instead S3Storage.open_zst_stream reads the body in blocks and passes each block to a stateful
+cipher (see S3DecryptingReader and ServerDecryptor). """
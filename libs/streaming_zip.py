@@ -9,8 +9,10 @@ from constants.data_stream_constants import (AMBIENT_AUDIO, AUDIO_RECORDING, SUR
 from constants.s3_constants import NoSuchKeyException
 from database.study_models import Study
 from endpoints.participant_endpoints import SentryUtils
+from libs.file_processing.chunk_segments import retrieve_chunk
 from libs.s3 import s3_retrieve, s3_retrieve_no_decompress
 from libs.streaming_io import StreamingBytesIO
+from libs.utils.compression import compress
 
 
 class DummyError(Exception): pass
@@ -115,6 +117,8 @@ class ZipGenerator:
             return chunk, None  # early exit if stopped
         
         try:
+            if chunk.get("segment_count"):  # chunks with segments are merged with them
+                return chunk, retrieve_chunk(chunk["chunk_path"], self.study, chunk["segment_count"])
             return chunk, s3_retrieve(chunk["chunk_path"], self.study, raw_path=True)
         except NoSuchKeyException:
             with SentryUtils.report_webserver():
@@ -128,6 +132,8 @@ class ZipGenerator:
             return chunk, None  # early exit if stopped
         
         try:
+            if chunk.get("segment_count"):  # chunks with segments have to be merged, then compressed
+                return chunk, compress(retrieve_chunk(chunk["chunk_path"], self.study, chunk["segment_count"]))
             return chunk, s3_retrieve_no_decompress(chunk["chunk_path"], self.study, raw_path=True)
         except NoSuchKeyException:
             with SentryUtils.report_webserver():
@@ -1,9 +1,12 @@
+from __future__ import annotations
+
 import pyzstd
 
 from config.settings import DATA_COMPRESSION_LEVEL
 
 
 from backports.zstd import decompress;  # noqa
+from backports.zstd import get_frame_info, ZstdFile
 
 # TODO: migrate compression to the new backports.zstd library
 
@@ -26,3 +29,52 @@ def compress(some_bytes: bytes, level: int = DATA_COMPRESSION_LEVEL) -> bytes:
             pyzstd.CParameter.strategy: pyzstd.Strategy.dfast,
         }
     ).compress(some_bytes)
+
+
+#
+## Buffer variants, for large files where copies of the whole data matter.
+#
+
+class BufferReader:
+    """ A minimal file-like reader over a buffer (bytes, bytearray, memoryview) that does not copy
+    it, BytesIO copies anything other than bytes.  Each read copies just the requested piece. """
+    
+    def __init__(self, data: bytes | bytearray | memoryview):
+        self.view = memoryview(data).cast("B")
+        self.position = 0
+    
+    def read(self, size: int = -1) -> bytes:
+        end = len(self.view) if size is None or size < 0 else self.position + size
+        piece = self.view[self.position:end].tobytes()
+        self.position += len(piece)
+        return piece
+
+
+def decompressed_size(data: bytes | bytearray | memoryview) -> int | None:
+    """ The size of the decompressed data as recorded in the zstd frame header, None if the frame
+    does not record it.  (compress records it.)  Only covers the first frame of the data. """
+    return get_frame_info(data).decompressed_size
+
+
+def decompress_into(data: bytes | bytearray | memoryview, output: bytearray | memoryview) -> int:
+    """ Decompresses zstd data into output, a writable buffer, returns the number of bytes written.
+    decompress builds its output in blocks and then joins them, it briefly holds over twice the size
+    of the output, this only holds the output buffer and small pieces.  Raises ValueError if the
+    output buffer is too small. """
+    view = memoryview(output).cast("B")
+    written = 0
+    with ZstdFile(BufferReader(data)) as f:
+        while written < len(view):
+            count = f.readinto(view[written:])
+            if not count:
+                break
+            written += count
+        if written == len(view) and f.read(1):
+            raise ValueError(f"output buffer of {len(view)} bytes is too small for the decompressed data")
+    return written
+
+
+def decompressing_reader(compressed_file) -> ZstdFile:
+    """ A file-like object of the decompressed contents of compressed_file, a file-like object of
+    zstd data, that decompresses as it is read. """
+    return ZstdFile(compressed_file)
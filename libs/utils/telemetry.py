@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import resource
+import threading
+from collections import defaultdict
+from time import perf_counter
+
+
+"""
+Time and byte accounting of the stages of a long running job, e.g. a participant's data processing
+run (see FileProcessingTracker).  Code at any depth, like S3 operations, wraps its work in stage()
+and calls count(), which do nothing unless a Telemetry is recording.  A recording Telemetry collects
+from every thread of the process (downloads, uploads and compression run on thread pools), so only
+one Telemetry records at a time, another one entered while it is recording records nothing.
+
+Stage times are exclusive: when a stage starts inside another stage on the same thread the outer
+stage's clock pauses, e.g. downloading an existing chunk during a merge counts as download, not as
+merge.  Times of stages on several threads are summed, together they can exceed the elapsed time.
+
+The peak memory of a job is the process's high water mark, which on linux is reset when the job
+starts (reset_peak_memory) so that a long-lived worker process reports each job's own peak.
+"""
+
+# stages
+DOWNLOAD = "download"
+DECRYPT = "decrypt"
+DECOMPRESS = "decompress"
+BINNING = "binning"
+MERGE = "merge"
+COMPRESS = "compress"
+ENCRYPT = "encrypt"
+UPLOAD = "upload"
+REGISTER = "register"
+STATS = "stats"
+
+# counters
+BYTES_DOWNLOADED = "bytes_downloaded"
+BYTES_UPLOADED = "bytes_uploaded"
+
+_recording: Telemetry | None = None
+_threads = threading.local()  # the stack of running stages of each thread
+
+
+class Telemetry:
+    """ Seconds spent in each stage and counters, use as a context manager to record. """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stage_seconds: defaultdict[str, float] = defaultdict(float)
+        self.counters: defaultdict[str, int] = defaultdict(int)
+    
+    def __enter__(self) -> Telemetry:
+        global _recording
+        if _recording is None:
+            _recording = self
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        global _recording
+        if _recording is self:
+            _recording = None
+    
+    def add_seconds(self, stage_name: str, seconds: float):
+        with self.lock:
+            self.stage_seconds[stage_name] += seconds
+    
+    def add_count(self, counter_name: str, amount: int = 1):
+        with self.lock:
+            self.counters[counter_name] += amount
+    
+    def rounded_stage_seconds(self) -> dict[str, float]:
+        with self.lock:
+            return {name: round(seconds, 3) for name, seconds in sorted(self.stage_seconds.items())}
+
+
+class stage:
+    """ Times a stage of the recording Telemetry, if there is one. """
+    __slots__ = ("name", "start", "telemetry")
+    
+    def __init__(self, name: str):
+        self.name = name
+    
+    def __enter__(self) -> stage:
+        self.telemetry = _recording
+        if self.telemetry is None:
+            return self
+        
+        now = perf_counter()
+        try:
+            running: list[stage] = _threads.running
+        except AttributeError:
+            running = _threads.running = []
+        if running:  # pause the outer stage
+            outer = running[-1]
+            outer.telemetry.add_seconds(outer.name, now - outer.start)
+        self.start = now
+        running.append(self)
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.telemetry is None:
+            return
+        now = perf_counter()
+        running: list[stage] = _threads.running
+        running.pop()
+        self.telemetry.add_seconds(self.name, now - self.start)
+        if running:  # resume the outer stage
+            running[-1].start = now
+
+
+def reset_peak_memory() -> bool:
+    """ Resets the high water mark of the process's memory (VmHWM) to its current memory use, linux
+    only.  Returns whether it was reset. """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_memory_mb() -> float:
+    """ The high water mark of the process's memory since the last reset_peak_memory, or since the
+    process started where that is not available. """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024  # kilobytes
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kilobytes on linux
+
+
+def count(counter_name: str, amount: int = 1):
+    """ Adds to a counter of the recording Telemetry, if there is one. """
+    telemetry = _recording
+    if telemetry is not None:
+        telemetry.add_count(counter_name, amount)
@@ -30,17 +30,27 @@ def s3_op_threaded_iterate(
     pool = s3_op_threadpool()
     
     try:
-        return list(
-            pool.imap_unordered(
-                lambda iterated: func(iterated, *static_args, **static_kwargs), iterable
-            )
-        )
+        return threadpool_iterate(pool, func, iterable, *static_args, **static_kwargs)
     finally:
         pool.close()
         pool.join()
         pool.terminate()
 
 
+def threadpool_iterate(
+    pool: ThreadPool,
+    func: Callable[..., T],
+    iterable: Iterable[Any],
+    *static_args: Any,
+    **static_kwargs: Any,
+) -> list[T]:
+    """ s3_op_threaded_iterate on an existing threadpool, the threadpool is left open so that it can
+    be reused. """
+    return list(
+        pool.imap_unordered(lambda iterated: func(iterated, *static_args, **static_kwargs), iterable)
+    )
+
+
 def drain_in_reverse(lst: list[T]) -> Generator[T, None, None]:
     """ Drains a list, this is useful for memory management where order doesn't matter.  Memory
     deallocates as items are popped - to a point; this is Python. """
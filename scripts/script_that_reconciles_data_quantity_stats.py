@@ -0,0 +1,24 @@
+from database.user_models_participant import Participant
+from libs.file_processing.data_qty_stats import reconcile_data_quantity_stats
+
+
+# Data processing updates the data quantity stats (the beiwe_*_bytes fields of SummaryStatisticDaily)
+# incrementally, by the change in size of the data it processed.  This script recalculates them from
+# scratch from the ChunkRegistry, reports the participants and days where they differ, and fixes
+# them.  Set FIX = False to only report.
+FIX = True
+
+
+def main():
+    participant_count = 0
+    day_count = 0
+    for participant in Participant.objects.select_related("study").order_by("pk").iterator():
+        days = reconcile_data_quantity_stats(participant, fix=FIX)
+        if days:
+            participant_count += 1
+            day_count += len(days)
+            print(f"{participant.patient_id}: {len(days)} days differ, {days[0]} through {days[-1]}")
+    
+    print(f"\n{day_count} days across {participant_count} participants differed from the ChunkRegistry.")
+    if FIX:
+        print("They have been fixed.")
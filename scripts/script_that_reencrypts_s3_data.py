@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+from multiprocessing.pool import ThreadPool
+
+from constants.common_constants import CHUNKS_FOLDER, CUSTOM_ONDEPLOY_PREFIX, LOGS_FOLDER, PROBLEM_UPLOADS
+from database.models import Study
+from libs.s3 import BadS3PathException, NoSuchKeyException, s3_list_files, S3Storage
+from libs.utils.http_utils import numformat
+
+
+# If you need to restart the full script you can update START_GLOBAL_FILE_SEARCH_HERE.
+#
+# Provide a file path that was printed in the output of a previous run of the script, and the
+# re-encryption of all files will restart from there.
+#
+# Note: the sorting on s3 is case-sensitive, uppercase letters come before lowercase.
+#
+START_GLOBAL_FILE_SEARCH_HERE = None
+
+
+"""
+Rewrites the (compressed, .zst) files in study folders and the chunks folder that are still in the
+legacy AES-CFB-8 server encryption format in the current format, see libs/aes.py.  This is opt-in,
+the server reads both formats, and every file written by the server is already in the current
+format.  Reading legacy files is ~10x slower, so this speeds up data processing, data downloads and
+Forest on older data.
+
+Run it in the background with run_task.sh.  Files are downloaded and uploaded again (S3 transfer
+costs apply), their contents don't change so there are no database updates.  A file that changes
+while it is being re-encrypted (e.g. a chunk that data processing updates) is left alone, the new
+upload is already in the current format.  Uncompressed files are not touched, the compression script
+(script_that_compresses_s3_data.py) rewrites them in the current format.
+"""
+
+VALID_JUNK_FOLDERS = (LOGS_FOLDER, PROBLEM_UPLOADS, CUSTOM_ONDEPLOY_PREFIX, "logs")
+
+THREAD_POOL_SIZE = 50
+BATCH_SIZE = 10_000
+
+
+def main():
+    """ This is called when run through the run_task.sh script. """
+    reencrypt_files_matching_prefix("", START_GLOBAL_FILE_SEARCH_HERE)
+
+
+class stats:
+    number_paths_total = 0
+    number_of_skipped_files = 0
+    number_files_reencrypted = 0
+    number_files_already_current = 0
+    number_files_failed_with_error = 0
+    
+    @classmethod
+    def stats(cls):
+        print()
+        print("number_paths_total:", numformat(cls.number_paths_total))
+        print("number_of_skipped_files:", numformat(cls.number_of_skipped_files))
+        print("number_files_reencrypted:", numformat(cls.number_files_reencrypted))
+        print("number_files_already_current:", numformat(cls.number_files_already_current))
+        print("number_files_failed_with_error:", numformat(cls.number_files_failed_with_error))
+        print()
+
+
+def reencrypt_file(path_study: tuple[str, Study]):
+    path, study = path_study
+    try:
+        s = S3Storage(path.removesuffix(".zst"), study, bypass_study_folder=True)
+        if s.reencrypt_legacy_zst():
+            stats.number_files_reencrypted += 1
+        else:
+            stats.number_files_already_current += 1
+    except NoSuchKeyException:
+        stats.number_of_skipped_files += 1  # deleted since it was listed
+    except BadS3PathException as e:
+        print("bad s3 path:", e)
+        stats.number_files_failed_with_error += 1
+    except Exception as e:
+        print(f"uhoh, encountered an `{e}` on {path}.")
+        stats.number_files_failed_with_error += 1
+
+
+# we can bypass a whole database query by having the study to hand
+ALL_STUDIES: dict[str, Study | None] = {}
+
+
+def get_study(study_object_id: str) -> Study | None:
+    if study_object_id not in ALL_STUDIES:
+        ALL_STUDIES[study_object_id] = Study.objects.filter(object_id=study_object_id).first()
+    return ALL_STUDIES[study_object_id]
+
+
+def reencrypt_a_study(study: Study):
+    reencrypt_files_matching_prefix(study.object_id + "/")
+    reencrypt_files_matching_prefix(CHUNKS_FOLDER + "/" + study.object_id + "/")
+
+
+def reencrypt_files_matching_prefix(prefix: str, start_at: str = None):
+    pool = ThreadPool(THREAD_POOL_SIZE)
+    args = []
+    
+    try:
+        for path in s3_list_files(prefix, start_at=start_at):
+            if stats.number_paths_total % 100_000 == 0:
+                print(f'file {numformat(stats.number_paths_total)} for your reference: "{path}"')
+                stats.stats()
+            stats.number_paths_total += 1
+            
+            path_start = path.split("/", 1)[0]
+            if not path.endswith(".zst") or path_start in VALID_JUNK_FOLDERS:
+                stats.number_of_skipped_files += 1
+                continue
+            
+            # get study object id in the chunks folder or participant folder
+            study_object_id = path.split("/")[1] if path_start == CHUNKS_FOLDER else path_start
+            study = get_study(study_object_id)
+            if not study:
+                stats.number_of_skipped_files += 1
+                continue
+            
+            args.append((path, study))
+            if len(args) >= BATCH_SIZE:
+                list(pool.imap_unordered(reencrypt_file, args, chunksize=1))  # just a fast iterate
+                print(f'Most recent re-encrypted file for your reference: "{path}"')
+                args = []
+        
+        if args:
+            list(pool.imap_unordered(reencrypt_file, args, chunksize=1))
+    finally:
+        pool.close()
+        pool.terminate()
+    
+    stats.stats()
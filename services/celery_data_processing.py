@@ -2,10 +2,13 @@ from datetime import timedelta
 
 from django.utils import timezone
 
-from database.models import FileToProcess, Participant
+from database.models import Participant
 from libs.celery_control import (CeleryDataProcessingTask, get_processing_active_job_ids,
     safe_apply_async)
-from libs.file_processing.file_processing_core import easy_run
+from libs.file_processing.file_processing_core import (delete_old_processing_runs, easy_run,
+    easy_run_batch, PROCESSING_TIME_LIMIT)
+from libs.file_processing.processing_scheduler import (get_participant_backlogs,
+    plan_processing_tasks, record_schedule)
 from libs.sentry import SentryUtils
 
 
@@ -15,6 +18,8 @@ from libs.celery_control import processing_celery_app;  # noqa - required in the
 ############################# Data Processing ##################################
 ################################################################################
 
+DEFAULT_TIME_LIMIT_SECONDS = int(PROCESSING_TIME_LIMIT.total_seconds())
+
 
 def create_file_processing_tasks():
     """ Generates tasks to enqueue.  This is called every 6 minutes, and tasks have a lifetime
@@ -29,37 +34,51 @@ def create_file_processing_tasks():
     expiry = (timezone.now() + timedelta(minutes=5)).replace(second=30, microsecond=0)
     
     with SentryUtils.report_data_processing():
-        participant_set = set(
-            FileToProcess.objects.values_list("participant_id", flat=True).distinct()
-        )
-        
         # sometimes celery just fails to exist, set should be redundant.
         active_set = set(get_processing_active_job_ids())
         
-        participants_to_process = participant_set - active_set
-        print("Queueing these participants:", ",".join(str(p) for p in participants_to_process))
+        # participants are ranked and grouped into tasks by processing_scheduler, queue order matters.
+        backlogs = get_participant_backlogs(exclude_participant_ids=active_set)
+        tasks = plan_processing_tasks(backlogs)
+        record_schedule(backlogs, tasks, already_running_count=len(active_set))
+        delete_old_processing_runs()
+        print("Queueing these participants:", ",".join(str(b[0]) for b in backlogs))
         
-        for participant_id in participants_to_process:
+        for participant_ids, time_limit in tasks:
             # Queue all users' file processing, and generate a list of currently running jobs to use
             # to detect when all jobs are finished running.
+            if len(participant_ids) == 1:
+                task, args = daily_celery_process_file_chunks, [participant_ids[0]]
+            else:
+                task, args = daily_celery_process_file_chunks_batch, [participant_ids]
             safe_apply_async(
-                daily_celery_process_file_chunks,
-                args=[participant_id],
+                task,
+                args=args,
+                kwargs={"time_limit_seconds": int(time_limit.total_seconds())},
                 max_retries=0,
                 expires=expiry,
                 task_track_started=True,
                 task_publish_retry=False,
                 retry=False
             )
-        print(f"{len(participants_to_process)} users queued for processing")
+        print(f"{len(backlogs)} users queued for processing in {len(tasks)} tasks")
 
 
 ## uh, this use of "daily" is just to make the timer warning useful for this process.
 @CeleryDataProcessingTask()
-def daily_celery_process_file_chunks(participant_id):
+def daily_celery_process_file_chunks(participant_id, time_limit_seconds=DEFAULT_TIME_LIMIT_SECONDS):
     """ Task caller that runs through all new uploads from a specific user and 'chunks' them.
     Handles logic for skipping bad files, raising errors ~nicer. """
     
     # All iteration logic has been moved into celery_processing_core
     participant = Participant.objects.get(id=participant_id)
-    easy_run(participant)
+    easy_run(participant, timedelta(seconds=time_limit_seconds))
+
+
+@CeleryDataProcessingTask()
+def daily_celery_process_file_chunks_batch(
+    participant_ids, time_limit_seconds=DEFAULT_TIME_LIMIT_SECONDS
+):
+    """ Processes several participants with small backlogs one after another, see easy_run_batch.
+    Participants that don't get a turn are queued again by the next scheduling run. """
+    easy_run_batch(participant_ids, timedelta(seconds=time_limit_seconds))
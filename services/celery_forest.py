@@ -4,9 +4,10 @@ import logging
 import shutil
 import traceback
 from datetime import date, datetime, timedelta
-from os import makedirs
+from os import makedirs, remove
 from os.path import dirname, exists as file_exists, join as path_join
 from time import sleep
+from typing import BinaryIO
 
 from dateutil.tz import UTC
 from django.db import transaction
@@ -26,8 +27,9 @@ from database.system_models import ForestVersion
 from database.user_models_participant import Participant
 from libs.celery_control import forest_celery_app, safe_apply_async
 from libs.endpoint_helpers.copy_study_helpers import format_study
+from libs.file_processing.chunk_segments import retrieve_chunk
 from libs.intervention_utils import intervention_survey_data
-from libs.s3 import s3_retrieve
+from libs.s3 import s3_open, S3_STREAM_BLOCK_SIZE
 from libs.sentry import SentryUtils
 from libs.streaming_zip import determine_base_file_name
 from libs.utils.date_utils import get_timezone_shortcode, legible_time
@@ -358,16 +360,19 @@ def download_data_files(task: ForestTask, chunks: dbt.ChunkRegistryQS) -> None:
 
 def batch_create_file(task_and_chunk_tuple: tuple[ForestTask, dict]):
     """ Wrapper for basic file download operations so that it can be run in a ThreadPool. """
-    # weird unpack of variables, do s3_retrieve.
+    # weird unpack of variables, download the chunk (merged with its segments).
     forest_task, chunk = task_and_chunk_tuple
-    contents = s3_retrieve(chunk["chunk_path"], chunk["study__object_id"], raw_path=True)
     # file ops, sometimes we have to add folder structure (surveys)
     file_name = path_join(forest_task.data_input_path, determine_base_file_name(chunk))
     makedirs(dirname(file_name), exist_ok=True)
     
     try:
         with open(file_name, "xb") as f:
-            f.write(contents)
+            try:
+                write_chunk(f, chunk)
+            except BaseException:
+                remove(file_name)  # don't leave a partial file for forest to run on
+                raise
     except FileExistsError:
         # we used to track this, it happens when someone uploads duplicate files, which we handle
         # but at some point we started deduplicating the file names so it retriggered. Silencing.
@@ -376,6 +381,15 @@ def batch_create_file(task_and_chunk_tuple: tuple[ForestTask, dict]):
         pass
 
 
+def write_chunk(f: BinaryIO, chunk: dict):
+    if chunk["segment_count"]:  # the chunk has to be merged with its segments
+        f.write(retrieve_chunk(chunk["chunk_path"], chunk["study__object_id"], chunk["segment_count"]))
+        return
+    # otherwise it is downloaded, decrypted and decompressed into the file in blocks
+    with s3_open(chunk["chunk_path"], chunk["study__object_id"], raw_path=True) as contents:
+        shutil.copyfileobj(contents, f, S3_STREAM_BLOCK_SIZE)
+
+
 def get_interventions_data(forest_task: ForestTask):
     """ Generates a study interventions file for the participant's survey and returns the path to it """
     ensure_folders_exist(forest_task)
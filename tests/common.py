@@ -30,6 +30,8 @@ from database.user_models_researcher import Researcher, StudyRelation
 from libs.django_typing import (FileResponse as _FileResponse, HttpResponse as _HttpResponse,
     HttpResponseBase as _HttpResponseBase, HttpResponseRedirect as _HttpResponseRedirect,
     StreamingHttpResponse as _StreamingHttpResponse)
+from libs.rsa import ParticipantKeyCache
+from libs.s3 import StudyKeyCache
 from libs.shell_support import tformat
 from libs.utils.security_utils import generate_easy_alphanumeric_string
 from tests.helpers import compare_dictionaries, DatabaseHelperMixin, render_test_html_file
@@ -114,6 +116,11 @@ class CommonTestCase(TestCase, DatabaseHelperMixin):
         messages.warning = self.monkeypatch_messages(messages.warning)
         messages.error = self.monkeypatch_messages(messages.error)
         
+        # studies and participants are rolled back at the end of each test, cached keys would
+        # outlive them.
+        StudyKeyCache.clear()
+        ParticipantKeyCache.clear()
+        
         if VERBOSE_2_OR_3:
             print("\n==")
         return super().setUp()
@@ -16,7 +16,7 @@ from constants.schedule_constants import ScheduleTypes
 from constants.testing_constants import MONDAY_JAN_10_NOON_2022_EST
 from constants.user_constants import ANDROID_API, ResearcherRole, TABLEAU_TABLE_FIELD_TYPES
 from database.forest_models import SummaryStatisticDaily
-from database.models import ArchivedEvent, DataProcessingStatus
+from database.models import ArchivedEvent, DataProcessingRun, DataProcessingStatus
 from database.profiling_models import UploadTracking
 from database.security_models import ApiKey
 from database.study_models import Study
@@ -1712,6 +1712,65 @@ class TestBackgroundProcessingStatus(DataApiTest):
         DataProcessingStatus.singleton().update(last_run=timezone.now()-timedelta(minutes=20))
         resp = self.smart_post_status_code(500)
         self.assertEqual(resp.content, b"")
+    
+    def test_no_data_processing_runs(self):
+        # the summary of data processing runs is not public, see TestGetDataProcessingSummary
+        DataProcessingStatus.singleton().update(last_run=timezone.now())
+        self.generate_data_processing_run(self.default_participant)
+        resp = self.smart_post_status_code(200)
+        self.assertEqual(resp.content, b"")
+    
+    def generate_data_processing_run(self, participant, seconds: float = 1.0, stages: dict = None):
+        return DataProcessingRun.objects.create(
+            participant=participant, seconds=seconds, errored=False, files=2, failed_files=1,
+            file_bytes=100, bytes_in=30, bytes_out=20, chunks=1, queries=10, peak_memory_mb=50.0,
+            stages=orjson.dumps(stages or {}).decode(),
+        )
+
+
+class TestGetDataProcessingSummary(DataApiTest):
+    ENDPOINT_NAME = "data_api_endpoints.get_data_processing_summary"
+    generate_data_processing_run = TestBackgroundProcessingStatus.generate_data_processing_run
+    
+    def test_no_relation(self):
+        self.smart_post_status_code(403)
+    
+    def test_researcher(self):
+        self.set_session_study_relation(ResearcherRole.researcher)
+        self.smart_post_status_code(403)
+    
+    def test_study_admin(self):
+        self.set_session_study_relation(ResearcherRole.study_admin)
+        self.smart_post_status_code(403)
+    
+    def test_no_runs(self):
+        self.set_session_study_relation(ResearcherRole.site_admin)
+        summary = orjson.loads(self.smart_post_status_code(200).content)
+        self.assertEqual(summary["runs"], 0)
+        self.assertEqual(summary["slowest_runs"], [])
+    
+    def test_data_processing_runs_of_the_last_hour(self):
+        self.set_session_study_relation(ResearcherRole.site_admin)
+        participant = self.default_participant
+        self.generate_data_processing_run(participant, 1.5, {"download": 1.0, "merge": 0.25})
+        self.generate_data_processing_run(participant, 3.0, {"download": 2.0})
+        old_run = self.generate_data_processing_run(participant, 100.0, {"download": 99.0})
+        DataProcessingRun.objects.filter(pk=old_run.pk).update(created_on=timezone.now() - timedelta(hours=2))
+        
+        summary = orjson.loads(self.smart_post_status_code(200).content)
+        self.assertEqual(summary["runs"], 2)
+        self.assertEqual(summary["errored_runs"], 0)
+        self.assertEqual(summary["seconds"], 4.5)
+        self.assertEqual(summary["files"], 4)
+        self.assertEqual(summary["failed_files"], 2)
+        self.assertEqual(summary["bytes_in"], 60)
+        self.assertEqual(summary["bytes_out"], 40)
+        self.assertEqual(summary["queries"], 20)
+        self.assertEqual(summary["stages"], {"download": 3.0, "merge": 0.25})
+        # slowest first
+        self.assertEqual([run["seconds"] for run in summary["slowest_runs"]], [3.0, 1.5])
+        self.assertEqual(summary["slowest_runs"][0]["participant__patient_id"], participant.patient_id)
+        self.assertEqual(summary["slowest_runs"][0]["stages"], {"download": 2.0})
 
 
 class TestCheckMyCredentials(DataApiTest):
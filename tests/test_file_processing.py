@@ -1,29 +1,60 @@
 import hashlib
+import json
+import os
+from base64 import b64encode
 from collections import defaultdict
-from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime, timedelta
 from io import BytesIO
+from itertools import chain, repeat
+from random import Random
+from tempfile import TemporaryDirectory
 from unittest.mock import Mock, patch
 
+from celery import Celery
 from cronutils import ErrorHandler, null_error_handler
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from pyzstd import decompress
 
 from config.settings import FILE_PROCESS_PAGE_SIZE
 from constants.common_constants import CHUNKS_FOLDER, UTC
 from constants.data_processing_constants import (AllBinifiedData, BinifyKey,
     CHUNK_TIMESLICE_QUANTUM, REFERENCE_CHUNKREGISTRY_HEADERS)
-from constants.data_stream_constants import (ACCELEROMETER, ALL_DATA_STREAMS,
-    ANDROID_LOG_FILE, AUDIO_RECORDING, BLUETOOTH, CALL_LOG, DEVICEMOTION, GPS, GYRO, IDENTIFIERS,
+from constants.data_stream_constants import (ACCELEROMETER, ALL_DATA_STREAMS, AMBIENT_AUDIO,
+    ANDROID_LOG_FILE, AUDIO_RECORDING, BLUETOOTH, CALL_LOG, CHUNKABLE_FILES, DEVICEMOTION, GPS, GYRO, IDENTIFIERS,
     IOS_LOG_FILE, MAGNETOMETER, POWER_STATE, PROXIMITY, REACHABILITY, SURVEY_ANSWERS,
     SURVEY_TIMINGS, TEXTS_LOG, WIFI)
+from constants.raw_data_constants import CHUNK_FIELDS
 from constants.user_constants import ANDROID_API, IOS_API
-from database.models import ChunkRegistry, FileToProcess, S3File, Survey
+from database.data_access_models import ChunkableDataTypeError, UnchunkableDataTypeError
+from database.models import (ChunkRegistry, DataProcessingRun, DataProcessingSchedule,
+    FileToProcess, S3File, SummaryStatisticDaily, Survey)
+from endpoints.raw_data_api_endpoints import combined_chunk_query, filter_chunks_by_registry
 from libs.aes import decrypt_server
+from libs.file_processing.binified_data_spill import SpillableRows
+from libs.file_processing.binning_pool import (bin_stream_files, pack_rows, shutdown_binning_pool,
+    unpack_rows)
+from libs.file_processing.chunk_cache import ChunkCache
+from libs.file_processing.chunk_segments import construct_segment_path
 from libs.file_processing.csv_merger import construct_s3_chunk_path, CsvMerger
+from libs.file_processing.data_qty_stats import (apply_data_quantity_changes,
+    reconcile_data_quantity_stats)
 from libs.file_processing.file_for_processing import FileForProcessing
-from libs.file_processing.file_processing_core import easy_run, FileProcessingTracker
+from libs.file_processing.file_processing_core import (easy_run, easy_run_batch,
+    ESTIMATED_COMPRESSION_RATIO, FileProcessingTracker, PROCESSING_TIME_LIMIT, RUN_FAILED,
+    RUN_FINISHED, RUN_SKIPPED, UNKNOWN_FILE_SIZE_ESTIMATE)
+from libs.file_processing.processing_scheduler import (BATCH_MAX_PARTICIPANTS,
+    get_participant_backlogs, LARGE_BACKLOG_TIME_LIMIT, plan_processing_tasks)
 from libs.file_processing.utility_functions_csvs import construct_csv_as_bytes
-from libs.file_processing.utility_functions_simple import (binify_from_timecode,
-    convert_unix_to_human_readable_timestamps)
+from libs.file_processing.utility_functions_simple import (binify_from_timecode, binify_rows_numpy,
+    convert_unix_to_human_readable_timestamps, insert_human_readable_timestamps_numpy)
+from libs.streaming_zip import ZipGenerator
+from libs.utils.compression import compress
+from libs.utils.date_utils import get_timezone_shortcode
+from services import celery_data_processing
 from tests.common import CommonTestCase
 from tests.helpers import DatabaseHelperMixin
 
@@ -359,6 +390,48 @@ class TestFileProcessing(CommonTestCase):
         self.assertEqual(len(ffp.file_lines), 155)
         self.assertIsNone(ffp.file_contents)  # file_contents was cleared
     
+    @patch("libs.s3.conn")
+    def test_prepare_data_splits_only_leading_columns(self, conn: Mock):
+        setup_conn_retrieve_mock(conn, input_power_state_content)
+        ftp = self.generate_file_to_process(path=self.raw_fp_good, os_type=ANDROID_API)
+        ffp = FileForProcessing(ftp, self.default_study)
+        ffp.prepare_data()
+        assert ffp.file_lines is not None  # linter type assertion
+        self.assertEqual(ffp.header, b"timestamp,event,level")
+        self.assertEqual(ffp.file_lines[0], [b"1768928568332", b"Locked,0.7"])
+        self.assertEqual(len(ffp.file_lines), 155)
+    
+    @patch("libs.s3.conn")
+    def test_prepare_data_call_log_moves_timestamp_column(self, conn: Mock):
+        # the call log fix needs its first three columns split
+        setup_conn_retrieve_mock(conn, b"hashed phone number,call type,date,duration\nabc,Missed Call,1768928568332,0\n")
+        ftp = self.generate_file_to_process(
+            path=f"{self.default_study.object_id}/{self.default_participant.patient_id}/callLog/1768928568332.csv",
+            os_type=ANDROID_API,
+        )
+        ffp = FileForProcessing(ftp, self.default_study)
+        ffp.prepare_data()
+        self.assertEqual(ffp.header, b"date,hashed phone number,call type,duration")
+        self.assertEqual(ffp.file_lines, [[b"1768928568332", b"abc", b"Missed Call", b"0"]])
+    
+    def test_bin_stream_files(self):
+        good_path = "1234567890ABCDEFGHIJKMNO/patient1/powerState/1768928568332.csv"
+        bad_path = "1234567890ABCDEFGHIJKMNO/patient1/callLog/1768928568332.csv"
+        results = dict(bin_stream_files([
+            (1, good_path, ANDROID_API, input_power_state_content),
+            (2, bad_path, ANDROID_API, b"hashed phone number,call type\nabc,Missed Call"),
+            (3, good_path, ANDROID_API, b"timestamp,event,level"),
+        ]))
+        self.assertIsInstance(results[2], IndexError)  # errors only fail their file
+        self.assertIsNone(results[3])  # no data
+        
+        header, packed_bins = results[1]
+        self.assertEqual(header, b"timestamp,event,level")
+        rows = [row for packed_rows in packed_bins.values() for row in unpack_rows(packed_rows)]
+        self.assertEqual(len(rows), 155)
+        self.assertEqual(rows[0], [b"1768928568332", b"Locked,0.7"])
+        self.assertEqual(pack_rows(rows[:2]), b"1768928568332,Locked,0.7\n" + b",".join(rows[1]))
+    
     @patch("libs.s3.conn")
     def test_raw_csv_to_line_list_single_line(self, conn: Mock):
         single_line_content = b'timestamp,event,level'
@@ -757,6 +830,81 @@ class TestCsvMerger(CommonTestCase):
         self.assertIsNotNone(chunk_params)
         self.assertEqual(chunk_params['data_type'], POWER_STATE)
     
+    def test_csv_merger_chunk_existence_query_count_is_constant(self):
+        # raw upload header, gets the UTC time column added and then matches the reference header
+        header = b"timestamp,event"
+        self.using_default_participant()
+        
+        for bin_count in (1, 10, 100):
+            binified_data, null_handler = self.binified_and_handler
+            for i in range(bin_count):
+                data_bin: BinifyKey = (*self.bin_start, BIN_1 + i, header)
+                binified_data[data_bin] = ([list(row) for row in POWER_STATE_ROWS_1], [i])
+            
+            # one query for all the chunk paths, regardless of how many time bins there are.
+            with self.assertNumQueries(1):
+                merger = CsvMerger(binified_data, null_handler, self.default_participant, None, None)
+            
+            self.assertEqual(len(merger.upload_these), bin_count)
+            self.assertTrue(all(is_new for *_, is_new in merger.upload_these))
+    
+    def power_state_bins(self, bin_count: int) -> AllBinifiedData:
+        binified_data, _ = self.binified_and_handler
+        for i in range(bin_count):
+            rows = [[b"%d" % (int(T1_BYTESTR) + i * 3_600_000 + j), b"Locked"] for j in range(i + 1)]
+            binified_data[(*self.bin_start, BIN_1 + i, b"timestamp,event")] = (rows, [i])
+        return binified_data
+    
+    def test_csv_merger_compression_pool_matches_serial(self):
+        serial = CsvMerger(self.power_state_bins(10), null_error_handler(), self.default_participant, None, None)  # type: ignore
+        # a buffer of 0 forces a wait on every earlier chunk, a large one lets them all queue up.
+        for buffer_mb in (0, 100):
+            pooled = CsvMerger(
+                self.power_state_bins(10), null_error_handler(), self.default_participant, None, None,  # type: ignore
+                compression_workers=3, compression_buffer_mb=buffer_mb,
+            )
+            self.assertEqual(pooled.upload_these, serial.upload_these)  # same content, same order
+            self.assertEqual(pooled.get_retirees(), serial.get_retirees())
+            self.assertEqual(len(pooled.pending_chunks), 0)
+            self.assertEqual(pooled.pending_bytes, 0)
+            self.assertIsNone(pooled.compression_pool)
+        self.assertEqual(len(serial.upload_these), 10)
+        self.assertTrue(all(chunk_kwargs["chunk_hash"] for chunk_kwargs, *_ in serial.upload_these))
+    
+    @patch("libs.file_processing.csv_merger.compress")
+    def test_csv_merger_compression_pool_failure_marks_only_that_chunks_ftps(self, compress_mock: Mock):
+        # the bin with 3 rows fails to compress, the error must not land on whichever bin was being
+        # merged when the failure was collected.
+        def compress_side_effect(contents: bytes) -> bytes:
+            if contents.count(b"\n") == 3:
+                raise FakeException("compression failed")
+            return contents
+        compress_mock.side_effect = compress_side_effect
+        
+        error_handler = ErrorHandler()
+        merger = CsvMerger(
+            self.power_state_bins(5), error_handler, self.default_participant, None, None,
+            compression_workers=2, compression_buffer_mb=0,
+        )
+        self.assertIn('raise FakeException("compression failed")', list(error_handler.errors)[0])
+        succeeded, failed, _, _ = merger.get_retirees()
+        self.assertEqual(failed, {2})
+        self.assertEqual(succeeded, {0, 1, 3, 4})
+        self.assertEqual(len(merger.upload_these), 4)
+    
+    def test_csv_merger_resolve_existing_chunks(self):
+        chunk_path = self.create_chunk()
+        chunk = ChunkRegistry.objects.get(chunk_path=chunk_path)
+        merger = CsvMerger(*self.binified_and_handler, self.default_participant, None, None)
+        self.assertEqual(merger.existing_chunks, {})
+        
+        # populate bins afterwards so that we only exercise the resolution step
+        merger.binified_data[(*self.bin_start, BIN_1, POWER_STATE_HEADER_ANDROID)] = ([], [1])
+        merger.binified_data[(*self.bin_start, BIN_2, POWER_STATE_HEADER_ANDROID)] = ([], [2])
+        self.assertEqual(
+            merger.resolve_existing_chunks(), {chunk_path: (chunk.pk, 1000, BIN_1_DT, 0)}
+        )
+    
     def test_csv_merger_two_identical_lines_are_merged(self):
         duplicated_row = [T1_BYTESTR, T1_UTC, b'Locked']
         duplicate_rows = [duplicated_row, duplicated_row]  # Same row twice
@@ -1277,6 +1425,79 @@ class TestCsvMerger(CommonTestCase):
 
 
 # AI generated, manually review, minor tweaks
+class TestChunkCache(CommonTestCase):
+    
+    def setUp(self):
+        super().setUp()
+        self.temp_directory = TemporaryDirectory()
+        self.directory = self.temp_directory.name
+    
+    def tearDown(self):
+        self.temp_directory.cleanup()
+        super().tearDown()
+    
+    @staticmethod
+    def chunk(n: int) -> tuple[bytes, bytes]:
+        contents = f"timestamp,UTC time,event,level\n{n},x,Locked,0.7\n".encode() * 100
+        return hashlib.sha1(contents).digest(), contents
+    
+    def test_hit_and_miss(self):
+        cache = ChunkCache(self.directory, 1024 * 1024)
+        sha1, contents = self.chunk(1)
+        self.assertIsNone(cache.get("CHUNKED_DATA/a", sha1))
+        cache.put("CHUNKED_DATA/a", sha1, compress(contents))
+        self.assertEqual(cache.get("CHUNKED_DATA/a", sha1), contents)
+        self.assertIsNone(cache.get("CHUNKED_DATA/b", sha1))
+        
+        # a new version replaces the old one, the old sha1 misses
+        new_sha1, new_contents = self.chunk(2)
+        cache.put("CHUNKED_DATA/a", new_sha1, compress(new_contents))
+        self.assertIsNone(cache.get("CHUNKED_DATA/a", sha1))
+        self.assertEqual(cache.get("CHUNKED_DATA/a", new_sha1), new_contents)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        self.assertEqual((cache.hits, cache.misses, cache.invalid), (2, 3, 0))
+    
+    def test_invalid_entry_is_a_miss_and_is_removed(self):
+        cache = ChunkCache(self.directory, 1024 * 1024)
+        sha1, contents = self.chunk(1)
+        cache.put("CHUNKED_DATA/a", sha1, compress(contents + b"corrupted"))
+        self.assertIsNone(cache.get("CHUNKED_DATA/a", sha1))
+        cache.put("CHUNKED_DATA/b", sha1, b"not zstd data")
+        self.assertIsNone(cache.get("CHUNKED_DATA/b", sha1))
+        self.assertEqual((cache.hits, cache.misses, cache.invalid), (0, 2, 2))
+        self.assertEqual(os.listdir(self.directory), [])
+    
+    def test_least_recently_used_entries_are_evicted(self):
+        compressed = {n: compress(self.chunk(n)[1]) for n in range(4)}
+        entry_size = 20 + len(compressed[0])
+        cache = ChunkCache(self.directory, entry_size * 3)
+        for n in range(3):
+            cache.put(f"CHUNKED_DATA/{n}", self.chunk(n)[0], compressed[n])
+            os.utime(cache.entry_path(f"CHUNKED_DATA/{n}"), (n, n))  # mtimes are too coarse to test with
+        self.assertIsNotNone(cache.get("CHUNKED_DATA/0", self.chunk(0)[0]))  # 0 is now the most recent
+        self.assertEqual(cache.evictions, 0)
+        
+        # over the limit, evicts down to 80% of it, which is two entries
+        cache.put("CHUNKED_DATA/3", self.chunk(3)[0], compressed[3])
+        self.assertEqual(cache.evictions, 2)
+        self.assertEqual(cache.estimated_size, entry_size * 2)
+        self.assertIsNone(cache.get("CHUNKED_DATA/1", self.chunk(1)[0]))
+        self.assertIsNone(cache.get("CHUNKED_DATA/2", self.chunk(2)[0]))
+        self.assertIsNotNone(cache.get("CHUNKED_DATA/0", self.chunk(0)[0]))
+        self.assertIsNotNone(cache.get("CHUNKED_DATA/3", self.chunk(3)[0]))
+        
+        # an existing cache directory is measured when a cache is created, e.g. a new worker process
+        self.assertEqual(ChunkCache(self.directory, entry_size * 3).estimated_size, entry_size * 2)
+    
+    def test_write_failure_does_not_raise(self):
+        cache = ChunkCache(self.directory, 1024 * 1024)
+        sha1, contents = self.chunk(1)
+        self.temp_directory.cleanup()
+        with patch("builtins.print"):
+            cache.put("CHUNKED_DATA/a", sha1, compress(contents))
+        self.assertIsNone(cache.get("CHUNKED_DATA/a", sha1))
+
+
 class TestFileProcessingTracker(CommonTestCase):
     """Tests for the FileProcessingTracker class"""
     
@@ -1385,6 +1606,111 @@ class TestFileProcessingTracker(CommonTestCase):
         self.assertEqual(len(pages), 1)
         self.assertEqual(len(pages[0]), 5)
     
+    def generate_sized_files_to_process(self, sizes: list[int | None]):
+        for i, size in enumerate(sizes):
+            path = f"study/participant/powerState/{i:02}.csv"
+            self.generate_file_to_process(
+                path=path, participant=self.default_participant, os_type=ANDROID_API,
+            )
+            if size is not None:
+                S3File(path=path + ".zst", sha1=path.encode()[:16], size_uncompressed=size).save()
+    
+    def test_get_paginated_files_to_process_by_bytes(self):
+        mb = 1024 * 1024
+        self.generate_sized_files_to_process([3*mb, 3*mb, 3*mb, 20*mb, 1*mb, 1*mb, 1*mb])
+        tracker = FileProcessingTracker(self.default_participant, page_size=10, page_mb=8)
+        
+        with patch("libs.file_processing.file_processing_core.logd"):
+            pages = list(tracker.get_paginated_files_to_process())
+        
+        # files stay in order, a file larger than the page size gets a page to itself
+        self.assertEqual([len(page) for page in pages], [2, 1, 1, 3])
+        self.assertEqual(
+            [ftp.s3_file_path for page in pages for ftp in page],
+            [f"study/participant/powerState/{i:02}.csv" for i in range(7)],
+        )
+    
+    def test_get_paginated_files_to_process_by_bytes_file_count_cap(self):
+        self.generate_sized_files_to_process([100] * 25)
+        tracker = FileProcessingTracker(self.default_participant, page_size=10, page_mb=8)
+        
+        with patch("libs.file_processing.file_processing_core.logd"):
+            pages = list(tracker.get_paginated_files_to_process())
+        
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+    
+    def test_get_paginated_files_to_process_size_estimates(self):
+        mb = 1024 * 1024
+        self.generate_sized_files_to_process([None, 2*mb, None])
+        path = "study/participant/powerState/03.csv"
+        self.generate_file_to_process(path=path, participant=self.default_participant, os_type=ANDROID_API)
+        S3File(path=path + ".zst", sha1=path.encode()[:16], size_compressed=mb).save()
+        
+        tracker = FileProcessingTracker(self.default_participant)
+        sizes = tracker.estimate_file_sizes(list(FileToProcess.objects.order_by("s3_file_path")))
+        
+        # a compressed size is scaled up by the expected compression ratio
+        self.assertEqual(list(sizes.values()), [UNKNOWN_FILE_SIZE_ESTIMATE, 2*mb, UNKNOWN_FILE_SIZE_ESTIMATE, 5*mb])
+    
+    def test_page_byte_budget_shrinks_near_time_limit(self):
+        tracker = FileProcessingTracker(self.default_participant, page_mb=100)
+        full_page = 100 * 1024 * 1024
+        
+        # the first page, and pages that will finish well within the time limit, are full size
+        self.assertEqual(tracker.page_byte_budget(1770, None), full_page)
+        self.assertEqual(tracker.page_byte_budget(1770, 1024 * 1024), full_page)
+        # a full page would take 100 seconds, with 60 seconds left the page gets 30 seconds of data
+        self.assertEqual(tracker.page_byte_budget(60, 1024 * 1024), 30 * 1024 * 1024)
+        # out of time, a page will still get one file
+        self.assertEqual(tracker.page_byte_budget(-5, 1024 * 1024), 0)
+    
+    def test_get_paginated_files_to_process_shrinks_slow_pages(self):
+        self.generate_sized_files_to_process([1024 * 1024] * 6)
+        tracker = FileProcessingTracker(self.default_participant, page_size=10, page_mb=4)
+        
+        # the first page takes 1000 seconds to "process" 4MB, leaving 770 seconds at 4KB/s, enough
+        # time for 3MB, half of that is a page of 1 file.  (The clock stops after the first page.)
+        times = chain([0, 0, 0], repeat(1000))
+        with patch("libs.file_processing.file_processing_core.logd"), \
+                patch("libs.file_processing.file_processing_core.perf_counter", lambda: next(times)):
+            pages = list(tracker.get_paginated_files_to_process())
+        
+        self.assertEqual([len(page) for page in pages], [4, 1, 1])
+    
+    def test_get_paginated_files_to_process_pipelined_does_not_time_pages(self):
+        # pipelined, the next pages are requested while a page is processed, the time between
+        # requests is not the time of a page.  The pipeline times the pages instead.
+        self.generate_sized_files_to_process([1024 * 1024] * 6)
+        tracker = FileProcessingTracker(self.default_participant, page_size=10, page_mb=4, pipeline_depth=2)
+        times = chain([0, 0, 0], repeat(1000))
+        with patch("libs.file_processing.file_processing_core.logd"), \
+                patch("libs.file_processing.file_processing_core.perf_counter", lambda: next(times)):
+            pages = list(tracker.get_paginated_files_to_process())
+        
+        self.assertEqual([len(page) for page in pages], [4, 2])
+        self.assertIsNone(tracker.page_bytes_per_second)
+    
+    @patch("libs.s3.conn")
+    def test_pipelined_processing_times_the_processing_of_pages(self, conn: Mock):
+        self.fake_s3_power_state_files(conn)
+        tracker = FileProcessingTracker(self.default_participant, page_size=1, page_mb=100, pipeline_depth=2)
+        rates = []
+        merge_binified_data = tracker.merge_binified_data
+        
+        def merge():
+            rates.append(tracker.page_bytes_per_second)
+            return merge_binified_data()
+        
+        tracker.merge_binified_data = merge
+        with patch("libs.file_processing.file_processing_core.logd"):
+            tracker.process_user_file_chunks()
+        
+        # the first page has no rate yet, every page after it has the rate of the page before it
+        self.assertEqual(len(rates), 3)
+        self.assertIsNone(rates[0])
+        for rate in rates[1:] + [tracker.page_bytes_per_second]:
+            self.assertGreater(rate, 0)
+    
     # binify
     
     def test_binify_csv_rows(self):
@@ -1460,6 +1786,59 @@ class TestFileProcessingTracker(CommonTestCase):
         total_rows = sum(len(bin_rows) for bin_rows in result.values())
         self.assertEqual(total_rows, 2)
     
+    def binify_and_convert_all_bins(
+        self, tracker: FileProcessingTracker, rows: list[list[bytes]], data_stream: str, header: bytes, numpy_min_rows: int
+    ) -> list[tuple[BinifyKey, bytes]]:
+        """ binify_csv_rows and then convert_unix_to_human_readable_timestamps on each bin, returns
+        the bins in order with their csv output. """
+        with patch("libs.file_processing.utility_functions_simple.NUMPY_MIN_ROWS", numpy_min_rows):
+            binified = tracker.binify_csv_rows([list(row) for row in rows], data_stream, header)
+            ret = []
+            for data_bin, bin_rows in binified.items():
+                updated_header = convert_unix_to_human_readable_timestamps(header, bin_rows)
+                ret.append((data_bin, construct_csv_as_bytes(updated_header, bin_rows)))
+        return ret
+    
+    def test_binify_and_convert_numpy_output_identical_for_all_chunkable_streams(self):
+        tracker = FileProcessingTracker(self.default_participant)
+        random = Random(5)
+        for data_stream in sorted(CHUNKABLE_FILES):
+            # the header without the UTC time column, as it is in uploaded files
+            header = REFERENCE_CHUNKREGISTRY_HEADERS[data_stream][ANDROID_API].replace(b"UTC time,", b"")
+            column_count = header.count(b",")
+            rows = []
+            for _ in range(1000):
+                # a few hours of data, out of order, with leading zero milliseconds and duplicates
+                timestamp = b"%d" % random.randint(1768928568000, 1768939368000)
+                rows.append([timestamp] + [b"%d" % random.randint(0, 9) for _ in range(column_count)])
+            rows.append(list(rows[10]))
+            rows.append([b"1768928568001"] + [b""] * column_count)
+            rows.append([b"1000000000000"] + [b"x"] * column_count)  # too early
+            rows.append([b"9999999999999"] + [b"x"] * column_count)  # too late
+            rows.append([b"+768928568332"] + [b"x"] * column_count)  # not digits
+            
+            python_output = self.binify_and_convert_all_bins(tracker, rows, data_stream, header, 10**9)
+            numpy_output = self.binify_and_convert_all_bins(tracker, rows, data_stream, header, 0)
+            self.assertEqual(len(python_output), 4)
+            self.assertEqual(python_output, numpy_output)
+    
+    def test_binify_rows_numpy_falls_back_on_mixed_timestamp_lengths(self):
+        self.assertIsNone(binify_rows_numpy([[b"1768928568332", b"a"], [b"176892856833", b"b"]]))
+        self.assertIsNone(binify_rows_numpy([[b"1768928568332", b"a"], []]))
+        self.assertIsNone(binify_rows_numpy([]))
+        self.assertEqual(
+            binify_rows_numpy([[b"1768932200000", b"a"], [b"1768928568332", b"b"], [b"1768932200001", b"c"]]),
+            {491370: [[b"1768932200000", b"a"], [b"1768932200001", b"c"]], 491369: [[b"1768928568332", b"b"]]},
+        )
+    
+    def test_convert_unix_to_human_readable_timestamps_numpy_bad_timestamp_raises(self):
+        # binify only looks at the first 10 characters, conversion parses the whole timestamp
+        rows = [[b"1768928568332", b"a"]] * 10 + [[b"17689285683x2", b"b"]]
+        with patch("libs.file_processing.utility_functions_simple.NUMPY_MIN_ROWS", 0):
+            self.assertFalse(insert_human_readable_timestamps_numpy([list(row) for row in rows]))
+            with self.assertRaises(ValueError):
+                convert_unix_to_human_readable_timestamps(b"timestamp,a", [list(row) for row in rows])
+    
     def test_append_binified_csvs(self):
         tracker = FileProcessingTracker(self.default_participant)
         
@@ -1529,6 +1908,91 @@ class TestFileProcessingTracker(CommonTestCase):
         self.assertEqual(ftps, [ftp1.pk, ftp2.pk])
         self.assertEqual(len(tracker.all_binified_data), 1)
     
+    def test_append_binified_csvs_spills_over_memory_budget(self):
+        tracker = FileProcessingTracker(self.default_participant)
+        tracker.memory_budget = 1  # one byte, everything spills
+        ftp1 = self.generate_file_to_process(
+            path=f"{self.study_participant_start}/powerState/1.csv", os_type=ANDROID_API,
+        )
+        ftp2 = self.generate_file_to_process(
+            path=f"{self.study_participant_start}/powerState/2.csv", os_type=ANDROID_API,
+        )
+        header = b"timestamp,event,level"
+        data_bin_1: BinifyKey = (tracker.study_object_id, tracker.patient_id, POWER_STATE, 491369, header)
+        data_bin_2: BinifyKey = (tracker.study_object_id, tracker.patient_id, POWER_STATE, 491370, header)
+        
+        tracker.append_binified_csvs({data_bin_1: [[b"1768928568332", b"Locked,0.7"]]}, ftp1)
+        tracker.append_binified_csvs({data_bin_2: [[b"1768932000000", b"Unlocked,0.6"]]}, ftp1)
+        # same bin again, spilled rows come back before in-memory rows
+        tracker.append_binified_csvs({data_bin_1: [[b"1768928682951", b"Unlocked,"]]}, ftp2)
+        
+        self.assertEqual(tracker.spill_count, 3)
+        self.assertGreater(tracker.spilled_bytes, 0)
+        self.assertGreater(tracker.binified_high_water_mark, 0)
+        self.assertEqual(tracker.binified_size_estimate, 0)
+        
+        rows_1, ftps_1 = tracker.all_binified_data[data_bin_1]
+        self.assertIsInstance(rows_1, SpillableRows)
+        self.assertEqual(len(rows_1), 0)  # all spilled
+        self.assertTrue(rows_1.has_spilled)
+        self.assertEqual(ftps_1, [ftp1.pk, ftp2.pk])
+        
+        rows_1.load_spilled()
+        self.assertFalse(rows_1.has_spilled)
+        self.assertEqual(list(rows_1), [[b"1768928568332", b"Locked,0.7"], [b"1768928682951", b"Unlocked,"]])
+    
+    def test_spilled_rows_are_split_on_the_timestamp_only(self):
+        # rows are split on their leading columns only, the rest of the line may have any number of
+        # commas.  Spilled rows come back as the timestamp and the rest of the line.
+        rows = SpillableRows([[b"1768928568332", b"a,b,,c"], [b"1768928568333", b"Missed Call", b"5,x"]])
+        lines = [b",".join(row) for row in rows]
+        rows.spill()
+        rows.append([b"1768928568334", b"d,e"])
+        rows.load_spilled()
+        self.assertEqual(
+            list(rows),
+            [[b"1768928568332", b"a,b,,c"], [b"1768928568333", b"Missed Call,5,x"], [b"1768928568334", b"d,e"]],
+        )
+        self.assertEqual([b",".join(row) for row in rows[:2]], lines)
+    
+    def test_append_binified_csvs_under_memory_budget_does_not_spill(self):
+        tracker = FileProcessingTracker(self.default_participant)
+        ftp = self.generate_file_to_process(
+            path=f"{self.study_participant_start}/powerState/1.csv", os_type=ANDROID_API,
+        )
+        data_bin: BinifyKey = (
+            tracker.study_object_id, tracker.patient_id, POWER_STATE, 491369, b"timestamp,event,level"
+        )
+        tracker.append_binified_csvs({data_bin: [[b"1768928568332", b"Locked", b"0.7"]]}, ftp)
+        self.assertEqual(tracker.spill_count, 0)
+        self.assertFalse(tracker.all_binified_data[data_bin][0].has_spilled)  # type: ignore
+        self.assertEqual(tracker.binified_high_water_mark, tracker.binified_size_estimate)
+    
+    def test_csv_merger_output_identical_with_spilled_data(self):
+        header = b"timestamp,event"
+        rows = [[b"1770358250000", b"Unlocked"], [T1_BYTESTR, b"Locked"], [T1_BYTESTR, b"Locked"]]
+        data_bin: BinifyKey = (
+            self.default_study.object_id, self.default_participant.patient_id, POWER_STATE, BIN_1, header
+        )
+        
+        outputs = []
+        for spill in (False, True):
+            tracker = FileProcessingTracker(self.default_participant)
+            tracker.memory_budget = 1 if spill else 0
+            ftp = self.generate_file_to_process(
+                path=f"{self.study_participant_start}/powerState/{int(spill)}.csv", os_type=ANDROID_API,
+            )
+            tracker.append_binified_csvs({data_bin: [list(row) for row in rows]}, ftp)
+            self.assertEqual(tracker.spill_count, int(spill))
+            merger = CsvMerger(
+                tracker.all_binified_data, null_error_handler(), self.default_participant, None, None  # type: ignore
+            )
+            self.assertEqual(len(merger.upload_these), 1)
+            outputs.append(decompress(merger.upload_these[0][2]))
+        
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0].splitlines()[1:], [POWERSTATE_OUT_LINE_1, POWERSTATE_OUT_LINE_2])
+    
     @patch("libs.s3.conn")
     def test_process_csv_data(self, conn: Mock):
         setup_conn_retrieve_mock(conn, input_power_state_content)
@@ -1576,6 +2040,9 @@ class TestFileProcessingTracker(CommonTestCase):
         )
         ffp = FileForProcessing(ftp, self.default_study)
         tracker.process_unchunkable_file(ffp)
+        self.assertEqual(ChunkRegistry.objects.count(), 0)  # registered with the rest of the page
+        self.assertEqual(len(tracker.unchunkable_files), 1)
+        tracker.register_unchunkable_files()
         
         # Verify ChunkRegistry was created
         chunk_registries = ChunkRegistry.objects.filter(
@@ -1651,6 +2118,7 @@ class TestFileProcessingTracker(CommonTestCase):
         
         ffp = FileForProcessing(ftp, self.default_study)
         tracker.process_one_file(ffp)
+        tracker.register_unchunkable_files()
         self.assertEqual(ChunkRegistry.objects.count(), 1)
     
     @patch("libs.s3.conn")
@@ -1753,6 +2221,719 @@ class TestFileProcessingTracker(CommonTestCase):
             self.assertIn(t, upload2_body)
             self.assertNotIn(t, upload1_body)
     
+    def fake_s3_power_state_files(self, conn: Mock) -> dict[str, bytes]:
+        """ Sets up FILE_DATA1-3 for processing against a dict that stands in for S3. The first two
+        files share a time bin. """
+        fake_s3: dict[str, bytes] = {}
+        
+        def put_object(Body: bytes, Bucket: str, Key: str):
+            fake_s3[Key] = Body
+        
+        def get_object(Bucket: str, Key: str, **kwargs):
+            return {"Body": BytesIO(fake_s3[Key])}
+        
+        def delete_object(Bucket: str, Key: str):
+            fake_s3.pop(Key)
+            return {}
+        
+        conn.put_object.side_effect = put_object
+        conn.get_object.side_effect = get_object
+        conn.delete_object.side_effect = delete_object
+        
+        for timestamp, data in (
+            ("1768928568332", FILE_DATA1), ("1768929245717", FILE_DATA2), ("1768932200000", FILE_DATA3)
+        ):
+            path = f"{self.study_participant_start}/powerState/{timestamp}.csv"
+            fake_s3[path + ".zst"] = self.true_default_s3_form(data)
+            S3File(path=path + ".zst", sha1=path.encode()[:16]).save()
+            self.generate_file_to_process(path=path, os_type=ANDROID_API)
+        return fake_s3
+    
+    def chunk_hashes_and_contents(self, fake_s3: dict[str, bytes]) -> dict[str, tuple[str, bytes]]:
+        """ Returns the chunk hash and decrypted contents of each chunk by chunk path. """
+        ret = {}
+        for chunk_path, chunk_hash in ChunkRegistry.objects.values_list("chunk_path", "chunk_hash"):
+            self.assertTrue(S3File.objects.filter(path=chunk_path + ".zst").exists())
+            contents = decompress(decrypt_server(fake_s3[chunk_path + ".zst"], self.default_study.encryption_key.encode()))
+            ret[chunk_path] = (chunk_hash, contents)
+        return ret
+    
+    def process_power_state_files_one_per_page(
+        self, conn: Mock, pipeline_depth: int, chunk_cache: ChunkCache | None = None
+    ) -> dict[str, tuple[str, bytes]]:
+        """ Processes FILE_DATA1-3, one file per page, so the second page has to merge into the first
+        page's chunk. """
+        fake_s3 = self.fake_s3_power_state_files(conn)
+        tracker = FileProcessingTracker(
+            self.default_participant, page_size=1, pipeline_depth=pipeline_depth, chunk_cache=chunk_cache
+        )
+        with patch("libs.file_processing.file_processing_core.logd"):
+            tracker.process_user_file_chunks()
+        return self.chunk_hashes_and_contents(fake_s3)
+    
+    @patch("libs.s3.conn")
+    def test_pipelined_processing_matches_serial_processing(self, conn: Mock):
+        pipelined = self.process_power_state_files_one_per_page(conn, pipeline_depth=2)
+        self.assertEqual(FileToProcess.objects.count(), 0)
+        self.assertEqual(len(pipelined), 2)
+        
+        # reset and run the same files through serial processing
+        ChunkRegistry.objects.all().delete()
+        S3File.objects.all().delete()
+        serial = self.process_power_state_files_one_per_page(conn, pipeline_depth=0)
+        self.assertEqual(FileToProcess.objects.count(), 0)
+        self.assertEqual(pipelined, serial)
+        
+        # and the shared time bin contains the data of both files
+        shared_bin = [contents for path, (_, contents) in serial.items() if "T17:00:00" in path][0]
+        for line in FILE_DATA1.splitlines()[1:] + FILE_DATA2.splitlines()[1:]:
+            self.assertIn(line.split(b",")[0], shared_bin)
+    
+    @patch("libs.s3.conn")
+    def test_pipelined_processing_upload_failure_retains_files_to_process(self, conn: Mock):
+        conn.get_object.side_effect = [{"Body": BytesIO(self.true_default_s3_form(FILE_DATA3))}]
+        conn.put_object.side_effect = ValueError("upload failed")  # not a retryable error
+        path = f"{self.study_participant_start}/powerState/1768932200000.csv"
+        S3File(path=path + ".zst", sha1=path.encode()[:16]).save()
+        self.generate_file_to_process(path=path, os_type=ANDROID_API)
+        
+        tracker = FileProcessingTracker(self.default_participant, pipeline_depth=1)
+        with patch("libs.file_processing.file_processing_core.logd"):
+            with self.assertRaises(ValueError):
+                tracker.process_user_file_chunks()
+        
+        self.assertEqual(FileToProcess.objects.count(), 1)
+        self.assertEqual(ChunkRegistry.objects.count(), 0)
+    
+    # telemetry
+    
+    @patch("libs.s3.conn")
+    def test_run_telemetry_is_recorded(self, conn: Mock):
+        for pipeline_depth in (0, 1):
+            DataProcessingRun.objects.all().delete()
+            ChunkRegistry.objects.all().delete()
+            S3File.objects.all().delete()
+            conn.reset_mock()
+            fake_s3 = self.fake_s3_power_state_files(conn)
+            get_object, downloaded_sizes = conn.get_object.side_effect, []
+            
+            def counting_get_object(**kwargs):
+                downloaded_sizes.append(len(fake_s3[kwargs["Key"]]))
+                return get_object(**kwargs)
+            
+            conn.get_object.side_effect = counting_get_object
+            tracker = FileProcessingTracker(self.default_participant, page_size=1, pipeline_depth=pipeline_depth)
+            with patch("libs.file_processing.file_processing_core.logd"):
+                tracker.process_user_file_chunks()
+            
+            run = DataProcessingRun.objects.get()
+            self.assertEqual(run.participant_id, self.default_participant.pk)
+            self.assertFalse(run.errored)
+            self.assertEqual(run.files, 3)
+            self.assertEqual(run.failed_files, 0)
+            self.assertEqual(run.file_bytes, len(FILE_DATA1) + len(FILE_DATA2) + len(FILE_DATA3))
+            self.assertEqual(run.chunks, conn.put_object.call_count)
+            self.assertEqual(run.bytes_in, sum(downloaded_sizes))
+            self.assertEqual(
+                run.bytes_out, sum(len(call.kwargs["Body"]) for call in conn.put_object.call_args_list)
+            )
+            self.assertGreater(run.queries, 0)
+            self.assertGreater(run.peak_memory_mb, 0)
+            stages = json.loads(run.stages)
+            for stage_name in ("download", "decrypt", "decompress", "binning", "merge", "compress",
+                               "encrypt", "upload", "register", "stats"):
+                self.assertIn(stage_name, stages)
+    
+    @patch("libs.s3.conn")
+    def test_run_telemetry_is_recorded_when_the_run_errors(self, conn: Mock):
+        conn.get_object.side_effect = [{"Body": BytesIO(self.true_default_s3_form(FILE_DATA3))}]
+        conn.put_object.side_effect = ValueError("upload failed")  # not a retryable error
+        path = f"{self.study_participant_start}/powerState/1768932200000.csv"
+        S3File(path=path + ".zst", sha1=path.encode()[:16]).save()
+        self.generate_file_to_process(path=path, os_type=ANDROID_API)
+        
+        with patch("libs.file_processing.file_processing_core.logd"):
+            with self.assertRaises(ValueError):
+                FileProcessingTracker(self.default_participant, pipeline_depth=0).process_user_file_chunks()
+        
+        run = DataProcessingRun.objects.get()
+        self.assertTrue(run.errored)
+        self.assertEqual(run.files, 1)
+        self.assertEqual(run.chunks, 0)
+        self.assertEqual(run.bytes_out, 0)
+    
+    # binning pool
+    
+    @patch("libs.s3.conn")
+    def test_binning_workers_match_in_process_binning(self, conn: Mock):
+        fake_s3 = self.fake_s3_power_state_files(conn)
+        tracker = FileProcessingTracker(self.default_participant, binning_workers=2)
+        try:
+            with patch("libs.file_processing.file_processing_core.logd"):
+                tracker.process_user_file_chunks()
+        finally:
+            shutdown_binning_pool()
+        self.assertEqual(FileToProcess.objects.count(), 0)
+        in_processes = self.chunk_hashes_and_contents(fake_s3)
+        
+        # reset and run the same files through in-process binning
+        ChunkRegistry.objects.all().delete()
+        S3File.objects.all().delete()
+        fake_s3 = self.fake_s3_power_state_files(conn)
+        with patch("libs.file_processing.file_processing_core.logd"):
+            FileProcessingTracker(self.default_participant, binning_workers=0).process_user_file_chunks()
+        self.assertEqual(FileToProcess.objects.count(), 0)
+        self.assertEqual(in_processes, self.chunk_hashes_and_contents(fake_s3))
+    
+    @patch("libs.s3.conn")
+    def test_binning_workers_errors_only_fail_their_files(self, conn: Mock):
+        # a call log with too few columns fails the call log fix, the power state files still process.
+        fake_s3 = self.fake_s3_power_state_files(conn)
+        path = f"{self.study_participant_start}/callLog/1768928568332.csv"
+        fake_s3[path + ".zst"] = self.true_default_s3_form(b"hashed phone number,call type\nabc,Missed Call")
+        S3File(path=path + ".zst", sha1=path.encode()[:16]).save()
+        self.generate_file_to_process(path=path, os_type=ANDROID_API)
+        
+        tracker = FileProcessingTracker(self.default_participant, binning_workers=2)
+        tracker.error_handler = ErrorHandler()
+        # a thread pool runs the same tasks without starting processes
+        with ThreadPoolExecutor(2) as pool, \
+                patch("libs.file_processing.file_processing_core.get_binning_pool", return_value=pool), \
+                patch("libs.file_processing.file_processing_core.logd"):
+            tracker.process_user_file_chunks()
+        
+        self.assertEqual(list(FileToProcess.objects.values_list("s3_file_path", flat=True)), [path])
+        self.assertEqual(len(self.chunk_hashes_and_contents(fake_s3)), 2)
+        self.assertEqual(len(tracker.error_handler.errors), 1)
+    
+    @patch("libs.s3.conn")
+    def test_binning_workers_broken_pool_retains_files(self, conn: Mock):
+        self.fake_s3_power_state_files(conn)
+        broken_future = Future()
+        broken_future.set_exception(BrokenProcessPool("a worker process died"))
+        pool = Mock(submit=Mock(return_value=broken_future))
+        
+        tracker = FileProcessingTracker(self.default_participant, binning_workers=2)
+        tracker.error_handler = ErrorHandler()
+        with patch("libs.file_processing.file_processing_core.get_binning_pool", return_value=pool), \
+                patch("libs.file_processing.file_processing_core.shutdown_binning_pool") as shutdown, \
+                patch("libs.file_processing.file_processing_core.logd"):
+            tracker.process_user_file_chunks()
+        
+        shutdown.assert_called()
+        self.assertEqual(FileToProcess.objects.count(), 3)
+        self.assertEqual(ChunkRegistry.objects.count(), 0)
+    
+    @patch("libs.s3.conn")
+    def test_binning_workers_pool_failures_fail_only_their_files(self, conn: Mock):
+        # the pool can fail to start its processes, or fail a submit, the files fail individually.
+        self.fake_s3_power_state_files(conn)
+        broken_pool = Mock(submit=Mock(side_effect=BrokenProcessPool("a worker process died")))
+        for get_binning_pool in (Mock(side_effect=OSError("can't start a process")), Mock(return_value=broken_pool)):
+            tracker = FileProcessingTracker(self.default_participant, binning_workers=2)
+            tracker.error_handler = ErrorHandler()
+            with patch("libs.file_processing.file_processing_core.get_binning_pool", get_binning_pool), \
+                    patch("libs.file_processing.file_processing_core.shutdown_binning_pool") as shutdown, \
+                    patch("libs.file_processing.file_processing_core.logd"):
+                tracker.process_user_file_chunks()
+            
+            shutdown.assert_called()
+            self.assertEqual(FileToProcess.objects.count(), 3)
+            self.assertEqual(ChunkRegistry.objects.count(), 0)
+            self.assertEqual(len(tracker.error_handler.errors), 3)
+    
+    # chunk cache
+    
+    def chunk_downloads(self, conn: Mock) -> list[str]:
+        return [
+            call.kwargs["Key"] for call in conn.get_object.call_args_list
+            if call.kwargs["Key"].startswith(CHUNKS_FOLDER)
+        ]
+    
+    @patch("libs.s3.conn")
+    def test_chunk_cache_skips_chunk_download(self, conn: Mock):
+        uncached = self.process_power_state_files_one_per_page(conn, pipeline_depth=0)
+        self.assertEqual(len(self.chunk_downloads(conn)), 1)  # the second page merges into the first's chunk
+        
+        for pipeline_depth in (0, 2):
+            ChunkRegistry.objects.all().delete()
+            S3File.objects.all().delete()
+            conn.reset_mock()
+            with TemporaryDirectory() as directory:
+                chunk_cache = ChunkCache(directory, 1024 * 1024)
+                cached = self.process_power_state_files_one_per_page(conn, pipeline_depth, chunk_cache)
+                self.assertEqual(len(os.listdir(directory)), 2)
+            self.assertEqual(cached, uncached)
+            self.assertEqual(self.chunk_downloads(conn), [])
+            self.assertEqual((chunk_cache.hits, chunk_cache.misses), (1, 0))
+    
+    @patch("libs.s3.conn")
+    def test_chunk_cache_does_not_return_a_chunk_that_has_changed(self, conn: Mock):
+        with TemporaryDirectory() as directory:
+            chunk_cache = ChunkCache(directory, 1024 * 1024)
+            fake_s3 = self.fake_s3_power_state_files(conn)
+            tracker = FileProcessingTracker(self.default_participant, page_size=1, chunk_cache=chunk_cache)
+            # stop after the first page, the shared chunk is then updated "by another server"
+            tracker.get_paginated_files_to_process = lambda: iter([list(FileToProcess.objects.order_by("pk")[:1])])
+            with patch("libs.file_processing.file_processing_core.logd"):
+                tracker.process_user_file_chunks()
+            
+            chunk_path, = ChunkRegistry.objects.values_list("chunk_path", flat=True)
+            elsewhere = b"timestamp,UTC time,event,level\n1768928500000,2026-01-20T17:01:40.000,Locked,0.5\n"
+            fake_s3[chunk_path + ".zst"] = self.true_default_s3_form(elsewhere)
+            S3File.objects.filter(path=chunk_path + ".zst").update(sha1=hashlib.sha1(elsewhere).digest())
+            
+            conn.reset_mock()
+            with patch("libs.file_processing.file_processing_core.logd"):
+                FileProcessingTracker(self.default_participant, chunk_cache=chunk_cache).process_user_file_chunks()
+        
+        self.assertEqual(self.chunk_downloads(conn), [chunk_path + ".zst"])
+        self.assertEqual((chunk_cache.hits, chunk_cache.misses), (0, 1))
+        contents = self.chunk_hashes_and_contents(fake_s3)[chunk_path][1]
+        self.assertIn(b"1768928500000", contents)  # the other server's data was merged with ours
+        self.assertIn(b"1768929245717", contents)
+    
+    # chunk segments
+    
+    @patch("libs.file_processing.csv_merger.compactable_before")
+    @patch("libs.s3.conn")
+    def test_chunk_segments_are_merged_on_download_and_compacted(self, conn: Mock, compactable_before: Mock):
+        rewritten = self.process_power_state_files_one_per_page(conn, pipeline_depth=0)
+        
+        # the test data is from January, pretend that is recent
+        compactable_before.return_value = datetime(2026, 1, 1, tzinfo=UTC)
+        for pipeline_depth in (0, 2):
+            ChunkRegistry.objects.all().delete()
+            S3File.objects.all().delete()
+            SummaryStatisticDaily.objects.all().delete()
+            conn.reset_mock()
+            fake_s3 = self.fake_s3_power_state_files(conn)
+            tracker = FileProcessingTracker(
+                self.default_participant, page_size=1, pipeline_depth=pipeline_depth, max_segments=4
+            )
+            with patch("libs.file_processing.file_processing_core.logd"):
+                tracker.process_user_file_chunks()
+            self.assertEqual(self.chunk_downloads(conn), [])  # the second page wrote a segment
+        
+        shared_chunk = ChunkRegistry.objects.get(segment_count=1)
+        segment_path = construct_segment_path(shared_chunk.chunk_path, 1)
+        self.assertIn(segment_path + ".zst", fake_s3)
+        self.assertTrue(S3File.objects.filter(path=segment_path + ".zst").exists())
+        self.assertEqual(shared_chunk.s3_retrieve(), rewritten[shared_chunk.chunk_path][1])
+        self.assertEqual(reconcile_data_quantity_stats(self.default_participant, fix=False), [])
+        
+        # downloads get the merged chunk
+        chunk_values = ChunkRegistry.objects.filter(pk=shared_chunk.pk).values(*CHUNK_FIELDS).get()
+        zip_generator = ZipGenerator(self.default_study, [], False, 1, as_compressed=False)
+        self.assertEqual(zip_generator._retrieve_decompress(chunk_values)[1], rewritten[shared_chunk.chunk_path][1])
+        zip_generator = ZipGenerator(self.default_study, [], False, 1, as_compressed=True)
+        self.assertEqual(decompress(zip_generator._retrieve_no_decompress(chunk_values)[1]), rewritten[shared_chunk.chunk_path][1])
+        
+        # and are not skipped by a registry, even if the hashes match
+        registry = {
+            chunk["chunk_path"].replace("CHUNKED_DATA/", "", 1): b64encode(chunk["sha1"]).decode()
+            for chunk in combined_chunk_query(ChunkRegistry.objects.all(), CHUNK_FIELDS)
+        }
+        filtered = filter_chunks_by_registry(combined_chunk_query(ChunkRegistry.objects.all(), CHUNK_FIELDS), registry)
+        self.assertEqual([chunk["chunk_path"] for chunk in filtered], [shared_chunk.chunk_path])
+        
+        # compaction (the chunks are not recent for compaction) rewrites the chunk and deletes the segment
+        with patch("libs.file_processing.file_processing_core.logd"):
+            FileProcessingTracker(self.default_participant).compact_chunk_segments()
+        self.assertNotIn(segment_path + ".zst", fake_s3)
+        self.assertFalse(S3File.objects.filter(path=segment_path + ".zst").exists())
+        self.assertEqual(ChunkRegistry.objects.filter(segment_count__gt=0).count(), 0)
+        self.assertEqual(self.chunk_hashes_and_contents(fake_s3), rewritten)
+        self.assertEqual(reconcile_data_quantity_stats(self.default_participant, fix=False), [])
+    
+    @patch("libs.file_processing.csv_merger.compactable_before")
+    @patch("libs.s3.conn")
+    def test_rewritten_chunk_replaces_its_segments(self, conn: Mock, compactable_before: Mock):
+        rewritten = self.process_power_state_files_one_per_page(conn, pipeline_depth=0)
+        ChunkRegistry.objects.all().delete()
+        S3File.objects.all().delete()
+        SummaryStatisticDaily.objects.all().delete()
+        
+        compactable_before.return_value = datetime(2026, 1, 1, tzinfo=UTC)  # the test data is recent
+        fake_s3 = self.fake_s3_power_state_files(conn)
+        tracker = FileProcessingTracker(self.default_participant, page_size=1, pipeline_depth=0, max_segments=4)
+        with patch("libs.file_processing.file_processing_core.logd"):
+            tracker.process_user_file_chunks()
+        shared_chunk = ChunkRegistry.objects.get(segment_count=1)
+        segment_path = construct_segment_path(shared_chunk.chunk_path, 1) + ".zst"
+        self.assertIn(segment_path, fake_s3)
+        
+        # the same data again, for a chunk that has all the segments it may have, rewrites the chunk
+        path = f"{self.study_participant_start}/powerState/1768929300000.csv"
+        fake_s3[path + ".zst"] = self.true_default_s3_form(FILE_DATA2)
+        S3File(path=path + ".zst", sha1=path.encode()[:16]).save()
+        self.generate_file_to_process(path=path, os_type=ANDROID_API)
+        tracker = FileProcessingTracker(self.default_participant, page_size=1, pipeline_depth=0, max_segments=1)
+        with patch("libs.file_processing.file_processing_core.logd"):
+            tracker.process_user_file_chunks()
+        
+        shared_chunk.refresh_from_db()
+        self.assertEqual(shared_chunk.segment_count, 0)
+        self.assertNotIn(segment_path, fake_s3)
+        self.assertFalse(S3File.objects.filter(path=segment_path).exists())
+        self.assertEqual(self.chunk_hashes_and_contents(fake_s3), rewritten)
+        self.assertEqual(reconcile_data_quantity_stats(self.default_participant, fix=False), [])
+    
+    # bulk ChunkRegistry writes
+    
+    def chunk_kwargs_for_bins(self, time_bins: range, chunk_hash: str) -> list[dict]:
+        return [
+            {
+                "study_id": self.default_study.id,
+                "participant_id": self.default_participant.id,
+                "data_type": POWER_STATE,
+                "chunk_path": construct_s3_chunk_path(
+                    self.default_study.object_id, self.default_participant.patient_id, POWER_STATE, time_bin, None
+                ),
+                "chunk_hash": chunk_hash,
+                "time_bin": time_bin,
+                "survey_id": None,
+                "file_size": time_bin,
+            }
+            for time_bin in time_bins
+        ]
+    
+    def test_bulk_register_chunked_data_query_count_is_constant(self):
+        self.using_default_participant()
+        for bin_count in (1, 50):
+            ChunkRegistry.objects.all().delete()
+            new_chunks = self.chunk_kwargs_for_bins(range(BIN_1, BIN_1 + bin_count), "new_hash")
+            existing = self.chunk_kwargs_for_bins(range(BIN_1 + bin_count, BIN_1 + bin_count * 2), "old_hash")
+            for chunk_kwargs in existing:
+                ChunkRegistry.register_chunked_data(**chunk_kwargs)
+            updated = {kwargs["chunk_path"]: {"chunk_hash": "updated_hash", "file_size": 1} for kwargs in existing}
+            
+            # savepoint, select, insert, select, update, release savepoint
+            with self.assertNumQueries(6):
+                ChunkRegistry.bulk_register_chunked_data(new_chunks, updated)
+            
+            self.assertEqual(ChunkRegistry.objects.filter(chunk_hash="new_hash").count(), bin_count)
+            self.assertEqual(ChunkRegistry.objects.filter(chunk_hash="updated_hash", file_size=1).count(), bin_count)
+    
+    def test_bulk_register_chunked_data_matches_register_chunked_data(self):
+        self.using_default_participant()
+        chunk_kwargs, = self.chunk_kwargs_for_bins(range(BIN_1, BIN_1 + 1), b"hash")  # bytes hash is decoded
+        ChunkRegistry.register_chunked_data(**chunk_kwargs)
+        fields = ("chunk_path", "chunk_hash", "data_type", "time_bin", "file_size", "is_chunkable", "study_id", "participant_id", "survey_id")
+        expected = list(ChunkRegistry.objects.values_list(*fields))
+        ChunkRegistry.objects.all().delete()
+        
+        ChunkRegistry.bulk_register_chunked_data([chunk_kwargs], {})
+        self.assertEqual(list(ChunkRegistry.objects.values_list(*fields)), expected)
+        self.assertEqual(chunk_kwargs["time_bin"], BIN_1)  # the caller's kwargs are not modified
+        
+        chunk_kwargs["data_type"] = AUDIO_RECORDING
+        with self.assertRaises(UnchunkableDataTypeError):
+            ChunkRegistry.bulk_register_chunked_data([chunk_kwargs], {})
+    
+    def test_bulk_register_chunked_data_retry_is_idempotent(self):
+        # a retried task registers new chunks that its first attempt already registered, and updates
+        # chunks that may have been deleted since.
+        self.using_default_participant()
+        new_chunks = self.chunk_kwargs_for_bins(range(BIN_1, BIN_1 + 3), "first_hash")
+        ChunkRegistry.bulk_register_chunked_data(new_chunks[:2], {})  # the first attempt got part way
+        first_attempt = dict(ChunkRegistry.objects.values_list("chunk_path", "pk"))
+        
+        retried = self.chunk_kwargs_for_bins(range(BIN_1, BIN_1 + 3), "retry_hash")
+        missing_path = "CHUNKED_DATA/not/a/real/chunk.csv"
+        changes = ChunkRegistry.bulk_register_chunked_data(
+            retried, {missing_path: {"chunk_hash": "x", "file_size": 1}}
+        )
+        # only the chunk that the first attempt did not register changes the data quantity stats
+        self.assertEqual([change for _, _, change in changes], [0, 0, BIN_1 + 2])
+        changes = ChunkRegistry.bulk_register_chunked_data(retried, {})  # and again
+        self.assertEqual([change for _, _, change in changes], [0, 0, 0])
+        
+        self.assertEqual(ChunkRegistry.objects.count(), 3)
+        self.assertEqual(set(ChunkRegistry.objects.values_list("chunk_hash", flat=True)), {"retry_hash"})
+        for chunk_path, pk in first_attempt.items():  # the rows were updated, not replaced
+            self.assertEqual(ChunkRegistry.objects.get(chunk_path=chunk_path).pk, pk)
+    
+    def unchunkable_files(self, count: int) -> list[tuple[str, int, str, int]]:
+        # data type, timestamp, path, size
+        files = []
+        for i in range(count):
+            timestamp_ms = 1768928568332 + i * 60_000
+            path = f"{self.study_participant_start}/ambientAudio/{timestamp_ms}.wav"
+            files.append((AMBIENT_AUDIO, timestamp_ms // 1000, path, 100 + i))
+        return files
+    
+    def unchunked_registrations(self, files: list[tuple[str, int, str, int]]) -> list[ChunkRegistry]:
+        return [
+            ChunkRegistry.build_unchunked_registration(
+                data_type, timestamp, path, self.default_study.pk, self.default_participant.pk, size
+            )
+            for data_type, timestamp, path, size in files
+        ]
+    
+    def test_bulk_register_unchunked_data_matches_register_unchunked_data(self):
+        self.using_default_participant()
+        (data_type, timestamp, path, size), = self.unchunkable_files(1)
+        ChunkRegistry.register_unchunked_data(
+            data_type, timestamp, path, self.default_study.pk, self.default_participant.pk, b"x" * size
+        )
+        fields = ("chunk_path", "chunk_hash", "data_type", "time_bin", "file_size", "is_chunkable", "study_id", "participant_id", "survey_id")
+        expected = list(ChunkRegistry.objects.values_list(*fields))
+        ChunkRegistry.objects.all().delete()
+        
+        changes = ChunkRegistry.bulk_register_unchunked_data(
+            self.unchunked_registrations([(data_type, timestamp, path, size)])
+        )
+        self.assertEqual(list(ChunkRegistry.objects.values_list(*fields)), expected)
+        self.assertEqual(changes, [(datetime.fromtimestamp(timestamp, UTC), data_type, size)])
+        
+        with self.assertRaises(ChunkableDataTypeError):
+            self.unchunked_registrations([(POWER_STATE, timestamp, path, size)])
+        with self.assertRaises(ValidationError):
+            self.unchunked_registrations([(data_type, timestamp, "x" * 257, size)])  # path too long
+    
+    def test_bulk_register_unchunked_data_query_count_is_constant(self):
+        self.using_default_participant()
+        for file_count in (1, 50):
+            ChunkRegistry.objects.all().delete()
+            files = self.unchunkable_files(file_count * 2)
+            chunks = self.unchunked_registrations(files)
+            for data_type, timestamp, path, _ in files[file_count:]:  # re-uploads, with a new size
+                ChunkRegistry.register_unchunked_data(
+                    data_type, timestamp, path, self.default_study.pk, self.default_participant.pk, b"x"
+                )
+            
+            # savepoint, select, update, insert, release savepoint
+            with self.assertNumQueries(5):
+                changes = ChunkRegistry.bulk_register_unchunked_data(chunks)
+            
+            self.assertEqual(ChunkRegistry.objects.count(), file_count * 2)
+            self.assertEqual(
+                dict(ChunkRegistry.objects.values_list("chunk_path", "file_size")),
+                {path: size for _, _, path, size in files},
+            )
+            self.assertEqual(
+                sorted(change for _, _, change in changes),
+                sorted([size for *_, size in files[:file_count]] + [size - 1 for *_, size in files[file_count:]]),
+            )
+    
+    def test_bulk_register_unchunked_data_duplicate_path_in_page(self):
+        self.using_default_participant()
+        (data_type, timestamp, path, size), = self.unchunkable_files(1)
+        ChunkRegistry.bulk_register_unchunked_data(
+            self.unchunked_registrations([(data_type, timestamp, path, size), (data_type, timestamp, path, size + 5)])
+        )
+        self.assertEqual(list(ChunkRegistry.objects.values_list("chunk_path", "file_size")), [(path, size + 5)])
+    
+    @patch("libs.s3.conn")
+    def test_unchunkable_files_are_registered_in_bulk(self, conn: Mock):
+        contents = b"ambient audio data"
+        encrypted = self.true_default_s3_form(contents)
+        conn.get_object.side_effect = lambda **kwargs: {"Body": BytesIO(encrypted)}
+        files = self.unchunkable_files(20)
+        for _, _, path, _ in files:
+            self.generate_file_to_process(path=path, os_type=ANDROID_API)
+        data_type, timestamp, path, _ = files[0]  # one was processed before
+        ChunkRegistry.register_unchunked_data(
+            data_type, timestamp, path, self.default_study.pk, self.default_participant.pk, b"x"
+        )
+        
+        tracker = FileProcessingTracker(self.default_participant, pipeline_depth=0)
+        with patch("libs.file_processing.file_processing_core.logd"):
+            tracker.process_user_file_chunks()
+        
+        self.assertEqual(FileToProcess.objects.count(), 0)
+        self.assertEqual(
+            dict(ChunkRegistry.objects.filter(is_chunkable=False).values_list("chunk_path", "file_size")),
+            {path: len(contents) for _, _, path, _ in files},
+        )
+        self.assertEqual(tracker.unchunkable_files, [])
+    
+    @patch("libs.s3.conn")
+    def test_invalid_unchunkable_file_fails_alone(self, conn: Mock):
+        contents = b"ambient audio data"
+        encrypted = self.true_default_s3_form(contents)
+        conn.get_object.side_effect = lambda **kwargs: {"Body": BytesIO(encrypted)}
+        files = self.unchunkable_files(5)
+        for _, _, path, _ in files:
+            self.generate_file_to_process(path=path, os_type=ANDROID_API)
+        bad_path = files[2][2]
+        build = ChunkRegistry.build_unchunked_registration
+        
+        def build_or_fail(data_type, timestamp, chunk_path, *args):
+            if chunk_path == bad_path:
+                raise ValidationError("bad file")
+            return build(data_type, timestamp, chunk_path, *args)
+        
+        tracker = FileProcessingTracker(self.default_participant, pipeline_depth=0)
+        tracker.error_handler = ErrorHandler()
+        with patch.object(ChunkRegistry, "build_unchunked_registration", side_effect=build_or_fail), \
+                patch("libs.file_processing.file_processing_core.logd"):
+            tracker.process_user_file_chunks()
+        
+        self.assertEqual(list(FileToProcess.objects.values_list("s3_file_path", flat=True)), [bad_path])
+        self.assertEqual(
+            set(ChunkRegistry.objects.values_list("chunk_path", flat=True)),
+            {path for _, _, path, _ in files if path != bad_path},
+        )
+        self.assertEqual(len(tracker.error_handler.errors), 1)
+    
+    def test_register_unchunkable_files_query_count_is_constant(self):
+        query_counts = []
+        for file_count in (1, 20):
+            tracker = FileProcessingTracker(self.default_participant)
+            files = self.unchunkable_files(file_count)
+            for chunk in self.unchunked_registrations(files):
+                ftp = self.generate_file_to_process(path=chunk.chunk_path, os_type=ANDROID_API)
+                tracker.unchunkable_files.append((ftp.pk, chunk))
+            with CaptureQueriesContext(connection) as queries:
+                tracker.register_unchunkable_files()
+            query_counts.append(len(queries))
+            self.assertEqual(FileToProcess.objects.count(), 0)
+            self.assertEqual(len(tracker.data_quantity_changes), file_count)
+            ChunkRegistry.objects.all().delete()
+        self.assertEqual(query_counts[0], query_counts[1])
+    
+    @patch("libs.s3.conn")
+    def test_retry_after_upload_failure_mid_page_matches_clean_run(self, conn: Mock):
+        clean = self.process_power_state_files_one_per_page(conn, pipeline_depth=0)
+        self.assertEqual(len(clean), 2)
+        ChunkRegistry.objects.all().delete()
+        S3File.objects.all().delete()
+        
+        # all three files in one page, the second chunk upload fails
+        fake_s3 = self.fake_s3_power_state_files(conn)
+        put_object = conn.put_object.side_effect
+        upload_count = 0
+        
+        def failing_put_object(Body: bytes, Bucket: str, Key: str):
+            nonlocal upload_count
+            upload_count += 1
+            if upload_count == 2:
+                raise ValueError("upload failed")  # not a retryable error
+            put_object(Body=Body, Bucket=Bucket, Key=Key)
+        
+        conn.put_object.side_effect = failing_put_object
+        with patch("libs.file_processing.file_processing_core.logd"):
+            with self.assertRaises(ValueError):
+                FileProcessingTracker(self.default_participant).process_user_file_chunks()
+        
+        # the chunk that was uploaded is registered, the files remain to be processed
+        self.assertEqual(ChunkRegistry.objects.count(), 1)
+        self.assertEqual(FileToProcess.objects.count(), 3)
+        
+        with patch("libs.file_processing.file_processing_core.logd"):
+            FileProcessingTracker(self.default_participant).process_user_file_chunks()
+        self.assertEqual(FileToProcess.objects.count(), 0)
+        self.assertEqual(self.chunk_hashes_and_contents(fake_s3), clean)
+    
+    # data quantity stats
+    
+    def data_quantity_stats(self) -> dict[date, tuple[int | None, str]]:
+        return {
+            day: (power_state_bytes, tz)
+            for day, power_state_bytes, tz in SummaryStatisticDaily.objects.filter(
+                participant=self.default_participant
+            ).values_list("date", "beiwe_power_state_bytes", "timezone")
+        }
+    
+    @patch("libs.s3.conn")
+    def test_processing_updates_data_quantity_stats_incrementally(self, conn: Mock):
+        # three pages, the second page merges into the first page's chunk, so that is an update
+        self.process_power_state_files_one_per_page(conn, pipeline_depth=0)
+        serial_stats = self.data_quantity_stats()
+        chunk_bytes = sum(ChunkRegistry.objects.values_list("file_size", flat=True))
+        self.assertEqual(sum(power_state_bytes for power_state_bytes, _ in serial_stats.values()), chunk_bytes)
+        self.assertEqual(reconcile_data_quantity_stats(self.default_participant, fix=False), [])
+        
+        ChunkRegistry.objects.all().delete()
+        S3File.objects.all().delete()
+        SummaryStatisticDaily.objects.all().delete()
+        self.process_power_state_files_one_per_page(conn, pipeline_depth=2)
+        self.assertEqual(self.data_quantity_stats(), serial_stats)
+    
+    @patch("libs.s3.conn")
+    def test_easy_run_batch_isolates_participant_errors(self, conn: Mock):
+        fake_s3 = self.fake_s3_power_state_files(conn)
+        missing_participant_id = self.default_participant.pk + 1000
+        error_handler = ErrorHandler()
+        with patch("libs.file_processing.file_processing_core.logd"), \
+                patch("libs.file_processing.file_processing_core.log"):
+            runs = easy_run_batch(
+                [missing_participant_id, self.default_participant.pk], error_handler=error_handler
+            )
+        
+        # the missing participant fails, the next participant is still processed.
+        self.assertEqual([(pk, outcome) for pk, _, outcome in runs], [
+            (missing_participant_id, RUN_FAILED), (self.default_participant.pk, RUN_FINISHED)
+        ])
+        self.assertEqual(len(error_handler.errors), 1)
+        self.assertFalse(FileToProcess.objects.exists())
+        self.assertEqual(len(self.chunk_hashes_and_contents(fake_s3)), 2)
+    
+    def test_easy_run_batch_shares_thread_pool_and_time_limit(self):
+        p1 = self.default_participant
+        p2 = self.generate_participant(self.default_study)
+        p3 = self.generate_participant(self.default_study)
+        times = chain([0, 1000, 1700], repeat(1800))  # the third participant is out of time
+        with patch("libs.file_processing.file_processing_core.easy_run") as easy_run_mock, \
+                patch("libs.file_processing.file_processing_core.log"), \
+                patch("libs.file_processing.file_processing_core.timezone.now",
+                      lambda: datetime(2026, 1, 1, tzinfo=UTC) + timedelta(seconds=next(times))):
+            runs = easy_run_batch([p1.pk, p2.pk, p3.pk])
+        
+        self.assertEqual([outcome for _, _, outcome in runs], [RUN_FINISHED, RUN_FINISHED, RUN_SKIPPED])
+        (participant_1, time_limit_1, pool_1), (participant_2, time_limit_2, pool_2) = \
+            [call.args for call in easy_run_mock.call_args_list]
+        self.assertEqual([participant_1, participant_2], [p1, p2])
+        self.assertEqual(time_limit_1, PROCESSING_TIME_LIMIT - timedelta(seconds=1000))
+        self.assertEqual(time_limit_2, PROCESSING_TIME_LIMIT - timedelta(seconds=1700))
+        self.assertIs(pool_1, pool_2)
+    
+    def test_apply_data_quantity_changes(self):
+        self.using_default_participant()
+        tz = self.default_study.timezone
+        # 2am UTC on the 21st is still the 20th in New York
+        first_day, second_day = date(2026, 1, 20), date(2026, 1, 21)
+        late_bin = datetime(2026, 1, 21, 2, tzinfo=UTC)
+        next_bin = datetime(2026, 1, 21, 20, tzinfo=UTC)
+        for chunk_kwargs, time_bin in zip(self.chunk_kwargs_for_bins(range(BIN_1, BIN_1 + 2), "hash"), (late_bin, next_bin)):
+            chunk_kwargs["time_bin"] = int(time_bin.timestamp()) // CHUNK_TIMESLICE_QUANTUM
+            chunk_kwargs["file_size"] = 100
+            ChunkRegistry.register_chunked_data(**chunk_kwargs)
+        
+        # the first day has stats that get added to, the second day has none and is calculated.
+        SummaryStatisticDaily.objects.create(
+            the_study=self.default_study, participant=self.default_participant, date=first_day,
+            timezone="EST", beiwe_power_state_bytes=40, beiwe_gps_bytes=7,
+        )
+        changes = [(late_bin, POWER_STATE, 60), (late_bin, POWER_STATE, -10), (next_bin, POWER_STATE, 100)]
+        with self.assertNumQueries(5):  # savepoint, select, select (missing days), upsert, release
+            apply_data_quantity_changes(self.default_participant, changes)
+        
+        first, second = SummaryStatisticDaily.objects.order_by("date")
+        self.assertEqual((first.date, first.beiwe_power_state_bytes, first.beiwe_gps_bytes), (first_day, 90, 7))
+        self.assertEqual((second.date, second.beiwe_power_state_bytes, second.beiwe_gps_bytes), (second_day, 100, None))
+        self.assertEqual(second.timezone, get_timezone_shortcode(second_day, tz))
+        
+        # and a reconciliation corrects the first day to what the ChunkRegistry says
+        self.assertEqual(reconcile_data_quantity_stats(self.default_participant), [first_day])
+        first.refresh_from_db()
+        self.assertEqual((first.beiwe_power_state_bytes, first.beiwe_gps_bytes), (100, None))
+        self.assertEqual(reconcile_data_quantity_stats(self.default_participant), [])
+    
+    def test_reconcile_data_quantity_stats_creates_missing_days(self):
+        self.using_default_participant()
+        for chunk_kwargs in self.chunk_kwargs_for_bins(range(BIN_1, BIN_1 + 3), "hash"):
+            ChunkRegistry.register_chunked_data(**chunk_kwargs)
+        
+        self.assertEqual(reconcile_data_quantity_stats(self.default_participant, fix=False), [BIN_1_DT.astimezone(self.default_study.timezone).date()])
+        self.assertEqual(SummaryStatisticDaily.objects.count(), 0)
+        reconcile_data_quantity_stats(self.default_participant)
+        self.assertEqual(
+            SummaryStatisticDaily.objects.get().beiwe_power_state_bytes, BIN_1 * 3 + 3  # file_size is the time bin
+        )
+    
     @patch("libs.s3.conn")
     def test_easy_run_with_survey_timings_multiple_mixed_surveys(self, conn: Mock):
         # - Two different survey timings data
@@ -1930,6 +3111,130 @@ class TestFileProcessingTracker(CommonTestCase):
 
 # static data points for those last tests
 
+class TestProcessingScheduler(CommonTestCase):
+    
+    MB = 1024 * 1024
+    
+    def backlog(self, participant_id: int, pending_mb: float, hours_old: int, priority: int = 1):
+        oldest = datetime(2026, 1, 1, tzinfo=UTC) - timedelta(hours=hours_old)
+        return (participant_id, priority, 1, int(pending_mb * self.MB), oldest)
+    
+    def test_plan_processing_tasks_ranks_and_batches(self):
+        backlogs = [
+            self.backlog(1, 5000, hours_old=50),  # large
+            self.backlog(2, 100, hours_old=1),    # normal
+            self.backlog(3, 1, hours_old=2),      # small
+            self.backlog(4, 200, hours_old=5),    # normal, older
+            self.backlog(5, 2, hours_old=1),      # small
+            self.backlog(6, 1, hours_old=100, priority=0),  # small, stopped study
+        ]
+        tasks = plan_processing_tasks(backlogs)
+        
+        # small backlogs first, oldest first, then normal, then large with a short time limit, then
+        # the stopped study.
+        self.assertEqual(
+            tasks,
+            [
+                ([3, 5], PROCESSING_TIME_LIMIT),
+                ([4], PROCESSING_TIME_LIMIT),
+                ([2], PROCESSING_TIME_LIMIT),
+                ([1], LARGE_BACKLOG_TIME_LIMIT),
+                ([6], PROCESSING_TIME_LIMIT),
+            ]
+        )
+    
+    def test_plan_processing_tasks_caps_batches(self):
+        backlogs = [self.backlog(i, 0.1, hours_old=i) for i in range(BATCH_MAX_PARTICIPANTS + 5)]
+        backlogs += [self.backlog(100 + i, 15, hours_old=0) for i in range(10)]
+        tasks = plan_processing_tasks(backlogs)
+        
+        # batches are capped by participant count, then by size, 8 15MB participants fill a batch.
+        self.assertEqual(
+            [len(participant_ids) for participant_ids, _ in tasks], [BATCH_MAX_PARTICIPANTS, 13, 2]
+        )
+        self.assertEqual(tasks[0][0], list(range(BATCH_MAX_PARTICIPANTS + 4, 4, -1)))  # oldest first
+        self.assertEqual(tasks[1][0], [4, 3, 2, 1, 0, *range(100, 108)])
+    
+    def test_get_participant_backlogs(self):
+        p1 = self.default_participant
+        p2 = self.generate_participant(self.default_study)
+        stopped_study = self.generate_study("stopped study")
+        stopped_study.update(manually_stopped=True)
+        p3 = self.generate_participant(stopped_study)
+        
+        paths = [f"{self.default_study.object_id}/{p1.patient_id}/powerState/{i}.csv" for i in range(3)]
+        for path in paths:
+            self.generate_file_to_process(path, participant=p1)
+        S3File(path=paths[0] + ".zst", size_uncompressed=10).save()
+        S3File(path=paths[1] + ".zst", size_compressed=10).save()
+        self.generate_file_to_process("p2/powerState/0.csv", participant=p2)
+        self.generate_file_to_process("p3/powerState/0.csv", participant=p3)
+        
+        backlogs = {b[0]: b for b in get_participant_backlogs(exclude_participant_ids=[p2.pk])}
+        
+        oldest = FileToProcess.objects.filter(participant=p1).order_by("created_on").first().created_on
+        self.assertEqual(set(backlogs), {p1.pk, p3.pk})
+        self.assertEqual(
+            backlogs[p1.pk],
+            (p1.pk, 1, 3, 10 + 10 * ESTIMATED_COMPRESSION_RATIO + UNKNOWN_FILE_SIZE_ESTIMATE, oldest),
+        )
+        self.assertEqual(backlogs[p3.pk][1], 0)
+        self.assertEqual(backlogs[p3.pk][3], UNKNOWN_FILE_SIZE_ESTIMATE)
+    
+    def test_create_file_processing_tasks_with_memory_broker(self):
+        p1 = self.default_participant
+        p2 = self.generate_participant(self.default_study)
+        p3 = self.generate_participant(self.default_study)
+        for i, participant in enumerate([p1, p2, p3]):
+            self.generate_file_to_process(f"{participant.patient_id}/powerState/{i}.csv", participant=participant)
+        S3File(path=f"{p3.patient_id}/powerState/2.csv.zst", size_uncompressed=100 * self.MB).save()
+        
+        app = Celery("test_processing_scheduler", broker="memory://")
+        
+        @app.task(name="single")
+        def single_task(participant_id, time_limit_seconds): pass
+        
+        @app.task(name="batch")
+        def batch_task(participant_ids, time_limit_seconds): pass
+        
+        with patch.object(celery_data_processing, "daily_celery_process_file_chunks", single_task), \
+                patch.object(celery_data_processing, "daily_celery_process_file_chunks_batch", batch_task), \
+                patch.object(celery_data_processing, "get_processing_active_job_ids", lambda: [p2.pk]):
+            celery_data_processing.create_file_processing_tasks()
+        
+        messages = []
+        with app.connection_for_read() as connection:
+            queue = connection.SimpleQueue("celery")
+            while True:
+                try:
+                    message = queue.get(block=False)
+                except queue.Empty:
+                    break
+                args, kwargs, _ = message.decode()
+                messages.append((message.headers["task"], args, kwargs))
+                message.ack()
+            queue.close()
+        
+        # p2 is already running, p1 is small, p3 is not
+        time_limit = int(PROCESSING_TIME_LIMIT.total_seconds())
+        self.assertEqual(
+            messages,
+            [
+                ("single", [p1.pk], {"time_limit_seconds": time_limit}),
+                ("single", [p3.pk], {"time_limit_seconds": time_limit}),
+            ]
+        )
+        
+        schedule = DataProcessingSchedule.objects.get()
+        self.assertEqual(schedule.participant_count, 2)
+        self.assertEqual(schedule.task_count, 2)
+        self.assertEqual(schedule.already_running_count, 1)
+        self.assertEqual(schedule.pending_bytes, 100 * self.MB + UNKNOWN_FILE_SIZE_ESTIMATE)
+        self.assertEqual(
+            [task["participants"] for task in json.loads(schedule.tasks)], [[p1.pk], [p3.pk]]
+        )
+
+
 # File 1: Early hour timestamps
 FILE_DATA1 = b"""timestamp,event,level
 1768928568332,Locked,0.7
@@ -1,10 +1,15 @@
 import csv
-from datetime import date
-from io import StringIO
+import os
+from datetime import date, datetime
+from io import BytesIO, StringIO
+from tempfile import TemporaryDirectory
+from unittest.mock import Mock, patch
 
+from constants.common_constants import CHUNKS_FOLDER, UTC
+from constants.data_stream_constants import POWER_STATE
 from constants.forest_constants import ForestTree
 from database.forest_models import ForestTask, SummaryStatisticDaily
-from services.celery_forest import BadForestField, csv_parse_and_consume
+from services.celery_forest import BadForestField, batch_create_file, csv_parse_and_consume
 from tests.common import CommonTestCase
 
 
@@ -247,3 +252,40 @@ class TestFileConsumption(CommonTestCase):
     #     with self.assertRaises(BadForestField):
     #         self.call_csv_parse_and_consume(self.default_forest_task, csv_dict_rows)
     #     self.assertEqual(SummaryStatisticDaily.objects.count(), 0)
+
+
+class TestBatchCreateFile(CommonTestCase):
+    
+    CONTENTS = b"timestamp,event\n" + b"".join(b"%d,Unlocked\n" % (1768928568332 + i) for i in range(10_000))
+    
+    def chunk(self) -> dict:
+        participant_folder = f"{self.default_study.object_id}/{self.default_participant.patient_id}"
+        return {
+            "chunk_path": f"{CHUNKS_FOLDER}/{participant_folder}/powerState/2026-01-20T17:00:00.csv",
+            "study__object_id": self.default_study.object_id,
+            "segment_count": 0,
+            "participant__patient_id": self.default_participant.patient_id,
+            "time_bin": datetime(2026, 1, 20, 17, tzinfo=UTC),
+            "data_type": POWER_STATE,
+        }
+    
+    @patch("libs.s3.conn")
+    def test_chunk_is_streamed_into_the_file(self, conn: Mock):
+        conn.get_object.return_value = {"Body": BytesIO(self.true_default_s3_form(self.CONTENTS))}
+        with TemporaryDirectory() as folder:
+            batch_create_file((Mock(data_input_path=folder), self.chunk()))
+            file_names = [os.path.join(root, name) for root, _, names in os.walk(folder) for name in names]
+            self.assertEqual(len(file_names), 1)
+            with open(file_names[0], "rb") as f:
+                self.assertEqual(f.read(), self.CONTENTS)
+        self.assertEqual(conn.get_object.call_count, 1)
+    
+    @patch("libs.s3.conn")
+    def test_no_partial_file_is_left_on_error(self, conn: Mock):
+        encrypted = bytearray(self.true_default_s3_form(self.CONTENTS))
+        encrypted[-1] ^= 1  # the tag at the end doesn't verify
+        conn.get_object.return_value = {"Body": BytesIO(bytes(encrypted))}
+        with TemporaryDirectory() as folder:
+            with self.assertRaises(ValueError):
+                batch_create_file((Mock(data_input_path=folder), self.chunk()))
+            self.assertEqual([name for _, _, names in os.walk(folder) for name in names], [])
@@ -1002,6 +1002,21 @@ class TestMobileUpload(ParticipantSessionTest):
         
         self.assert_no_files_to_process
     
+    @patch("libs.endpoint_helpers.participant_file_upload_helpers.s3_upload")
+    @patch("libs.s3.s3_retrieve")
+    def test_private_key_is_downloaded_once_per_burst(self, s3_retrieve: MagicMock, s3_upload: MagicMock):
+        with open(f"{BEIWE_PROJECT_ROOT}/tests/files/private_key", 'rb') as f:
+            s3_retrieve.return_value = f.read()
+        
+        with patch("endpoints.mobile_endpoints.SentryUtils") as mock_sentry_utils:
+            mock_sentry_utils.report_webserver = MagicMock()
+            mock_sentry_utils.report_webserver.return_value = err_h = ErrorHandler()
+            for i in range(5):
+                self.smart_post_status_code(200, file_name=f"whatever{i}.csv", file="some_content")
+        
+        err_h.errors.clear()
+        s3_retrieve.assert_called_once()
+    
     def test_deleted_participant(self):
         self.INJECT_DEVICE_TRACKER_PARAMS = False
         self.INJECT_RECEIVED_SURVEY_UUIDS = False
@@ -1,17 +1,22 @@
 # trunk-ignore-all(bandit/B101,bandit/B106,ruff/B018,ruff/E701)
 import hashlib
 import time
+import tracemalloc
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from io import BytesIO
+from random import Random
 from typing import Optional
 from unittest.mock import _Call, MagicMock, Mock, patch
 
 import dateutil
+from botocore.exceptions import ClientError as Boto3ClientError
 from dateutil.tz import gettz
 from django.utils import timezone
 
-from constants.common_constants import API_TIME_FORMAT, CHUNKS_FOLDER, EASTERN, UTC
+from constants.common_constants import (API_TIME_FORMAT, BEIWE_PROJECT_ROOT, CHUNKS_FOLDER, EASTERN,
+    UTC)
 from constants.data_stream_constants import (ACCELEROMETER, ALL_DATA_STREAMS,
     ANDROID_LOG_FILE, AUDIO_RECORDING, BLUETOOTH, CALL_LOG, DEVICEMOTION, GPS, GYRO, IDENTIFIERS,
     IOS_LOG_FILE, MAGNETOMETER, POWER_STATE, PROXIMITY, REACHABILITY, SURVEY_ANSWERS,
@@ -27,23 +32,33 @@ from constants.s3_constants import (COMPRESSED_DATA_MISSING_AT_UPLOAD,
     UNCOMPRESSED_DATA_PRESENT_ON_ASSIGNMENT, UNCOMPRESSED_DATA_PRESENT_ON_DOWNLOAD,
     UNCOMPRESSED_DATA_PRESENT_WRONG_AT_UPLOAD)
 from constants.user_constants import ACTIVE_PARTICIPANT_FIELDS, ANDROID_API, IOS_API
-from database.models import ArchivedEvent, ForestVersion, S3File, ScheduledEvent
+from database.models import (ArchivedEvent, DataProcessingRun, ForestVersion, S3File,
+    ScheduledEvent, Study)
 from database.profiling_models import EncryptionErrorMetadata, UploadTracking
 from database.user_models_participant import (AppHeartbeats, AppVersionHistory,
     DeviceStatusReportHistory, Participant, ParticipantActionLog, ParticipantDeletionEvent,
     PushNotificationDisabledEvent, SurveyNotificationReport)
-from libs.aes import encrypt_for_server
+from libs.aes import (decrypt_server, decrypt_server_into, decrypted_size, encrypt_for_server,
+    encrypt_for_server_into, encrypted_size, GCM_OVERHEAD, is_legacy_server_encryption,
+    legacy_encrypt_for_server, SERVER_ENCRYPTION_MAGIC, SERVER_ENCRYPTION_VERSION, ServerDecryptor)
 from libs.celery_control import DebugCeleryApp
 from libs.endpoint_helpers.participant_table_helpers import determine_registered_status
+from libs.file_processing.utility_functions_csvs import (construct_csv_as_bytes,
+    construct_csv_as_bytes_with_set, split_csv_rows, TIMESTAMP_GROUP_SET_SIZE)
 from libs.file_processing.utility_functions_simple import (BadTimecodeError, binify_from_timecode,
     clean_java_timecode, convert_unix_to_human_readable_timestamps, ensure_sorted_by_timestamp,
-    normalize_s3_file_path, resolve_survey_id_from_file_name, s3_file_path_to_data_type)
+    merge_sorted_rows_as_csv_bytes, normalize_s3_file_path, resolve_survey_id_from_file_name,
+    s3_file_path_to_data_type, sort_rows_by_timestamp_keys, timestamp_sort_keys)
 from libs.participant_purge import (confirm_deleted, get_all_file_path_prefixes,
     run_next_queued_participant_data_deletion)
-from libs.s3 import BadS3PathException, decrypt_server, NoSuchKeyException, S3Storage
+from libs.rsa import (create_participant_key_pair, get_participant_private_key, get_RSA_cipher,
+    ParticipantKeyCache)
+from libs.s3 import (BadS3PathException, DataException, get_just_prefix, NoSuchKeyException, s3_open,
+    S3Storage, smart_get_study_encryption_key, StudyKeyCache)
 from libs.streaming_zip import determine_base_file_name
-from libs.utils.compression import compress
+from libs.utils.compression import compress, decompress, decompress_into, decompressed_size
 from libs.utils.forest_utils import get_forest_git_hash
+from libs.utils.telemetry import count, peak_memory_mb, reset_peak_memory, stage, Telemetry
 from libs.utils.participant_app_version_comparison import (is_this_version_gt_participants,
     is_this_version_gte_participants, is_this_version_lt_participants,
     is_this_version_lte_participants)
@@ -179,6 +194,193 @@ class TestEnsureSortedByTimestamp(CommonTestCase):
             ensure_sorted_by_timestamp(rows)
         
         self.assertEqual(rows, [[b"100"], [b"illegal"], [b"50"], [b"not_a_number"], [b"200"]])
+    
+    # the adaptive sort must match a plain stable sort exactly
+    
+    def assert_sorts_like_original(self, rows: list[list[bytes]]):
+        expected = sorted(rows, key=lambda row: int(row[0]))
+        for numpy_min_rows in (0, 10**9):  # numpy and python versions
+            rows_copy = list(rows)
+            with patch("libs.file_processing.utility_functions_simple.NUMPY_MIN_ROWS", numpy_min_rows):
+                ensure_sorted_by_timestamp(rows_copy)
+            self.assertEqual(rows_copy, expected)
+            for a, b in zip(rows_copy, expected):
+                self.assertIs(a, b)  # and ties keep their original order
+    
+    def test_ensure_sorted_by_timestamp_sorted_nearly_sorted_runs_and_random(self):
+        timestamps = [1770358145000 + i * 7 % 5 for i in range(300)]  # lots of ties
+        self.assert_sorts_like_original([[b"%d" % t, b"%d" % i] for i, t in enumerate(sorted(timestamps))])
+        nearly = sorted(timestamps)
+        nearly[10], nearly[200] = nearly[200], nearly[10]
+        self.assert_sorts_like_original([[b"%d" % t, b"%d" % i] for i, t in enumerate(nearly)])
+        runs = sorted(timestamps[100:]) + sorted(timestamps[:100])
+        self.assert_sorts_like_original([[b"%d" % t, b"%d" % i] for i, t in enumerate(runs)])
+        self.assert_sorts_like_original([[b"%d" % t, b"%d" % i] for i, t in enumerate(timestamps)])
+    
+    def test_ensure_sorted_by_timestamp_numpy_falls_back_on_mixed_widths_and_str(self):
+        self.assert_sorts_like_original([[b"1000000"], [b"999"], [b"1000"], [b"99"], [b"10000"]])
+        self.assert_sorts_like_original([["30"], ["10"], ["20"]])  # type: ignore
+    
+    def test_ensure_sorted_by_timestamp_numpy_invalid_rows_unmodified(self):
+        rows = [[b"300"], [b"2x0"], [b"100"]]
+        with patch("libs.file_processing.utility_functions_simple.NUMPY_MIN_ROWS", 0):
+            with self.assertRaises(ValueError):
+                ensure_sorted_by_timestamp(rows)
+        self.assertEqual(rows, [[b"300"], [b"2x0"], [b"100"]])
+    
+    def test_sort_rows_by_timestamp_keys_sorts_keys(self):
+        rows = [[b"3", b"a"], [b"1", b"b"], [b"3", b"c"], [b"2", b"d"]]
+        keys = timestamp_sort_keys(rows)
+        sort_rows_by_timestamp_keys(rows, keys)
+        self.assertEqual(rows, [[b"1", b"b"], [b"2", b"d"], [b"3", b"a"], [b"3", b"c"]])
+        self.assertEqual(keys, [1, 2, 3, 3])
+
+
+class TestConstructCsvAsBytes(CommonTestCase):
+    # output must be byte-identical to the set-of-every-row version, whatever the row order
+    
+    def assert_construct_matches(self, rows: list[list[bytes]]):
+        rows_copy = [list(row) for row in rows]
+        expected = construct_csv_as_bytes_with_set(b"header", rows)
+        self.assertEqual(construct_csv_as_bytes(b"header", rows_copy), expected)
+        self.assertEqual(rows_copy, rows)  # input is not modified
+    
+    def test_construct_empty(self):
+        self.assert_construct_matches([])
+        self.assertEqual(construct_csv_as_bytes(b"header", []), b"header")
+    
+    def test_construct_sorted_with_duplicates(self):
+        rows = [[b"1", b"a"], [b"1", b"a"], [b"2", b"b"], [b"2", b"c"], [b"2", b"b"], [b"10", b"d"]]
+        self.assert_construct_matches(rows)
+        self.assertEqual(construct_csv_as_bytes(b"header", rows), b"header\n1,a\n2,b\n2,c\n10,d")
+    
+    def test_construct_large_timestamp_group(self):
+        # enough rows on one timestamp that the group switches from a list to a set
+        rows = [[b"5", b"%d" % (i % (TIMESTAMP_GROUP_SET_SIZE * 2))] for i in range(TIMESTAMP_GROUP_SET_SIZE * 5)]
+        self.assert_construct_matches(rows)
+        self.assertEqual(
+            construct_csv_as_bytes(b"header", rows).count(b"\n"), TIMESTAMP_GROUP_SET_SIZE * 2
+        )
+    
+    def test_construct_unsorted_falls_back(self):
+        # a duplicate that is not adjacent to its twin must still be dropped
+        self.assert_construct_matches([[b"1", b"a"], [b"2", b"b"], [b"1", b"a"]])
+        self.assert_construct_matches([[b"10", b"a"], [b"9", b"b"], [b"10", b"a"]])
+        self.assertEqual(
+            construct_csv_as_bytes(b"header", [[b"2", b"b"], [b"1", b"a"], [b"2", b"b"]]),
+            b"header\n2,b\n1,a",
+        )
+    
+    def test_construct_random_rows(self):
+        rng = Random(0)
+        for _ in range(50):
+            rows = [[b"%d" % rng.randrange(20), b"%d" % rng.randrange(3)] for _ in range(rng.randrange(60))]
+            if rng.random() < 0.5:
+                ensure_sorted_by_timestamp(rows)
+            self.assert_construct_matches(rows)
+    
+    def test_construct_single_field_and_empty_rows(self):
+        self.assert_construct_matches([[b"1"], [b"1"], [b""], [b"2"]])
+        self.assert_construct_matches([[], [], [b"1"]])
+
+
+class TestMergeSortedRowsAsCsvBytes(CommonTestCase):
+    # the merge must be byte-identical to the sort-then-construct path it replaced
+    
+    def old_path(self, existing_rows: list[list[bytes]], new_rows: list[list[bytes]]) -> bytes:
+        rows = [list(row) for row in existing_rows] + [list(row) for row in new_rows]
+        ensure_sorted_by_timestamp(rows)
+        return construct_csv_as_bytes(b"header", rows)
+    
+    def assert_merge_matches(self, existing_rows: list[list[bytes]], new_rows: list[list[bytes]]):
+        expected = self.old_path(existing_rows, new_rows)
+        existing_copy, new_copy = [list(row) for row in existing_rows], [list(row) for row in new_rows]
+        self.assertEqual(merge_sorted_rows_as_csv_bytes(b"header", existing_copy, new_copy), expected)
+        self.assertEqual(existing_copy, [])  # inputs are consumed
+        self.assertEqual(new_copy, [])
+    
+    def test_merge_interleaved(self):
+        self.assert_merge_matches([[b"1", b"a"], [b"3", b"c"]], [[b"2", b"b"], [b"4", b"d"]])
+    
+    def test_merge_empty(self):
+        self.assert_merge_matches([], [])
+        self.assert_merge_matches([[b"1", b"a"]], [])
+        self.assert_merge_matches([], [[b"1", b"a"]])
+    
+    def test_merge_deduplicates_across_and_within(self):
+        existing = [[b"1", b"a"], [b"2", b"b"], [b"2", b"b"]]
+        new = [[b"1", b"a"], [b"2", b"c"], [b"2", b"b"], [b"3", b"d"]]
+        self.assert_merge_matches(existing, new)
+        self.assertEqual(
+            merge_sorted_rows_as_csv_bytes(b"header", existing, new), b"header\n1,a\n2,b\n2,c\n3,d"
+        )
+    
+    def test_merge_existing_rows_win_timestamp_ties(self):
+        self.assert_merge_matches([[b"5", b"old"]], [[b"5", b"new"]])
+        self.assertEqual(
+            merge_sorted_rows_as_csv_bytes(b"header", [[b"5", b"old"]], [[b"5", b"new"]]),
+            b"header\n5,old\n5,new",
+        )
+    
+    def test_merge_unsorted_inputs(self):
+        self.assert_merge_matches([[b"3", b"c"], [b"1", b"a"]], [[b"4", b"d"], [b"2", b"b"], [b"0", b"z"]])
+    
+    def test_merge_mixed_numeric_widths(self):
+        self.assert_merge_matches([[b"99"], [b"1000"]], [[b"999"], [b"10000"], [b"02"], [b"2"]])
+    
+    def test_merge_large_timestamp_group(self):
+        # tens of thousands of rows on one timestamp, on both sides, with duplicates.  Deduplication
+        # switches from a list to a set, so this stays linear.
+        existing = [[b"5", b"%d" % (i % 10_000)] for i in range(20_000)]
+        new = [[b"5", b"%d" % (i % 15_000)] for i in range(5_000, 25_000)] + [[b"6", b"x"]]
+        self.assert_merge_matches(existing, new)
+        merged = merge_sorted_rows_as_csv_bytes(b"header", existing, new)
+        self.assertEqual(merged.count(b"\n"), 15_001)
+        self.assertTrue(merged.startswith(b"header\n5,0\n5,1\n"))  # first-seen order
+    
+    def test_merge_bad_timestamp_raises(self):
+        with self.assertRaises(ValueError):
+            merge_sorted_rows_as_csv_bytes(b"header", [[b"1", b"a"], [b"illegal", b"b"]], [[b"2", b"c"]])
+        with self.assertRaises(ValueError):
+            merge_sorted_rows_as_csv_bytes(b"header", [[b"1", b"a"]], [[]])
+
+
+class TestSplitCsvRows(CommonTestCase):
+    # output must be identical to splitlines-then-split, whatever the block boundaries
+    
+    def old_path(self, file_contents: bytes, maxsplit: int) -> tuple[bytes, list[list[bytes]]]:
+        lines = file_contents.splitlines()
+        return lines.pop(0), [line.split(b",", maxsplit) for line in lines]
+    
+    def test_split_matches_splitlines(self):
+        rng = Random(0)
+        pieces = [b"1", b"a,b", b",", b"\n", b"\r\n", b"\r", b"xyz,q,r"]
+        for block_size in (1, 5, 1024):
+            with patch("libs.file_processing.utility_functions_csvs.SPLIT_BLOCK_SIZE", block_size):
+                for _ in range(100):
+                    file_contents = b"h,e,a,d\n" + b"".join(rng.choice(pieces) for _ in range(rng.randrange(40)))
+                    for maxsplit in (-1, 1, 2, 3):
+                        self.assertEqual(
+                            split_csv_rows(file_contents, maxsplit), self.old_path(file_contents, maxsplit)
+                        )
+    
+    def test_split_leading_columns(self):
+        header, rows = split_csv_rows(b"timestamp,x,y\n1,2,3\n4,5,6\n", 1)
+        self.assertEqual(header, b"timestamp,x,y")
+        self.assertEqual(rows, [[b"1", b"2,3"], [b"4", b"5,6"]])
+    
+    def test_split_peak_memory(self):
+        # the original holds a list of every line at the same time as the rows
+        file_contents = b"timestamp,x,y,z\n" + b"\n".join(
+            b"%d,0.123456789,0.123456789,9.87654321" % (1770357600000 + i) for i in range(50_000)
+        )
+        peaks = []
+        for split in (lambda: self.old_path(file_contents, -1), lambda: split_csv_rows(file_contents, 1)):
+            tracemalloc.start()
+            split()
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        self.assertLess(peaks[1], peaks[0] * 0.6)
 
 
 # AI generated, reviewed
@@ -669,6 +871,16 @@ class TestParticipantDataDeletion(CommonTestCase):
         run_next_queued_participant_data_deletion()
         self.assertEqual(SurveyNotificationReport.objects.count(), 0)
     
+    @data_purge_mock_s3_calls
+    def test_confirm_DataProcessingRun(self):
+        DataProcessingRun.objects.create(
+            participant=self.default_participant, seconds=1.0, errored=False, files=1, failed_files=0,
+            file_bytes=1, bytes_in=1, bytes_out=1, chunks=1, queries=1, peak_memory_mb=1.0, stages="{}",
+        )
+        self.assert_confirm_deletion_raises_then_reset_last_updated
+        run_next_queued_participant_data_deletion()
+        confirm_deleted(self.default_participant_deletion_event)
+    
     def test_confirm_S3File(self):
         # this is a weird test, we can't actually test the s3 file deletion, but we can test that
         # the function runs without error.
@@ -1587,6 +1799,138 @@ class TestS3Storage(CommonTestCase):
         self.assertEqual(s3_file.path, self.valid_non_study_path + ".zst")
         self.assert_correct_uploaded_s3file(s3_file)
     
+    ## memory
+    
+    @staticmethod
+    def traced_peak(function) -> int:
+        # the peak of memory allocated while running the function, above what was allocated before
+        tracemalloc.start()
+        start = tracemalloc.get_traced_memory()[0]
+        function()
+        peak = tracemalloc.get_traced_memory()[1] - start
+        tracemalloc.stop()
+        return peak
+    
+    @patch("libs.s3.conn")
+    def test_download_holds_at_most_two_uncompressed_copies(self, conn: Mock):
+        rng = Random(0)
+        content = b"\n".join(b"%d,%.8f,%.8f" % (1768928568332 + i, rng.random(), rng.random()) for i in range(150_000))
+        compressed = compress(content)
+        encrypted = encrypt_for_server(compressed, self.DEFAULT_ENCRYPTION_KEY_BYTES)
+        conn.get_object = MagicMock(side_effect=lambda **kwargs: {"Body": BytesIO(encrypted)})
+        key = self.default_s3storage_with_prefix.encryption_key  # (no database queries while tracing)
+        
+        def download():
+            s = self.default_s3storage_with_prefix
+            s._encryption_key = key
+            self.assertEqual(s.download().pop_uncompressed_file_content(), content)
+        
+        peak = self.traced_peak(download)
+        self.assertLess(peak, 2.2 * len(content))
+        # a plain decompress holds more than that by itself
+        self.assertLess(peak, self.traced_peak(lambda: decompress(compressed)))
+    
+    @patch("libs.s3.conn")
+    def test_upload_holds_one_encrypted_copy(self, conn: Mock):
+        compressed = Random(0).randbytes(2_000_000)  # (looks like compressed data to a cipher)
+        key = self.default_s3storage_with_prefix.encryption_key
+        
+        def upload():
+            s = self.default_s3storage_with_prefix
+            s._encryption_key = key
+            s.compressed_data = compressed
+            s.metadata.update(size_compressed=len(compressed), size_uncompressed=1, sha1=b"1" * 20)
+            s.push_to_storage_precompressed_and_clear_memory(defer_db_update=True)
+        
+        peak = self.traced_peak(upload)
+        self.assertLess(peak, 1.2 * len(compressed))
+        self.assertLess(peak, 0.7 * self.traced_peak(lambda: encrypt_for_server(compressed, key)))
+        self.assertEqual(decrypt_server(conn.put_object.call_args.kwargs["Body"], key), compressed)
+    
+    ## streaming download
+    
+    @patch("libs.s3.conn")
+    def test_s3_open_streams_in_bounded_memory(self, conn: Mock):
+        rng = Random(0)
+        content = b"\n".join(b"%d,%.8f,%.8f" % (1768928568332 + i, rng.random(), rng.random()) for i in range(300_000))
+        # two zstd frames, like a file that was appended to
+        body = encrypt_for_server(compress(content) + compress(b"\nthe end"), self.DEFAULT_ENCRYPTION_KEY_BYTES)
+        conn.get_object = MagicMock(side_effect=lambda **kwargs: {"Body": BytesIO(body)})
+        key = self.default_s3storage_with_prefix.encryption_key
+        first_line = content[:content.index(b"\n") + 1]
+        sha1_of_the_rest = hashlib.sha1(content[len(first_line):] + b"\nthe end").digest()
+        
+        def stream():
+            storage = self.default_s3storage_with_prefix
+            storage._encryption_key = key
+            with storage.open_zst_stream() as f:
+                self.assertEqual(f.readline(), first_line)
+                sha1 = hashlib.sha1()
+                for block in iter(lambda: f.read(100_000), b""):
+                    sha1.update(block)
+            self.assertEqual(sha1.digest(), sha1_of_the_rest)
+        
+        self.assertLess(self.traced_peak(stream), len(content) / 3)
+        call = self.extract_mock_call_params(conn)[0]
+        self.assertIn("call.get_object(", str(call))
+        self.assertEqual(call.kwargs, self.params_for_download_compressed_study_prefix())
+    
+    @patch("libs.s3.conn")
+    def test_s3_open_without_compressed_file(self, conn: Mock):
+        conn.get_object = Mock(side_effect=[self.hack_s3_error("nope"), {"Body": BytesIO(self.ENCRYPTED_SLUG)}])
+        S3File(path=self.valid_study_path + ".zst").save()
+        with s3_open(self.valid_study_path, self.default_study, raw_path=True) as f:
+            self.assertEqual(f.read(), b"content")
+        # downloaded, compressed, uploaded, and the uncompressed file deleted, like s3_retrieve
+        self.assertEqual(
+            [call[0] for call in conn.method_calls], ["get_object", "get_object", "put_object", "delete_object"]
+        )
+        s3_file = S3File.objects.get()
+        self.assertEqual(s3_file.path, self.valid_study_path + ".zst")
+        self.assertEqual(s3_file.size_uncompressed, len(b"content"))
+    
+    ## re-encryption of legacy files
+    
+    @patch("libs.s3.conn")
+    def test_reencrypt_legacy_zst(self, conn: Mock):
+        legacy = legacy_encrypt_for_server(self.COMPRESSED_SLUG, self.DEFAULT_ENCRYPTION_KEY_BYTES)
+        conn.get_object = MagicMock(return_value={"Body": BytesIO(legacy), "ETag": '"an etag"'})
+        s = self.default_s3storage_with_prefix
+        self.assertTrue(s.reencrypt_legacy_zst())
+        
+        call_1, call_2 = self.extract_mock_call_params(conn)
+        self.assertIn("call.get_object(", str(call_1))
+        self.assertEqual(call_1.kwargs, self.params_for_download_compressed_study_prefix())
+        self.assertIn("call.put_object(", str(call_2))
+        self.assertFalse(is_legacy_server_encryption(call_2.kwargs["Body"]))
+        self.decrypt_kwarg_Body(call_2.kwargs)
+        self.assertEqual(
+            call_2.kwargs, {**self.params_for_upload_compressed_study_prefix(), "IfMatch": '"an etag"'}
+        )
+        self.assertFalse(S3File.objects.exists())
+    
+    @patch("libs.s3.conn")
+    def test_reencrypt_legacy_zst_already_current(self, conn: Mock):
+        conn.get_object = MagicMock(return_value={"Body": BytesIO(self.COMPRESSED_ENCRYPTED_SLUG), "ETag": "x"})
+        self.assertFalse(self.default_s3storage_with_prefix.reencrypt_legacy_zst())
+        self.assertEqual(len(conn.method_calls), 1)
+    
+    @patch("libs.s3.conn")
+    def test_reencrypt_legacy_zst_changed_during_rewrite(self, conn: Mock):
+        legacy = legacy_encrypt_for_server(self.COMPRESSED_SLUG, self.DEFAULT_ENCRYPTION_KEY_BYTES)
+        conn.get_object = MagicMock(return_value={"Body": BytesIO(legacy), "ETag": "x"})
+        conn.put_object = MagicMock(
+            side_effect=Boto3ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+        )
+        self.assertFalse(self.default_s3storage_with_prefix.reencrypt_legacy_zst())
+    
+    @patch("libs.s3.conn")
+    def test_reencrypt_legacy_zst_wrong_key_does_not_upload(self, conn: Mock):
+        legacy = legacy_encrypt_for_server(self.COMPRESSED_SLUG, b"1" * 32)
+        conn.get_object = MagicMock(return_value={"Body": BytesIO(legacy), "ETag": "x"})
+        self.assertRaises(DataException, self.default_s3storage_with_prefix.reencrypt_legacy_zst)
+        self.assertEqual(len(conn.method_calls), 1)
+    
     # S3File assertions
     
     def assert_correct_downloaded_s3file(self, s3_file: S3File):
@@ -1620,6 +1964,305 @@ class TestS3Storage(CommonTestCase):
         self.assertEqual(s3_file.size_uncompressed, len(b"content"))
 
 
+class TestServerEncryption(CommonTestCase):
+    KEY = CommonTestCase.DEFAULT_ENCRYPTION_KEY_BYTES
+    
+    def test_round_trip(self):
+        for data in (b"", b"a", b"content" * 1000):
+            encrypted = encrypt_for_server(data, self.KEY)
+            self.assertTrue(encrypted.startswith(SERVER_ENCRYPTION_MAGIC + bytes([SERVER_ENCRYPTION_VERSION])))
+            self.assertEqual(len(encrypted), len(data) + GCM_OVERHEAD)
+            self.assertEqual(decrypt_server(encrypted, self.KEY), data)
+    
+    def test_nonce_is_random(self):
+        self.assertNotEqual(encrypt_for_server(b"content", self.KEY), encrypt_for_server(b"content", self.KEY))
+    
+    def test_legacy_format_still_decrypts(self):
+        encrypted = legacy_encrypt_for_server(b"content", self.KEY)
+        self.assertTrue(is_legacy_server_encryption(encrypted))
+        self.assertEqual(decrypt_server(encrypted, self.KEY), b"content")
+    
+    def test_tampered_data_or_wrong_key_raise(self):
+        encrypted = bytearray(encrypt_for_server(b"content", self.KEY))
+        with self.assertRaises(ValueError):
+            decrypt_server(bytes(encrypted), b"1" * 32)
+        encrypted[-20] ^= 1
+        with self.assertRaises(ValueError):
+            decrypt_server(bytes(encrypted), self.KEY)
+    
+    def test_unknown_version_and_truncated_data_raise(self):
+        with self.assertRaises(ValueError):
+            decrypt_server(SERVER_ENCRYPTION_MAGIC + b"\xff" + b"0" * 40, self.KEY)
+        with self.assertRaises(ValueError):
+            decrypt_server(encrypt_for_server(b"", self.KEY)[:-1], self.KEY)
+    
+    def test_bad_keys(self):
+        with self.assertRaises(Exception):
+            encrypt_for_server(b"content", self.KEY.decode())
+        with self.assertRaises(Exception):
+            encrypt_for_server(b"content", b"short")
+    
+    def test_into_buffer_variants(self):
+        data = b"content" * 1000
+        output = bytearray(encrypted_size(len(data)) + 3)  # larger buffers are fine
+        written = encrypt_for_server_into(memoryview(data), self.KEY, output)
+        self.assertEqual(written, encrypted_size(len(data)))
+        encrypted = bytes(output[:written])
+        self.assertEqual(decrypt_server(encrypted, self.KEY), data)
+        
+        for encrypted in (encrypted, legacy_encrypt_for_server(data, self.KEY)):
+            output = bytearray(decrypted_size(encrypted))
+            self.assertEqual(decrypt_server_into(bytearray(encrypted), self.KEY, output), len(data))
+            self.assertEqual(bytes(output), data)
+            with self.assertRaises(ValueError):
+                decrypt_server_into(encrypted, self.KEY, bytearray(len(data) - 1))
+        with self.assertRaises(ValueError):
+            encrypt_for_server_into(data, self.KEY, bytearray(len(data)))
+    
+    def test_server_decryptor_in_pieces(self):
+        data = Random(0).randbytes(5000)
+        for encrypted in (encrypt_for_server(data, self.KEY), legacy_encrypt_for_server(data, self.KEY)):
+            for piece_size in (1, 7, 16, 1000, len(encrypted)):
+                decryptor = ServerDecryptor(self.KEY)
+                pieces = [
+                    decryptor.update(encrypted[i:i + piece_size]) for i in range(0, len(encrypted), piece_size)
+                ]
+                self.assertEqual(b"".join(pieces) + decryptor.finalize(), data)
+        
+        for data in (b"", b"a"):  # shorter than the header
+            for encrypted in (encrypt_for_server(data, self.KEY), legacy_encrypt_for_server(data, self.KEY)):
+                decryptor = ServerDecryptor(self.KEY)
+                self.assertEqual(decryptor.update(encrypted) + decryptor.finalize(), data)
+    
+    def test_server_decryptor_verifies(self):
+        encrypted = bytearray(encrypt_for_server(b"content" * 100, self.KEY))
+        encrypted[30] ^= 1
+        decryptor = ServerDecryptor(self.KEY)
+        decryptor.update(encrypted)
+        with self.assertRaises(ValueError):
+            decryptor.finalize()
+        decryptor = ServerDecryptor(self.KEY)
+        decryptor.update(encrypt_for_server(b"content", self.KEY)[:-1])
+        with self.assertRaises(ValueError):
+            decryptor.finalize()
+    
+    def test_decompress_into(self):
+        data = b"content" * 1000
+        compressed = compress(data)
+        self.assertEqual(decompressed_size(compressed), len(data))
+        output = bytearray(len(data))
+        self.assertEqual(decompress_into(memoryview(compressed), output), len(data))
+        self.assertEqual(bytes(output), data)
+        # two frames, the header only has the size of the first
+        with self.assertRaises(ValueError):
+            decompress_into(compressed + compressed, bytearray(len(data)))
+        output = bytearray(len(data) * 2)
+        self.assertEqual(decompress_into(compressed + compressed, output), len(data) * 2)
+
+
+
+class TestStudyKeyCache(CommonTestCase):
+    """ Tests for the process-wide cache of study encryption keys and object ids in libs.s3 """
+    
+    OTHER_KEY = "abcdefghijklmnopqrstuvwxyz012345"
+    
+    def test_one_lookup_per_study(self):
+        participant = self.default_participant
+        object_id = self.default_study.object_id
+        with self.assertNumQueries(1):
+            for _ in range(50):
+                s = S3Storage("a_path", participant, bypass_study_folder=False)
+                self.assertEqual(s.encryption_key, self.DEFAULT_ENCRYPTION_KEY_BYTES)
+                self.assertEqual(s.get_path_prefix, object_id)
+                # the lookup by participant also populates the lookup by object id
+                s = S3Storage(object_id + "/a_path", object_id, bypass_study_folder=True)
+                self.assertEqual(s.encryption_key, self.DEFAULT_ENCRYPTION_KEY_BYTES)
+    
+    def test_one_lookup_per_study_with_several_studies(self):
+        participant = self.default_participant
+        study_2 = self.generate_study("study 2", encryption_key=self.OTHER_KEY)
+        participant_2 = self.generate_participant(study_2)
+        with self.assertNumQueries(2):
+            for _ in range(10):
+                self.assertEqual(smart_get_study_encryption_key(participant), self.DEFAULT_ENCRYPTION_KEY_BYTES)
+                self.assertEqual(smart_get_study_encryption_key(participant_2), self.OTHER_KEY.encode())
+                self.assertEqual(get_just_prefix(participant_2), study_2.object_id)
+    
+    def test_study_objects_need_no_lookup(self):
+        study = self.default_study
+        with self.assertNumQueries(0):
+            self.assertEqual(smart_get_study_encryption_key(study), self.DEFAULT_ENCRYPTION_KEY_BYTES)
+            self.assertEqual(get_just_prefix(study), study.object_id)
+    
+    def test_study_save_invalidates(self):
+        participant = self.default_participant
+        self.assertEqual(smart_get_study_encryption_key(participant), self.DEFAULT_ENCRYPTION_KEY_BYTES)
+        self.assertEqual(
+            smart_get_study_encryption_key(self.default_study.object_id), self.DEFAULT_ENCRYPTION_KEY_BYTES
+        )
+        self.default_study.update(encryption_key=self.OTHER_KEY)
+        with self.assertNumQueries(1):
+            self.assertEqual(smart_get_study_encryption_key(participant), self.OTHER_KEY.encode())
+            self.assertEqual(
+                smart_get_study_encryption_key(self.default_study.object_id), self.OTHER_KEY.encode()
+            )
+    
+    @patch("libs.s3.STUDY_KEY_CACHE_SECONDS", 60)
+    def test_expiry(self):
+        participant = self.default_participant
+        now = time.perf_counter()
+        with patch("libs.s3.perf_counter", return_value=now):
+            smart_get_study_encryption_key(participant)
+        with patch("libs.s3.perf_counter", return_value=now + 59):
+            with self.assertNumQueries(0):
+                smart_get_study_encryption_key(participant)
+        with patch("libs.s3.perf_counter", return_value=now + 61):
+            with self.assertNumQueries(1):
+                smart_get_study_encryption_key(participant)
+                smart_get_study_encryption_key(participant)
+    
+    def test_disabled(self):
+        participant = self.default_participant
+        with patch("libs.s3.STUDY_KEY_CACHE_SECONDS", 0), \
+                patch.object(StudyKeyCache, "lock", MagicMock()) as lock:
+            with self.assertNumQueries(3):
+                for _ in range(3):
+                    self.assertEqual(
+                        smart_get_study_encryption_key(participant), self.DEFAULT_ENCRYPTION_KEY_BYTES
+                    )
+        lock.__enter__.assert_not_called()  # a disabled cache doesn't serialize lookups
+    
+    def test_missing_study_is_not_cached(self):
+        with self.assertRaises(Study.DoesNotExist):
+            smart_get_study_encryption_key("a" * 24)
+        self.assertEqual(StudyKeyCache.by_object_id, {})
+        self.assertEqual(StudyKeyCache.by_pk, {})
+    
+    def test_one_lookup_under_threads(self):
+        # threads have their own database connections, which can't see this test's (uncommitted)
+        # study, so the lookup is mocked, slowly, so that every thread misses the cache at once.
+        study = self.default_study
+        values = (study.pk, study.object_id, study.encryption_key)
+        
+        def slow_lookup(**filters):
+            time.sleep(0.05)
+            return values
+        
+        with patch.object(StudyKeyCache, "lookup", side_effect=slow_lookup) as lookup:
+            with ThreadPoolExecutor(8) as pool:
+                keys = list(pool.map(lambda _: StudyKeyCache.get_by_pk(study.pk)[3], range(32)))
+            self.assertEqual(lookup.call_count, 1)
+        self.assertEqual(keys, [self.DEFAULT_ENCRYPTION_KEY_BYTES] * 32)
+
+
+class TestParticipantKeyCache(CommonTestCase):
+    """ Tests for the process-wide cache of participant private keys in libs.rsa """
+    
+    with open(f"{BEIWE_PROJECT_ROOT}/tests/files/private_key", "rb") as f:
+        PRIVATE_KEY_FILE = f.read()
+    
+    @patch("libs.s3.s3_retrieve")
+    def test_one_download_per_participant(self, s3_retrieve: MagicMock):
+        s3_retrieve.return_value = self.PRIVATE_KEY_FILE
+        participant = self.default_participant
+        keys = [participant.get_private_key() for _ in range(20)]
+        s3_retrieve.assert_called_once_with(
+            "keys/" + participant.patient_id + "_private", self.default_study.object_id
+        )
+        self.assertEqual(keys[0], get_RSA_cipher(self.PRIVATE_KEY_FILE))
+        self.assertTrue(all(key is keys[0] for key in keys))
+    
+    @patch("libs.s3.s3_retrieve")
+    def test_participants_are_cached_separately(self, s3_retrieve: MagicMock):
+        s3_retrieve.return_value = self.PRIVATE_KEY_FILE
+        participant_2 = self.generate_participant(self.default_study, "patient2")
+        for _ in range(5):
+            self.default_participant.get_private_key()
+            participant_2.get_private_key()
+        self.assertEqual(s3_retrieve.call_count, 2)
+    
+    @patch("libs.rsa.PARTICIPANT_KEY_CACHE_SECONDS", 60)
+    @patch("libs.s3.s3_retrieve")
+    def test_expiry(self, s3_retrieve: MagicMock):
+        s3_retrieve.return_value = self.PRIVATE_KEY_FILE
+        participant = self.default_participant
+        now = time.perf_counter()
+        with patch("libs.rsa.perf_counter", return_value=now):
+            participant.get_private_key()
+        with patch("libs.rsa.perf_counter", return_value=now + 59):
+            participant.get_private_key()
+        self.assertEqual(s3_retrieve.call_count, 1)
+        with patch("libs.rsa.perf_counter", return_value=now + 61):
+            participant.get_private_key()
+            participant.get_private_key()
+        self.assertEqual(s3_retrieve.call_count, 2)
+    
+    @patch("libs.rsa.PARTICIPANT_KEY_CACHE_SIZE", 2)
+    @patch("libs.s3.s3_retrieve")
+    def test_least_recently_used_keys_are_dropped(self, s3_retrieve: MagicMock):
+        s3_retrieve.return_value = self.PRIVATE_KEY_FILE
+        study_id = self.default_study.object_id
+        get_participant_private_key("patient1", study_id)
+        get_participant_private_key("patient2", study_id)
+        get_participant_private_key("patient1", study_id)  # patient2 is now the least recent
+        get_participant_private_key("patient3", study_id)
+        self.assertEqual(list(ParticipantKeyCache.keys), ["patient1", "patient3"])
+        self.assertEqual(s3_retrieve.call_count, 3)
+    
+    @patch("libs.rsa.PARTICIPANT_KEY_CACHE_SECONDS", 0)
+    @patch("libs.s3.s3_retrieve")
+    def test_disabled(self, s3_retrieve: MagicMock):
+        s3_retrieve.return_value = self.PRIVATE_KEY_FILE
+        with patch.object(ParticipantKeyCache, "lock", MagicMock()) as lock:
+            for _ in range(3):
+                self.default_participant.get_private_key()
+        self.assertEqual(s3_retrieve.call_count, 3)
+        self.assertEqual(len(ParticipantKeyCache.keys), 0)
+        lock.__enter__.assert_not_called()  # a disabled cache doesn't serialize lookups
+    
+    @patch("libs.s3.s3_retrieve")
+    @patch("libs.s3.s3_upload")
+    def test_new_key_pair_invalidates(self, s3_upload: MagicMock, s3_retrieve: MagicMock):
+        s3_retrieve.return_value = self.PRIVATE_KEY_FILE
+        participant = self.default_participant
+        participant.get_private_key()
+        with patch("libs.rsa.generate_key_pairing", return_value=(b"public", b"private")):
+            create_participant_key_pair(participant.patient_id, self.default_study.object_id)
+        self.assertEqual(len(ParticipantKeyCache.keys), 0)
+        participant.get_private_key()
+        self.assertEqual(s3_retrieve.call_count, 2)
+    
+    @patch("libs.s3.s3_retrieve")
+    def test_participant_deletion_invalidates(self, s3_retrieve: MagicMock):
+        s3_retrieve.return_value = self.PRIVATE_KEY_FILE
+        self.default_participant.get_private_key()
+        self.default_participant_deletion_event
+        with patch("libs.participant_purge.delete_participant_data"), \
+                patch("libs.participant_purge.confirm_deleted"):
+            run_next_queued_participant_data_deletion()
+        self.assertEqual(len(ParticipantKeyCache.keys), 0)
+    
+    @patch("libs.s3.s3_retrieve")
+    def test_other_study_is_a_miss(self, s3_retrieve: MagicMock):
+        s3_retrieve.return_value = self.PRIVATE_KEY_FILE
+        get_participant_private_key("patient1", "a" * 24)
+        get_participant_private_key("patient1", "b" * 24)
+        self.assertEqual(s3_retrieve.call_count, 2)
+    
+    @patch("libs.s3.s3_retrieve")
+    def test_threads(self, s3_retrieve: MagicMock):
+        s3_retrieve.return_value = self.PRIVATE_KEY_FILE
+        study_id = self.default_study.object_id
+        patient_ids = [f"patient{i}" for i in range(8)]
+        with ThreadPoolExecutor(8) as pool:
+            keys = list(pool.map(
+                lambda i: get_participant_private_key(patient_ids[i % 8], study_id), range(400)
+            ))
+        self.assertEqual(keys, [get_RSA_cipher(self.PRIVATE_KEY_FILE)] * 400)
+        self.assertEqual(sorted(ParticipantKeyCache.keys), patient_ids)
+        # concurrent misses may each download, but every participant after its first upload hits
+        self.assertLessEqual(s3_retrieve.call_count, 64)
+
 class TestCeleryAtLeastImports(CommonTestCase):
     
     def test_data_processing(self):
@@ -1805,3 +2448,50 @@ class TestUpdateForestVersion(CommonTestCase):
     def test_get_forest_git_hash_gets_anything_at_all(self):
         hash = get_forest_git_hash()
         self.assertNotEqual(hash, "")
+
+
+class TestTelemetry(CommonTestCase):
+    
+    def test_nothing_is_recorded_without_a_recording_telemetry(self):
+        telemetry = Telemetry()
+        with stage("download"):
+            count("bytes_downloaded", 10)
+        self.assertEqual(dict(telemetry.stage_seconds), {})
+        self.assertEqual(dict(telemetry.counters), {})
+    
+    def test_nested_stages_are_exclusive(self):
+        # outer starts at 0, inner runs from 1 to 3, outer ends at 6.
+        with patch("libs.utils.telemetry.perf_counter", side_effect=[0.0, 1.0, 3.0, 6.0]):
+            with Telemetry() as telemetry:
+                with stage("merge"):
+                    with stage("download"):
+                        pass
+        self.assertEqual(dict(telemetry.stage_seconds), {"merge": 4.0, "download": 2.0})
+    
+    def test_stages_and_counts_are_recorded_from_other_threads(self):
+        def work():
+            with stage("upload"):
+                count("bytes_uploaded", 5)
+        
+        with Telemetry() as telemetry:
+            with ThreadPoolExecutor(4) as pool:
+                list(pool.map(lambda _: work(), range(8)))
+        self.assertEqual(telemetry.counters["bytes_uploaded"], 40)
+        self.assertIn("upload", telemetry.stage_seconds)
+    
+    def test_only_one_telemetry_records(self):
+        with Telemetry() as first:
+            with Telemetry() as second:
+                count("files")
+            count("files")  # the first is still recording after the second exits
+        self.assertEqual(first.counters["files"], 2)
+        self.assertEqual(dict(second.counters), {})
+    
+    def test_peak_memory_is_reset(self):
+        # a long-lived worker process must not report an earlier job's peak
+        data = b"x" * (100 * 1024 * 1024)
+        peak_with_data = peak_memory_mb()
+        del data
+        if not reset_peak_memory():
+            self.skipTest("the peak memory can only be reset on linux")
+        self.assertLess(peak_memory_mb(), peak_with_data - 50)
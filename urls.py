@@ -227,6 +227,7 @@ path("get-summary-statistics/v1", data_api_endpoints.get_summary_statistics)
 path("get-participant-device-status-history/v1", data_api_endpoints.get_participant_device_status_report_history)
 path("get-participant-notification-history/v1", data_api_endpoints.get_participant_notification_history)
 path("check-my-credentials/v1", data_api_endpoints.check_my_credentials)
+path("get-data-processing-summary/v1", data_api_endpoints.get_data_processing_summary)
 
 # tableau - legacy endpaints - these were UNFATHOMABLY poorly constructed, can't get rid of them
 # deprecating may 2025, wait... 3 years? to remove, there's at least one long-term study using them.
@@ -39,7 +39,13 @@ def iterate_s3(prefix: str):
 
 
 def decrypt_s3(data: bytes) -> bytes:
-    """ effectively copy-pasted from beiwe-backend """
+    """ effectively copy-pasted from beiwe-backend (libs/aes.py).  Newer files start with a header
+    and a version, version 1 is AES-GCM, older files are a 16 byte IV and AES-CFB-8. """
+    if data.startswith(b"\x00BEIWE\xe5\x5a"):
+        if data[8] != 1:
+            raise Exception(f"unknown server encryption version: {data[8]}")
+        nonce, ciphertext, tag = data[9:21], data[21:-16], data[-16:]
+        return AES.new(ENCRYPTION_KEY, AES.MODE_GCM, nonce=nonce).decrypt_and_verify(ciphertext, tag)
     iv = data[:16]
     data = data[16:]
     return AES.new(ENCRYPTION_KEY, AES.MODE_CFB, segment_size=8, IV=iv).decrypt(data)